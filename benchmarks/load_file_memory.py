@@ -0,0 +1,52 @@
+# Peak RSS of database_interface.load_file for growing file sizes, memory use should stay flat.
+# Requires BIFROST_DB_KEY to point at a test database, e.g.
+#   BIFROST_DB_KEY=mongodb://localhost:27017/bifrost_test python benchmarks/load_file_memory.py --sizes 16 256 1024
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from bson import ObjectId
+from bifrostlib import database_interface
+
+
+def peak_rss_of_load(file_id: ObjectId, save_to_path: str, buffer_size: int) -> int:
+    """Loads the file in a fresh interpreter and returns its peak RSS in KiB
+    """
+    code = (
+        "import resource, sys\n"
+        "from bson import ObjectId\n"
+        "from bifrostlib import database_interface\n"
+        f"assert database_interface.load_file(ObjectId('{file_id}'), {save_to_path!r}, buffer_size={buffer_size}, verify_checksum=True) is not None\n"
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return int(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Peak RSS of load_file for growing file sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 128, 512], help="file sizes in MiB")
+    parser.add_argument("--buffer_size", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+    assert "TEST" in os.environ["BIFROST_DB_KEY"].upper()
+    fs = database_interface.gridfs.GridFS(database_interface.get_connection().get_database())
+    print("size_mib\tpeak_rss_mib")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in args.sizes:
+            source_path = os.path.join(work_dir, f"source_{size}.bin")
+            with open(source_path, "wb") as file_handle:
+                for i in range(size):
+                    file_handle.write(os.urandom(1024 * 1024))
+            owner_id = ObjectId()
+            file_id = database_interface.save_file(owner_id, f"benchmark_{size}", "benchmark", source_path)
+            try:
+                peak_rss = peak_rss_of_load(file_id, os.path.join(work_dir, f"loaded_{size}.bin"), args.buffer_size)
+                print(f"{size}\t{peak_rss / 1024:.1f}")
+            finally:
+                fs.delete(file_id)
+                os.remove(source_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 __all__ = [
     'datahandling', 
     'common',
-    'database_interface'
+    'database_interface',
+    'cache',
+    'file_cache',
+    'scheduler',
+    'work_queue'
     ]
 
 __version__ = '2.1.21'
@@ -0,0 +1,248 @@
+# In memory cache of bifrost objects for long running services (dashboard, scheduler)
+import copy
+import datetime
+import sys
+import threading
+import traceback
+from typing import Dict, List, Tuple, Type
+from bson import ObjectId
+from bifrostlib import database_interface
+from bifrostlib.datahandling import BifrostObject
+from bifrostlib.datahandling import BifrostObjectReference
+from bifrostlib.datahandling import Component
+from bifrostlib.datahandling import Sample
+from bifrostlib.datahandling import SampleComponent
+
+
+class ObjectCache:
+    """Caches bifrost objects and keeps them in line with the DB
+
+    Note:
+        Entries are invalidated (or refreshed) from a MongoDB change stream on the cached collections, which
+        is resumed from its last resume token when it closes. Change streams require a replica set, when they
+        are unavailable (or can't be resumed) the cache falls back to polling metadata.updated_at for changed
+        entries and a projected _id query for deleted entries. metadata.updated_at is set from the clock of
+        each writer, so polls look poll_overlap seconds behind the newest timestamp seen. Writes from clocks
+        further behind than that may be missed while polling.
+
+    Args:
+        object_classes (List[Type[BifrostObject]], optional): Object types to cache. Defaults to Sample, SampleComponent and Component.
+        refresh (bool, optional): Replace changed cached entries with the new document instead of dropping them, change stream only. Defaults to False.
+        poll_interval (float, optional): Seconds between polls when change streams are unavailable. Defaults to 30.
+        use_change_stream (bool, optional): Try change streams before falling back to polling. Defaults to True.
+        poll_overlap (float, optional): Seconds polls look back past the newest metadata.updated_at seen. Defaults to 300.
+    """
+    def __init__(self, object_classes: List[Type[BifrostObject]] = (Sample, SampleComponent, Component), refresh: bool = False, poll_interval: float = 30.0, use_change_stream: bool = True, poll_overlap: float = 300.0) -> None:
+        self.object_classes = {i._object_type: i for i in object_classes}
+        self.collections = {database_interface.pluralize(i): i for i in self.object_classes}
+        self.refresh = refresh
+        self.poll_interval = poll_interval
+        self.use_change_stream = use_change_stream
+        self.poll_overlap = datetime.timedelta(seconds=poll_overlap)
+        self.mode = None  # "change_stream" or "polling" once started
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[Tuple[str, str], Dict] = {}
+        self._names: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._started = threading.Event()
+        self._thread = None
+        self._watermark = None
+        self._seen: Dict[Tuple[str, str], datetime.datetime] = {}  # updated_at of entries within the poll overlap
+        # invalidations are counted so a load racing an invalidation isn't stored, see get
+        self._invalidations = 0
+        self._invalidated: Dict[Tuple[str, str], int] = {}
+        self._type_invalidated: Dict[str, int] = {}
+        self._loading = 0
+    def __enter__(self):
+        self.start()
+        return self
+    def __exit__(self, *args) -> None:
+        self.stop()
+    def __len__(self) -> int:
+        return len(self._entries)
+    def start(self) -> None:
+        """Start the background thread keeping the cache up to date
+
+        Note:
+            Cached entries are dropped, they could have changed while the cache was stopped. Returns once the
+            change stream is open (or polling has been fallen back to) so no change after start is missed
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._started.clear()
+        self.mode = None
+        self.clear()
+        self._watermark = datetime.datetime.now(datetime.timezone.utc)
+        self._seen.clear()
+        self._thread = threading.Thread(target=self._run, name="bifrost-object-cache", daemon=True)
+        self._thread.start()
+        self._started.wait()
+    def stop(self) -> None:
+        """Stop the background thread, cached entries are kept but no longer invalidated until the next start
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    def get(self, object_class: Type[BifrostObject], reference: BifrostObjectReference) -> BifrostObject:
+        """Get an object from the cache, loading it from the DB on a miss
+
+        Args:
+            object_class (Type[BifrostObject]): class of the object e.g. Sample
+            reference (BifrostObjectReference): reference to the object, _id is preferred over name
+
+        Returns:
+            BifrostObject: A new object built from the cached json, None if not in the DB
+        """
+        object_type = object_class._object_type
+        json_object = self._lookup(object_type, reference.json)
+        if json_object is None:
+            with self._lock:
+                self.misses += 1
+                self._loading += 1
+                loaded_after = self._invalidations
+            try:
+                json_object = database_interface.load(object_type, reference.json)
+                if "_id" not in json_object:
+                    return None
+                self._store(object_type, json_object, loaded_after)
+            finally:
+                with self._lock:
+                    self._loading -= 1
+                    if self._loading == 0:
+                        self._invalidated.clear()
+                        self._type_invalidated.clear()
+        else:
+            with self._lock:
+                self.hits += 1
+        return object_class(schema_version=reference.schema_version, value=copy.deepcopy(json_object))
+    def invalidate(self, object_type: str, _id: str = None) -> None:
+        """Drop an entry, or all entries of an object type, from the cache
+
+        Args:
+            object_type (str): A bifrost object type e.g. sample
+            _id (str, optional): string form of the ObjectId, if None all entries of the type are dropped. Defaults to None.
+        """
+        with self._lock:
+            self._invalidations += 1
+            # only loads in flight need to know what was invalidated, they're cleared when the last one ends
+            if _id is None:
+                if self._loading:
+                    self._type_invalidated[object_type] = self._invalidations
+                keys = [key for key in self._entries if key[0] == object_type]
+            else:
+                if self._loading:
+                    self._invalidated[(object_type, _id)] = self._invalidations
+                keys = [(object_type, _id)]
+            for key in keys:
+                self._drop(key)
+    def clear(self) -> None:
+        with self._lock:
+            for object_type in self.object_classes:
+                self.invalidate(object_type)
+            self._entries.clear()
+            self._names.clear()
+    def _drop(self, key: Tuple[str, str]) -> None:
+        json_object = self._entries.pop(key, None)
+        if json_object is not None and json_object.get("name") is not None:
+            self._names.pop((key[0], json_object["name"]), None)
+    def _lookup(self, object_type: str, reference: Dict) -> Dict:
+        with self._lock:
+            _id = reference.get("_id", {}).get("$oid")
+            if _id is None and reference.get("name"):
+                _id = self._names.get((object_type, reference["name"]))
+            if _id is None:
+                return None
+            return self._entries.get((object_type, _id))
+    def _store(self, object_type: str, json_object: Dict, loaded_after: int = None) -> None:
+        """Caches a document, unless it was loaded before an invalidation of it (loaded_after is the invalidation count when the load started)
+        """
+        with self._lock:
+            _id = json_object["_id"]["$oid"]
+            if loaded_after is not None and max(self._invalidated.get((object_type, _id), 0), self._type_invalidated.get(object_type, 0)) > loaded_after:
+                return
+            self._drop((object_type, _id))
+            self._entries[(object_type, _id)] = json_object
+            if json_object.get("name") is not None:
+                self._names[(object_type, json_object["name"])] = _id
+    def _cached_ids(self, object_type: str) -> List[str]:
+        with self._lock:
+            return [key[1] for key in self._entries if key[0] == object_type]
+    def _run(self) -> None:
+        if self.use_change_stream:
+            try:
+                self._watch()
+                return
+            except Exception:
+                # e.g. "The $changeStream stage is only supported on replica sets", or a stream that can't be resumed
+                print(traceback.format_exc(), file=sys.stderr)
+        self.mode = "polling"
+        self.clear()  # changes could have been missed while switching mode
+        self._started.set()
+        self._poll()
+    def _watch(self) -> None:
+        db = database_interface.get_connection().get_database()
+        pipeline = [{"$match": {"ns.coll": {"$in": list(self.collections)}}}]
+        full_document = "updateLookup" if self.refresh else None
+        resume_token = None
+        while not self._stop.is_set():
+            # a closed stream is reopened after the last change seen, errors fall back to polling in _run
+            with db.watch(pipeline, full_document=full_document, max_await_time_ms=1000, resume_after=resume_token) as stream:
+                # the stream is open once watch returns, changes from here on are seen
+                self.mode = "change_stream"
+                self._started.set()
+                while not self._stop.is_set() and stream.alive:
+                    change = stream.try_next()
+                    resume_token = stream.resume_token
+                    if change is not None:
+                        self._apply_change(change)
+    def _apply_change(self, change: Dict) -> None:
+        object_type = self.collections.get(change.get("ns", {}).get("coll"))
+        if object_type is None:
+            return
+        if change["operationType"] in ("drop", "rename", "invalidate"):
+            self.invalidate(object_type)
+            return
+        _id = str(change["documentKey"]["_id"])
+        full_document = change.get("fullDocument")
+        with self._lock:
+            # only cached entries are refreshed, anything else would grow the cache to mirror the collections
+            cached = (object_type, _id) in self._entries
+            self.invalidate(object_type, _id)  # a load in flight has an older version
+            if self.refresh and cached and full_document is not None:
+                self._store(object_type, database_interface.bson_to_json(full_document))
+    def _poll(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self._poll_once()
+            except Exception:
+                print(traceback.format_exc(), file=sys.stderr)
+    def _poll_once(self) -> None:
+        db = database_interface.get_connection().get_database()
+        watermark = self._watermark
+        since = self._watermark - self.poll_overlap
+        for collection_name, object_type in self.collections.items():
+            changed = db[collection_name].find(
+                {"metadata.updated_at": {"$gte": since}},
+                projection={"_id": 1, "metadata.updated_at": 1})
+            for entry in changed:
+                updated_at = entry["metadata"]["updated_at"].replace(tzinfo=datetime.timezone.utc)
+                watermark = max(watermark, updated_at)
+                key = (object_type, str(entry["_id"]))
+                if self._seen.get(key) == updated_at:
+                    continue  # already invalidated for this change in an earlier poll
+                self._seen[key] = updated_at
+                self.invalidate(object_type, str(entry["_id"]))
+            cached_ids = self._cached_ids(object_type)
+            if cached_ids:
+                existing = db[collection_name].find(
+                    {"_id": {"$in": [ObjectId(i) for i in cached_ids]}},
+                    projection={"_id": 1})
+                deleted = set(cached_ids) - set(str(i["_id"]) for i in existing)
+                for _id in deleted:
+                    self.invalidate(object_type, _id)
+        self._watermark = watermark
+        self._seen = {key: updated_at for key, updated_at in self._seen.items() if updated_at >= watermark - self.poll_overlap}
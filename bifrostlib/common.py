@@ -10,7 +10,7 @@ def get_group_from_file(pattern: Pattern, source: TextIO = "", buffer: str = Non
 
     Args:
         pattern (re.Pattern): regex style pattern with at least one capture group
-        source (str, optional): File to look into. Defaults to "".
+        source (str, optional): File to look into, either a path or an open file e.g. from database_interface.open_file. Defaults to "".
         buffer (str, optional): buffer to look into. Defaults to None.
         group (int, optional): capture group you want the result of. Defaults to 1.
 
@@ -20,8 +20,13 @@ def get_group_from_file(pattern: Pattern, source: TextIO = "", buffer: str = Non
         str: The value of the capture group in the regex, if it's not found return None
     """
     if buffer is None:
-        with open(source, "r+") as fh:
-            buffer = fh.read()
+        if hasattr(source, "read"):
+            buffer = source.read()
+            if isinstance(buffer, bytes):
+                buffer = buffer.decode()
+        else:
+            with open(source, "r+") as fh:
+                buffer = fh.read()
     try:
         value = str(re.search(pattern, buffer, re.MULTILINE).group(group))
         return value
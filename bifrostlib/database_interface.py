@@ -1,14 +1,26 @@
 import os
 import pymongo
 import atexit
+import concurrent.futures
+import contextlib
+import datetime
 import json
 from bson import json_util
 import traceback
-from typing import Dict
+from typing import Dict, Iterator, List, Tuple
 import gridfs
+import gzip
+import io
+import importlib.util
+import hashlib
+import uuid
 import mimetypes
+import shutil
 import sys
+import tempfile
+import threading
 from pymongo import MongoClient
+from bifrostlib import file_cache
 
 CONNECTION = None
 
@@ -52,6 +64,37 @@ def close_connection():
 atexit.register(close_connection)
 
 
+def flush_write_buffer() -> int:
+    """Flushes the buffered updates of get_write_buffer
+
+    Other Parameters:
+        WRITE_BUFFER (WriteBehindBuffer): GLOBAL storing the buffer
+
+    Returns:
+        int: number of documents updated
+    """
+    if WRITE_BUFFER is None:
+        return 0
+    return WRITE_BUFFER.flush()
+
+
+def close_write_buffer() -> int:
+    """Stops the background flushing of get_write_buffer and flushes, registered with atexit to run before close_connection
+
+    Other Parameters:
+        WRITE_BUFFER (WriteBehindBuffer): GLOBAL storing the buffer
+
+    Returns:
+        int: number of documents updated
+    """
+    if WRITE_BUFFER is None:
+        return 0
+    return WRITE_BUFFER.close()
+
+
+atexit.register(close_write_buffer)  # atexit runs in reverse, so this flushes before the connection is closed
+
+
 def pluralize(name: str) -> str:
     """Turns a string into a pluralized form. For example sample -> samples and property -> properties
 
@@ -97,7 +140,7 @@ def remove_id(reference: Dict) -> Dict:
     return reference
 
 
-def load(object_type: str, reference: Dict) -> Dict:
+def load(object_type: str, reference: Dict, projection: Dict = None) -> Dict:
     """Loads an object based on it's id from the DB
 
     Note: 
@@ -106,6 +149,7 @@ def load(object_type: str, reference: Dict) -> Dict:
     Args: 
         object_type (str): A bifrost object type found in the database as a collection
         reference (Dict): json formatted reference (normally id as objectid {"$oid": <value>} and name)
+        projection (Dict, optional): MongoDB projection e.g. {"categories": 0}. Defaults to None for the whole object.
 
     Returns: 
         Dict: json formatted dict of the object
@@ -127,7 +171,7 @@ def load(object_type: str, reference: Dict) -> Dict:
                 query = ({"name": bson_reference["name"]})
             else:
                 return remove_id(reference)
-            query_result = list(db[collection_name].find(query))
+            query_result = list(db[collection_name].find(query, projection=projection))
             assert(len(query_result) <= 1)
             if len(query_result) == 0:
                 return remove_id(reference)
@@ -141,6 +185,51 @@ def load(object_type: str, reference: Dict) -> Dict:
         return remove_id(reference)
 
 
+def find(object_type: str, query: Dict, projection: Dict = None, batch_size: int = 1000) -> Iterator[Dict]:
+    """Streams the objects matching a query from the DB
+
+    Note:
+        Inputs and outputs are json dict but database works on bson dicts
+
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+        query (Dict): json formatted MongoDB filter
+        projection (Dict, optional): MongoDB projection, None for the whole object. Defaults to None.
+        batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+
+    Yields:
+        Dict: json formatted dict of each matching object
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    collection_name = pluralize(object_type)
+    cursor = db[collection_name].find(json_to_bson(query), projection=projection, batch_size=batch_size)
+    for bson_object in cursor:
+        yield bson_to_json(bson_object)
+
+
+def aggregate(object_type: str, pipeline: List[Dict], batch_size: int = 1000) -> Iterator[Dict]:
+    """Runs an aggregation pipeline on a collection
+
+    Note:
+        Inputs and outputs are json dict but database works on bson dicts
+
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+        pipeline (List[Dict]): json formatted MongoDB aggregation pipeline
+        batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+
+    Yields:
+        Dict: json formatted dict of each resulting document
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    collection_name = pluralize(object_type)
+    cursor = db[collection_name].aggregate(json_to_bson(pipeline), batchSize=batch_size)
+    for bson_object in cursor:
+        yield bson_to_json(bson_object)
+
+
 def save(object_type: str, object_value: Dict) -> Dict:
     """Saves a object to the DB
 
@@ -179,6 +268,54 @@ def save(object_type: str, object_value: Dict) -> Dict:
 
 
 
+def save_many(object_type: str, object_values: List[Dict], session=None) -> List[Dict]:
+    """Saves many objects of a type to the DB in one bulk write
+
+    Note:
+        Objects with an _id are upserted like in save, the others inserted
+
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+        object_values (List[Dict]): json formatted objects
+        session (pymongo.client_session.ClientSession, optional): session of a transaction, see transaction. Defaults to None.
+
+    Returns:
+        List[Dict]: json formatted dicts of the objects with objectids, in the same order
+    """
+    bson_object_values = [json_to_bson(i) for i in object_values]
+    requests = []
+    for bson_object_value in bson_object_values:
+        if "_id" in bson_object_value:
+            requests.append(pymongo.UpdateOne({"_id": bson_object_value["_id"]}, {"$set": bson_object_value}, upsert=True))
+        else:
+            requests.append(pymongo.InsertOne(bson_object_value))  # sets the _id of bson_object_value
+    if requests:
+        db = get_connection().get_database()
+        db[pluralize(object_type)].bulk_write(requests, ordered=True, session=session)
+    return [bson_to_json(i) for i in bson_object_values]
+
+
+@contextlib.contextmanager
+def transaction(enabled: bool = True) -> Iterator:
+    """Runs the enclosed writes in a transaction, committed at the end and aborted on an exception
+
+    Note:
+        Transactions need MongoDB as a replica set or sharded cluster. Pass the session to the writes.
+
+    Args:
+        enabled (bool, optional): False to yield no session and write without a transaction. Defaults to True.
+
+    Yields:
+        pymongo.client_session.ClientSession: session of the transaction, None if not enabled
+    """
+    if not enabled:
+        yield None
+        return
+    with get_connection().start_session() as session:
+        with session.start_transaction():
+            yield session
+
+
 def delete(object_type: str, reference: Dict) -> bool:
     """Deletes a object from the DB based on it's id
 
@@ -215,78 +352,1048 @@ def delete(object_type: str, reference: Dict) -> bool:
         return False
 
 
-def save_file(_id, _name, _type, file_path) -> str:
-    try:
-        connection = get_connection()
-        db = connection.get_database()
-        fs = gridfs.GridFS(db)
+def load_fields(object_type: str, _id, fields: List[str]) -> Dict:
+    """Loads only some fields of an object, e.g. one category of a lazily loaded object
 
-        # check if file is there
-        existing = fs.find_one({
-            "_id": _id,
-            "full_path": file_path
-        })
-        if existing:
-            print(("WARNING: File {} already exists in".format(file_path),
-                   " the db for this component,",
-                   " it was overwritten by the new file."), file=sys.stderr)
-            fs.delete(existing.id)
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+        _id (ObjectId): id of the object
+        fields (List[str]): field paths to load, e.g. ["categories.mlst"]
 
-        mimetype = mimetypes.guess_type(file_path)
+    Returns:
+        Dict: json formatted dict of the fields found on the object, {} if it doesn't exist
+    """
+    db = get_connection().get_database()
+    document = db[pluralize(object_type)].find_one({"_id": _id}, projection={field: 1 for field in fields})
+    return bson_to_json(document) if document is not None else {}
 
-        with open(file_path, 'rb') as file_handle:
-            file_id = fs.put(file_handle,
-                             _id=_id,
-                             name=_name,
-                             type=_type,
-                             full_path=file_path,
-                             filename=os.path.basename(file_path),
-                             contentType=mimetype[0])
-        return file_id
+
+def update_fields(object_type: str, _id, fields: Dict) -> bool:
+    """Sets fields of a object by (dotted) path without sending the rest of the document
+
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+        _id (ObjectId): id of the object
+        fields (Dict): json formatted field paths to values, e.g. {"status": "Running", "properties.progress": 0.5}
+
+    Returns:
+        bool: True if the object exists
+    """
+    db = get_connection().get_database()
+    result = db[pluralize(object_type)].update_one({"_id": _id}, {"$set": json_to_bson(fields)})
+    return result.matched_count == 1
+
+
+def _merge_set(update: Dict, path: str, value) -> None:
+    """Merges a $set of path into update so no two paths of it collide, later values win
+    """
+    for existing in list(update):
+        if existing.startswith(path + "."):
+            del update[existing]
+    for existing in update:
+        if path.startswith(existing + "."):
+            if not isinstance(update[existing], dict):
+                update[existing] = {}
+            update[existing] = parent = json.loads(json.dumps(update[existing]))  # copy, the value may be shared
+            keys = path[len(existing) + 1:].split(".")
+            for key in keys[:-1]:
+                if not isinstance(parent.get(key), dict):
+                    parent[key] = {}
+                parent = parent[key]
+            parent[keys[-1]] = value
+            return
+    update[path] = value
+
+
+WRITE_BUFFER = None
+
+
+def get_write_buffer() -> "WriteBehindBuffer":
+    """Get the write buffer shared by the process, flushed at exit
+
+    Other Parameters:
+        WRITE_BUFFER (WriteBehindBuffer): GLOBAL storing the buffer
+        BIFROST_WRITE_BUFFER_INTERVAL: (ENV) seconds between flushes, defaults to 5
+        BIFROST_WRITE_BUFFER_SIZE: (ENV) buffered documents which trigger a flush, defaults to 1000
+
+    Returns:
+        WriteBehindBuffer: The shared buffer
+    """
+    global WRITE_BUFFER
+    if WRITE_BUFFER is None:
+        WRITE_BUFFER = WriteBehindBuffer(
+            flush_interval=float(os.getenv("BIFROST_WRITE_BUFFER_INTERVAL", 5)),
+            max_documents=int(os.getenv("BIFROST_WRITE_BUFFER_SIZE", 1000)))
+    return WRITE_BUFFER
+
+
+class WriteBehindBuffer:
+    """Buffers field updates and writes them later, merging the updates to the same document into one
+
+    Note:
+        Updates are flushed with one bulk_write per collection every flush_interval seconds by a background
+        thread, as soon as max_documents documents have buffered updates, on flush and at exit for the shared
+        buffer of get_write_buffer. Until then the DB doesn't have the updates, so only use it for fields
+        nothing else waits on e.g. progress and heartbeats. Updates which fail to write are kept for the next
+        flush unless newer updates replaced them, the updates written are not written again.
+
+    Args:
+        flush_interval (float, optional): seconds between flushes, None for no background flushing. Defaults to 5.
+        max_documents (int, optional): buffered documents which trigger a flush. Defaults to 1000.
+    """
+    def __init__(self, flush_interval: float = 5.0, max_documents: int = 1000) -> None:
+        self.flush_interval = flush_interval
+        self.max_documents = max_documents
+        self._updates: Dict[Tuple[str, object], Dict] = {}  # (object_type, _id) to the merged $set
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.merged = 0
+    def __len__(self) -> int:
+        return len(self._updates)
+    def update(self, object_type: str, _id, fields: Dict) -> None:
+        """Buffers setting fields of a object, see update_fields
+
+        Args:
+            object_type (str): A bifrost object type found in the database as a collection
+            _id (ObjectId): id of the object
+            fields (Dict): json formatted field paths to values
+        """
+        with self._lock:
+            update = self._updates.get((object_type, _id))
+            if update is None:
+                update = self._updates[(object_type, _id)] = {}
+            else:
+                self.merged += 1
+            for path, value in fields.items():
+                _merge_set(update, path, value)
+            full = len(self._updates) >= self.max_documents
+            if self._thread is None and self.flush_interval is not None:
+                self._thread = threading.Thread(target=self._run, name="bifrost-write-buffer", daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                print(traceback.format_exc(), file=sys.stderr)
+    def flush(self) -> int:
+        """Writes the buffered updates
+
+        Returns:
+            int: number of documents updated
+
+        Raises:
+            pymongo.errors.PyMongoError: If the updates couldn't be written, they are kept to retry
+        """
+        with self._flush_lock:
+            with self._lock:
+                updates, self._updates = self._updates, {}
+            if not updates:
+                return 0
+            per_collection: Dict[str, List] = {}
+            for key in updates:
+                per_collection.setdefault(pluralize(key[0]), []).append(key)
+            db = get_connection().get_database()
+            written = 0
+            failed = []
+            error = None
+            for collection_name, keys in per_collection.items():
+                requests = [pymongo.UpdateOne({"_id": key[1]}, {"$set": json_to_bson(updates[key])}) for key in keys]
+                try:
+                    written += db[collection_name].bulk_write(requests, ordered=False).matched_count
+                except pymongo.errors.BulkWriteError as bulk_error:
+                    # unordered, so only the requests with a write error weren't applied
+                    written += bulk_error.details.get("nMatched", 0)
+                    failed.extend(keys[i["index"]] for i in bulk_error.details.get("writeErrors", []))
+                    error = error or bulk_error
+                except Exception as collection_error:
+                    failed.extend(keys)
+                    error = error or collection_error
+            if failed:
+                with self._lock:
+                    for key in failed:
+                        update = updates[key]
+                        for path, value in self._updates.get(key, {}).items():
+                            _merge_set(update, path, value)
+                        self._updates[key] = update
+            if error is not None:
+                raise error
+            self.flushes += 1
+            return written
+    def close(self) -> int:
+        """Stops the background flushing and flushes
+
+        Returns:
+            int: number of documents updated
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.flush()
+
+
+def save_file(_id, _name, _type, file_path, chunk_size: int = None, compression: str = None) -> str:
+    """Saves a file to GridFS, replacing the file already stored for the object at the same path
+
+    Note:
+        The file is hashed in a pass of its own before it is uploaded, so it's read twice. The sha256 has to be
+        known first to skip an unchanged file and to reference a stored file with the same content instead of
+        uploading it again; hashing while streaming would upload every duplicate before it could be found.
+
+    Args:
+        _id (ObjectId): id of the object the file belongs to
+        _name (str): name of the object the file belongs to
+        _type (str): object type of the object the file belongs to
+        file_path (str): path of the file
+        chunk_size (int, optional): GridFS chunk size in bytes, None for the GridFS default (255 KiB). Defaults to None.
+        compression (str, optional): "none", "auto", "gzip" or "zstd", see choose_file_codec. Defaults to None for BIFROST_FILE_COMPRESSION.
+
+    Returns:
+        str: file_id on success, None on failure
+    """
+    try:
+        return _save_file(_id, _name, _type, file_path, chunk_size, compression)
     except Exception:
         print(traceback.format_exc())
         return None
 
 
-def load_file(file_id, save_to_path=None, subpath=False) -> str:
+def hash_file(file_path: str, buffer_size: int = 1024 * 1024) -> str:
+    """Streams a file through sha256
+
+    Args:
+        file_path (str): path of the file
+        buffer_size (int, optional): bytes read at a time. Defaults to 1 MiB.
+
+    Returns:
+        str: sha256 hexdigest of the content
+    """
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as file_handle:
+        chunk = file_handle.read(buffer_size)
+        while chunk:
+            checksum.update(chunk)
+            chunk = file_handle.read(buffer_size)
+    return checksum.hexdigest()
+
+
+FILE_INDEXES_CREATED = False
+
+
+def ensure_file_indexes() -> None:
+    """Creates the indexes on fs.files used for deduplication and lookups by owner, once per process
+
+    Other Parameters:
+        FILE_INDEXES_CREATED (bool): GLOBAL storing whether indexes were created
+    """
+    global FILE_INDEXES_CREATED
+    if FILE_INDEXES_CREATED:
+        return
+    connection = get_connection()
+    db = connection.get_database()
+    db["fs.files"].create_index("sha256", unique=True, partialFilterExpression={"sha256": {"$exists": True}})
+    db["fs.files"].create_index([("references._id", pymongo.ASCENDING), ("references.full_path", pymongo.ASCENDING)])
+    db["fs.files"].create_index([("references.type", pymongo.ASCENDING)])
+    FILE_INDEXES_CREATED = True
+
+
+def _add_file_reference(db, sha256: str, reference: Dict):
+    """Adds a reference to the stored file with this content, returns its id or None if the content isn't stored
+    """
+    stored = db["fs.files"].find_one_and_update(
+        {"sha256": sha256, "refcount": {"$gt": 0}},
+        {"$push": {"references": reference}, "$inc": {"refcount": 1}},
+        projection={"_id": 1}
+    )
+    return None if stored is None else stored["_id"]
+
+
+def release_file(file_id, _id, file_path: str = None) -> bool:
+    """Removes an object's reference to a stored file, the file is deleted when no references remain
+
+    Args:
+        file_id (ObjectId): GridFS id of the file
+        _id (ObjectId): id of the object referencing the file
+        file_path (str, optional): only release the reference for this path, None for all of the object's references. Defaults to None.
+
+    Returns:
+        bool: True if the file was deleted
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    keep = [{"$ne": ["$$reference._id", _id]}]
+    if file_path is not None:
+        keep.append({"$ne": ["$$reference.full_path", file_path]})
+    # refcount is recomputed from the remaining references in the same atomic update
+    db["fs.files"].update_one(
+        {"_id": file_id, "references._id": _id},
+        [
+            {"$set": {"references": {"$filter": {"input": "$references", "as": "reference", "cond": {"$or": keep}}}}},
+            {"$set": {"refcount": {"$size": "$references"}}}
+        ]
+    )
+    return _delete_unreferenced_file(db, file_id)
+
+
+def release_files(_id) -> int:
+    """Removes all of an object's references to stored files, deleting files no longer referenced
+
+    Note:
+        Files stored under the object's _id before deduplication are deleted as well
+
+    Args:
+        _id (ObjectId): id of the object
+
+    Returns:
+        int: number of deleted files
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    fs = gridfs.GridFS(db)
+    deleted = 0
+    for stored in db["fs.files"].find({"references._id": _id}, projection={"_id": 1}):
+        deleted += release_file(stored["_id"], _id)
+    if fs.exists(_id):
+        fs.delete(_id)
+        deleted += 1
+    return deleted
+
+
+def delete_cascade(run_ids: List = (), sample_ids: List = (), dry_run: bool = False, in_transaction: bool = False, keep_shared_samples: bool = False) -> Dict[str, int]:
+    """Deletes runs and samples with their runcomponents, samplecomponents and stored files
+
+    Note:
+        Each collection takes one delete_many keyed on the ids, and references to the deleted samples are
+        pulled from the remaining runs and hosts. The deleted objects' references to stored files are
+        released (see release_files) in one update, and files no other object references are deleted.
+        With keep_shared_samples the samples still listed (by _id) by a run which isn't deleted are found with
+        one distinct and left out, they are counted under "shared_samples".
+
+    Args:
+        run_ids (List, optional): ids of the runs to delete. Defaults to ().
+        sample_ids (List, optional): ids of the samples to delete. Defaults to ().
+        dry_run (bool, optional): only count what would be deleted. Defaults to False.
+        in_transaction (bool, optional): do the deletes in one transaction, needs a replica set. Defaults to False.
+        keep_shared_samples (bool, optional): don't delete samples other runs still list. Defaults to False.
+
+    Returns:
+        Dict[str, int]: number of documents deleted (or to delete with dry_run) per collection, of "files" and with keep_shared_samples of "shared_samples" kept
+    """
+    db = get_connection().get_database()
+    run_ids, sample_ids = list(run_ids), list(sample_ids)
+    with transaction(in_transaction) as session:
+        shared_samples = set()
+        if keep_shared_samples and sample_ids:
+            listed = db["runs"].distinct("samples._id", {"_id": {"$nin": run_ids}, "samples._id": {"$in": sample_ids}}, session=session)
+            shared_samples = set(listed).intersection(sample_ids)
+            sample_ids = [i for i in sample_ids if i not in shared_samples]
+        filters = {
+            "runs": {"_id": {"$in": run_ids}},
+            "samples": {"_id": {"$in": sample_ids}},
+            "run_components": {"run._id": {"$in": run_ids}},
+            "sample_components": {"sample._id": {"$in": sample_ids}},
+        }
+        owners = run_ids + sample_ids
+        for collection_name in ("run_components", "sample_components"):
+            owners += [i["_id"] for i in db[collection_name].find(filters[collection_name], projection={"_id": 1}, session=session)]
+        owner_set = set(owners)
+        referenced_files = []
+        legacy_files = []  # stored under the owner's _id before migrate_file_layout
+        released_files = 0
+        for stored in db["fs.files"].find(_owner_query(owners), projection={"references._id": 1}, session=session):
+            if "references" not in stored:
+                legacy_files.append(stored["_id"])
+            else:
+                referenced_files.append(stored["_id"])
+                released_files += all(i["_id"] in owner_set for i in stored["references"])
+        if dry_run:
+            counts = {name: db[name].count_documents(query, session=session) for name, query in filters.items()}
+            counts["files"] = len(legacy_files) + released_files
+            if keep_shared_samples:
+                counts["shared_samples"] = len(shared_samples)
+            return counts
+        counts = {name: db[name].delete_many(query, session=session).deleted_count for name, query in filters.items()}
+        sample_references = {"samples._id": {"$in": sample_ids}}
+        for collection_name in ("runs", "hosts"):
+            db[collection_name].update_many(sample_references, {"$pull": {"samples": {"_id": {"$in": sample_ids}}}}, session=session)
+        unreferenced_files = list(legacy_files)
+        if referenced_files:
+            db["fs.files"].update_many(
+                {"_id": {"$in": referenced_files}},
+                [
+                    {"$set": {"references": {"$filter": {"input": "$references", "as": "reference", "cond": {"$not": {"$in": ["$$reference._id", owners]}}}}}},
+                    {"$set": {"refcount": {"$size": "$references"}}}
+                ],
+                session=session
+            )
+            # only files left without references, none are added to a file once its refcount is 0
+            unreferenced_files += [i["_id"] for i in db["fs.files"].find({"_id": {"$in": referenced_files}, "refcount": {"$lte": 0}}, projection={"_id": 1}, session=session)]
+        counts["files"] = db["fs.files"].delete_many({"_id": {"$in": unreferenced_files}}, session=session).deleted_count
+        db["fs.chunks"].delete_many({"files_id": {"$in": unreferenced_files}}, session=session)
+        if keep_shared_samples:
+            counts["shared_samples"] = len(shared_samples)
+    return counts
+
+
+def _delete_unreferenced_file(db, file_id) -> bool:
+    deleted = db["fs.files"].delete_one({"_id": file_id, "refcount": {"$lte": 0}})
+    if deleted.deleted_count:
+        db["fs.chunks"].delete_many({"files_id": file_id})
+        return True
+    return False
+
+
+FILE_CODECS = ("gzip", "zstd")
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/xml", "application/x-yaml", "application/javascript")
+COMPRESSIBLE_EXTENSIONS = (".tsv", ".csv", ".txt", ".log", ".json", ".yaml", ".yml", ".fasta", ".fa", ".fna", ".ffn", ".faa", ".fastq", ".fq", ".sam", ".vcf", ".gff", ".gfa", ".err", ".out")
+COMPRESSION_MIN_SIZE = 4096
+
+
+def choose_file_codec(file_path: str, compression: str = None) -> str:
+    """Picks the codec a file is stored with
+
+    Note:
+        "auto" compresses text files (text/* or known text mimetypes and extensions) of at least
+        COMPRESSION_MIN_SIZE bytes, with zstd when the zstandard package is installed and gzip otherwise.
+
+    Args:
+        file_path (str): path of the file
+        compression (str, optional): "none", "auto", "gzip" or "zstd". Defaults to None for the BIFROST_FILE_COMPRESSION env var, which defaults to "none".
+
+    Returns:
+        str: codec name, None for uncompressed
+    """
+    if compression is None:
+        compression = os.getenv("BIFROST_FILE_COMPRESSION", "none")
+    if compression == "none":
+        return None
+    if compression in FILE_CODECS:
+        return compression
+    if compression != "auto":
+        raise ValueError(f"compression: {compression} not one of none, auto, {', '.join(FILE_CODECS)}")
+    mimetype = mimetypes.guess_type(file_path)
+    is_text = (
+        (mimetype[0] is not None and (mimetype[0].startswith("text/") or mimetype[0] in COMPRESSIBLE_MIMETYPES))
+        or os.path.splitext(file_path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+    )
+    if mimetype[1] is not None or not is_text or os.path.getsize(file_path) < COMPRESSION_MIN_SIZE:
+        return None  # already compressed (e.g. .gz), binary or too small to gain from it
+    if importlib.util.find_spec("zstandard") is not None:
+        return "zstd"
+    return "gzip"
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        raise ImportError("zstandard is required for zstd compressed files, install bifrostlib[zstd]")
+
+
+def _write_encoded(source, destination, codec: str, buffer_size: int = 1024 * 1024) -> None:
+    """Copies source into destination through the codec's compressor
+    """
+    if codec is None:
+        shutil.copyfileobj(source, destination, buffer_size)
+    elif codec == "gzip":
+        with gzip.GzipFile(fileobj=destination, mode="wb", mtime=0) as encoder:
+            shutil.copyfileobj(source, encoder, buffer_size)
+    elif codec == "zstd":
+        zstandard = _import_zstandard()
+        with zstandard.ZstdCompressor().stream_writer(destination, closefd=False) as encoder:
+            shutil.copyfileobj(source, encoder, buffer_size)
+    else:
+        raise ValueError(f"Unknown file codec: {codec}")
+
+
+def open_decoded(fobj):
+    """Wraps a stored file in a reader that decompresses it according to its codec
+
+    Args:
+        fobj (gridfs.GridOut): stored file
+
+    Returns:
+        a readable file object returning the original content
+    """
+    codec = getattr(fobj, "codec", None)
+    if codec is None:
+        return fobj
+    elif codec == "gzip":
+        return gzip.GzipFile(fileobj=fobj, mode="rb")
+    elif codec == "zstd":
+        zstandard = _import_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(fobj, closefd=False)
+    else:
+        raise ValueError(f"Unknown file codec: {codec}")
+
+
+def _save_file(_id, _name, _type, file_path, chunk_size: int = None, compression: str = None, full_path: str = None):
+    connection = get_connection()
+    db = connection.get_database()
+    fs = gridfs.GridFS(db)
+    ensure_file_indexes()
+
+    if full_path is None:
+        full_path = file_path
+    sha256 = hash_file(file_path)  # before uploading, for the dedup lookups, see save_file
+    reference = {"_id": _id, "name": _name, "type": _type, "full_path": full_path}
+
+    # check if file is there, referenced by the object or stored under the object's _id (not yet migrated, see migrate_file_layout)
+    existing = db["fs.files"].find_one(_owner_query(_id, full_path), projection={"sha256": 1, "references": 1})
+    if existing and "references" in existing and existing.get("sha256") == sha256:
+        return existing["_id"]
+    if existing:
+        print(("WARNING: File {} already exists in".format(full_path),
+               " the db for this component,",
+               " it was overwritten by the new file."), file=sys.stderr)
+        if "references" in existing:
+            release_file(existing["_id"], _id, full_path)
+        else:
+            fs.delete(existing["_id"])
+
+    mimetype = mimetypes.guess_type(full_path)
+    codec = choose_file_codec(file_path, compression)
+    options = {}
+    if chunk_size is not None:
+        options["chunkSize"] = chunk_size
+    if codec is not None:
+        options["codec"] = codec
+        options["uncompressed_length"] = os.path.getsize(file_path)
+
+    for attempt in range(3):
+        file_id = _add_file_reference(db, sha256, reference)
+        if file_id is not None:
+            return file_id
+        unreferenced = db["fs.files"].find_one({"sha256": sha256, "refcount": {"$lte": 0}}, projection={"_id": 1})
+        if unreferenced is not None:
+            # its last reference was released but the file not deleted yet, it would block the unique sha256
+            _delete_unreferenced_file(db, unreferenced["_id"])
+        with open(file_path, 'rb') as file_handle:
+            grid_in = fs.new_file(full_path=full_path,
+                                  filename=os.path.basename(full_path),
+                                  contentType=mimetype[0],
+                                  sha256=sha256,
+                                  references=[reference],
+                                  refcount=1,
+                                  **options)
+            try:
+                _write_encoded(file_handle, grid_in, codec)
+                grid_in.close()
+                return grid_in._id
+            except pymongo.errors.DuplicateKeyError:
+                # the same content was stored, or released, concurrently: reference or replace it on the next attempt
+                db["fs.chunks"].delete_many({"files_id": grid_in._id})
+    raise RuntimeError(f"File {full_path} could not be stored, its content was stored and deleted concurrently")
+
+
+def save_files(_id, _name, _type, file_paths: List[str], max_workers: int = 4, chunk_size: int = None, compression: str = None) -> Tuple[List, Dict[str, str]]:
+    """Saves files to GridFS concurrently with a bounded thread pool
+
+    Args:
+        _id (ObjectId): id of the object the files belong to
+        _name (str): name of the object the files belong to
+        _type (str): object type of the object the files belong to
+        file_paths (List[str]): paths of the files
+        max_workers (int, optional): maximum concurrent uploads. Defaults to 4.
+        chunk_size (int, optional): GridFS chunk size in bytes, None for the GridFS default. Defaults to None.
+        compression (str, optional): "none", "auto", "gzip" or "zstd", see choose_file_codec. Defaults to None for BIFROST_FILE_COMPRESSION.
+
+    Returns:
+        Tuple[List, Dict[str, str]]: file_id per path in the order of file_paths (None on failure), and file path to error for failed uploads
+    """
+    get_connection()  # connect once before the workers share the client
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_save_file, _id, _name, _type, file_path, chunk_size, compression) for file_path in file_paths]
+    file_ids = []
+    failures = {}
+    for file_path, future in zip(file_paths, futures):
+        if future.exception() is not None:
+            failures[file_path] = repr(future.exception())
+            print(f"WARNING: File {file_path} failed to upload: {failures[file_path]}", file=sys.stderr)
+            file_ids.append(None)
+        else:
+            file_ids.append(future.result())
+    return file_ids, failures
+
+
+def save_json_file(_id, _name, _type, full_path: str, value, compression: str = "auto"):
+    """Stores a json value as a file of an object, used to offload large subtrees of a document
+
+    Note:
+        The value goes through save_file so unchanged content isn't uploaded again and identical
+        content is stored once.
+
+    Args:
+        _id (ObjectId): id of the object the file belongs to
+        _name (str): name of the object the file belongs to
+        _type (str): object type of the object the file belongs to
+        full_path (str): path the file is stored under e.g. results/cgmlst.json, replacing the file stored there for the object
+        value (Any): json formatted value
+        compression (str, optional): "none", "auto", "gzip" or "zstd", see choose_file_codec. Defaults to "auto".
+
+    Returns:
+        ObjectId: file_id of the stored file
+    """
+    file_descriptor, temp_path = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(file_descriptor, "w") as file_handle:
+            json.dump(value, file_handle)
+        return _save_file(_id, _name, _type, temp_path, compression=compression, full_path=full_path)
+    finally:
+        os.remove(temp_path)
+
+
+def load_json_file(file_id):
+    """Loads a json value stored with save_json_file
+
+    Args:
+        file_id (ObjectId): GridFS id of the file
+
+    Returns:
+        Any: the json formatted value
+    """
+    with open_file(file_id, "r") as file_handle:
+        return json.load(file_handle)
+
+
+def load_file(file_id, save_to_path=None, subpath=False, buffer_size: int = 1024 * 1024, verify_checksum: bool = False, cache: file_cache.FileCache = None, owner_id=None) -> str:
+    """Streams a file from GridFS to disk
+
+    Note:
+        The file is read in buffer_size chunks into a temporary file next to save_to_path which is
+        renamed into place once complete, so memory use doesn't depend on the file size and a partial
+        download never shows up under save_to_path. Compressed files (see save_file) are decompressed transparently.
+        With a file cache the file is linked or copied from the cache, and only downloaded (into the cache) on a miss.
+
+    Args:
+        file_id (ObjectId): GridFS id of the file
+        save_to_path (str, optional): file or directory to save to, None for the stored name in the working directory. Defaults to None.
+        subpath (bool, optional): use the stored full_path instead of the filename. Defaults to False.
+        buffer_size (int, optional): bytes read from the DB per write. Defaults to 1 MiB.
+        verify_checksum (bool, optional): check the content against the stored sha256 or md5. Defaults to False.
+        cache (file_cache.FileCache, optional): cache to load through, None for file_cache.get_default_cache(). Defaults to None.
+        owner_id (ObjectId, optional): object loading the file, whose path is used for a file shared by several objects (see save_file). Defaults to None.
+
+    Returns:
+        str: file_id on success, None on failure
+    """
     try:
         connection = get_connection()
         db = connection.get_database()
         fs = gridfs.GridFS(db)
 
         fobj = fs.get(file_id)
+        full_path = _owner_path(fobj, owner_id)
 
         if save_to_path is None:
             if subpath:
-                save_to_path = fobj.full_path
+                save_to_path = full_path
             else:
-                save_to_path = fobj.filename
+                save_to_path = os.path.basename(full_path)
         elif os.path.isdir(save_to_path):
             if subpath:
-                save_to_path = os.path.join(save_to_path, fobj.full_path)
+                save_to_path = os.path.join(save_to_path, full_path)
             else:
-                save_to_path = os.path.join(save_to_path, fobj.filename)
+                save_to_path = os.path.join(save_to_path, os.path.basename(full_path))
 
         if os.path.isfile(save_to_path):
             raise FileExistsError
 
         dirname = os.path.dirname(save_to_path)
-        if not os.path.exists(dirname):
+        if dirname and not os.path.exists(dirname):
             os.makedirs(dirname)
 
-        with open(save_to_path, 'wb') as file_handle:
-            file_handle.write(fobj.read())
+        if cache is None:
+            cache = file_cache.get_default_cache()
+        if cache is not None:
+            verify = (lambda path: _verify_file(fobj, path, buffer_size)) if verify_checksum else None
+            cache.load(file_id, _cache_key(fobj), save_to_path, lambda path: _download_file(fobj, path, buffer_size, verify_checksum), verify)
+        else:
+            _download_file(fobj, save_to_path, buffer_size, verify_checksum)
         return file_id
     except Exception:
         print(traceback.format_exc())
         return None
 
 
-def find_files(object_id):
+def _owner_path(fobj: gridfs.GridOut, owner_id=None) -> str:
+    """full_path of a stored file for its owner, a deduplicated file has one per reference
+    """
+    references = getattr(fobj, "references", None) or []
+    if owner_id is not None:
+        for reference in references:
+            if reference["_id"] == owner_id and reference.get("full_path") is not None:
+                return reference["full_path"]
+    elif len(references) == 1 and references[0].get("full_path") is not None:
+        return references[0]["full_path"]
+    return fobj.full_path
+
+
+def _cache_key(fobj: gridfs.GridOut) -> str:
+    """Key of a stored file's content in the file cache, its checksum or else its length and upload time
+    """
+    checksum = getattr(fobj, "sha256", None) or getattr(fobj, "md5", None)
+    if checksum is not None:
+        return checksum
+    # pymongo 4 no longer stores md5, files saved by other clients can lack both
+    return f"{fobj.length}-{int(fobj.upload_date.timestamp() * 1000)}"
+
+
+def _stored_checksums(fobj: gridfs.GridOut) -> Dict:
+    checksums = {}
+    for algorithm in ("sha256", "md5"):
+        if getattr(fobj, algorithm, None) is not None:
+            checksums[algorithm] = hashlib.new(algorithm)
+    if not checksums:
+        print(f"WARNING: File {fobj._id} has no stored checksum, it was not verified", file=sys.stderr)
+    return checksums
+
+
+def _check_checksums(fobj: gridfs.GridOut, checksums: Dict) -> None:
+    for algorithm, checksum in checksums.items():
+        if checksum.hexdigest() != getattr(fobj, algorithm):
+            raise ValueError(f"{algorithm} of file {fobj._id} does not match the stored {algorithm}")
+
+
+def _verify_file(fobj: gridfs.GridOut, path: str, buffer_size: int) -> None:
+    """Checks a local copy of a stored file against its stored checksums, raising ValueError on a mismatch
+    """
+    checksums = _stored_checksums(fobj)
+    with open(path, 'rb') as file_handle:
+        chunk = file_handle.read(buffer_size)
+        while chunk:
+            for checksum in checksums.values():
+                checksum.update(chunk)
+            chunk = file_handle.read(buffer_size)
+    _check_checksums(fobj, checksums)
+
+
+def _download_file(fobj: gridfs.GridOut, save_to_path: str, buffer_size: int, verify_checksum: bool) -> None:
+    checksums = _stored_checksums(fobj) if verify_checksum else {}
+
+    temp_path = os.path.join(os.path.dirname(save_to_path), f".{os.path.basename(save_to_path)}.{uuid.uuid4().hex}.part")
+    try:
+        with open(temp_path, 'xb') as file_handle:
+            decoded = open_decoded(fobj)
+            chunk = decoded.read(buffer_size)
+            while chunk:
+                file_handle.write(chunk)
+                for checksum in checksums.values():
+                    checksum.update(chunk)
+                chunk = decoded.read(buffer_size)
+        _check_checksums(fobj, checksums)
+        os.replace(temp_path, save_to_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _owner_query(_id=None, file_path: str = None, _type: str = None) -> Dict:
+    """fs.files filter on the owner of a file, served by the references indexes
+
+    Note:
+        Files stored under the owner's _id (before migrate_file_layout) are matched as well. A list of
+        _ids matches files owned by any of them.
+    """
+    reference = {}
+    legacy = {}
+    if isinstance(_id, (list, tuple, set)):
+        _id = {"$in": list(_id)}
+    if _id is not None:
+        reference["_id"] = legacy["_id"] = _id
+    if file_path is not None:
+        reference["full_path"] = legacy["full_path"] = file_path
+    if _type is not None:
+        reference["type"] = legacy["type"] = _type
+    legacy["references"] = {"$exists": False}
+    return {"$or": [{"references": {"$elemMatch": reference}}, legacy]}
+
+
+class GridFSFileReader(io.RawIOBase):
+    """Seekable raw reader over a stored file which only fetches the chunks it reads
+
+    Note:
+        Chunks are fetched from fs.chunks directly in windows of prefetch_chunks starting at the chunk being read,
+        so seeking to and reading a slice of a large file transfers only the chunks covering it.
+
+    Args:
+        db (pymongo.database.Database): database holding the GridFS collections
+        file_document (Dict): the fs.files document of the file
+        prefetch_chunks (int, optional): chunks fetched per round trip. Defaults to 4.
+    """
+    def __init__(self, db, file_document: Dict, prefetch_chunks: int = 4) -> None:
+        super().__init__()
+        self._chunks = db["fs.chunks"]
+        self.file_id = file_document["_id"]
+        self.length = file_document["length"]
+        self.chunk_size = file_document["chunkSize"]
+        self.prefetch_chunks = max(1, prefetch_chunks)
+        self.chunks_fetched = 0
+        self._position = 0
+        self._window = {}
+    def readable(self) -> bool:
+        return True
+    def seekable(self) -> bool:
+        return True
+    def tell(self) -> int:
+        return self._position
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+    def readinto(self, buffer) -> int:
+        if self._position >= self.length:
+            return 0
+        chunk_number, offset = divmod(self._position, self.chunk_size)
+        data = self._chunk(chunk_number)
+        count = min(len(buffer), len(data) - offset)
+        buffer[:count] = data[offset:offset + count]
+        self._position += count
+        return count
+    def _chunk(self, chunk_number: int) -> bytes:
+        if chunk_number not in self._window:
+            last_chunk = (self.length - 1) // self.chunk_size
+            window_end = min(chunk_number + self.prefetch_chunks, last_chunk + 1)
+            chunks = self._chunks.find(
+                {"files_id": self.file_id, "n": {"$gte": chunk_number, "$lt": window_end}},
+                projection={"_id": 0, "n": 1, "data": 1},
+                sort=[("n", pymongo.ASCENDING)]
+            )
+            self._window = {chunk["n"]: bytes(chunk["data"]) for chunk in chunks}
+            self.chunks_fetched += len(self._window)
+            if chunk_number not in self._window:
+                raise gridfs.errors.CorruptGridFile(f"no chunk #{chunk_number} for file {self.file_id}")
+        return self._window[chunk_number]
+
+
+class ZstdFileReader(io.RawIOBase):
+    """Seekable raw reader decompressing a zstd stream, seeking backwards restarts decompression from the start
+
+    Args:
+        reader: seekable binary file object with the compressed content
+        length (int, optional): decompressed length, needed for seeking relative to the end. Defaults to None.
+    """
+    def __init__(self, reader, length: int = None) -> None:
+        super().__init__()
+        self._reader = reader
+        self.length = length
+        self._restart()
+    def _restart(self) -> None:
+        self._reader.seek(0)
+        self._stream = _import_zstandard().ZstdDecompressor().stream_reader(self._reader, closefd=False)
+        self._position = 0
+    def readable(self) -> bool:
+        return True
+    def seekable(self) -> bool:
+        return True
+    def tell(self) -> int:
+        return self._position
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END and self.length is not None:
+            position = self.length + offset
+        else:
+            raise io.UnsupportedOperation(f"Can't seek with whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        if position < self._position:
+            self._restart()
+        while self._position < position:
+            skipped = self._stream.read(min(position - self._position, 1024 * 1024))
+            if not skipped:
+                break
+            self._position += len(skipped)
+        return self._position
+    def readinto(self, buffer) -> int:
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+    def close(self) -> None:
+        self._reader.close()
+        super().close()
+
+
+def open_file(file_id, mode: str = "rb", prefetch_chunks: int = 4, encoding: str = "utf-8"):
+    """Opens a stored file for reading without downloading it
+
+    Note:
+        The returned file object is seekable and can be passed to parsers expecting a file, e.g.
+        common.get_group_from_file. Only the chunks covering what is read are transferred. Compressed files
+        are decompressed on the fly, they can still be seeked but reaching an offset means decompressing up to it.
+
+    Args:
+        file_id (ObjectId): GridFS id of the file
+        mode (str, optional): "rb" for bytes or "r" for text. Defaults to "rb".
+        prefetch_chunks (int, optional): chunks fetched per round trip. Defaults to 4.
+        encoding (str, optional): text encoding in "r" mode. Defaults to "utf-8".
+
+    Returns:
+        a readable, seekable file object
+
+    Raises:
+        gridfs.errors.NoFile: If the file isn't stored
+    """
+    if mode not in ("r", "rb"):
+        raise ValueError(f"mode: {mode} not one of r, rb")
+    connection = get_connection()
+    db = connection.get_database()
+    file_document = db["fs.files"].find_one({"_id": file_id})
+    if file_document is None:
+        raise gridfs.errors.NoFile(f"no file in gridfs with _id {file_id}")
+    raw = GridFSFileReader(db, file_document, prefetch_chunks)
+    reader = io.BufferedReader(raw, buffer_size=file_document["chunkSize"])
+    codec = file_document.get("codec")
+    if codec == "gzip":
+        reader = gzip.GzipFile(fileobj=reader, mode="rb")
+    elif codec == "zstd":
+        reader = io.BufferedReader(ZstdFileReader(reader, file_document.get("uncompressed_length")))
+    elif codec is not None:
+        raise ValueError(f"Unknown file codec: {codec}")
+    if mode == "r":
+        return io.TextIOWrapper(reader, encoding=encoding)
+    return reader
+
+
+def find_files(object_id, object_type: str = None) -> List:
+    """Finds the stored files of an object
+
+    Args:
+        object_id (ObjectId): id of the object owning the files, None for all objects of object_type
+        object_type (str, optional): only files owned by this object type. Defaults to None.
+
+    Returns:
+        List[gridfs.GridOut]: the stored files
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    fs = gridfs.GridFS(db)
+    return list(fs.find(_owner_query(object_id, _type=object_type)))
+
+
+FILE_LISTING_FIELDS = ("filename", "full_path", "length", "contentType", "sha256", "md5", "codec",
+                       "uncompressed_length", "uploadDate", "references")
+
+
+def list_files(object_ids: List, object_type: str = None, batch_size: int = 1000) -> Iterator[Dict]:
+    """Lists the stored files of many objects from their fs.files metadata
+
+    Note:
+        Unlike find_files no GridOut is built and fs.chunks is never queried, one query covers all
+        object_ids. A file shared by several of the listed objects (see save_file) is yielded once per owner.
+
+    Args:
+        object_ids (List[ObjectId]): ids of the objects owning the files
+        object_type (str, optional): only files owned by this object type. Defaults to None.
+        batch_size (int, optional): cursor batch size. Defaults to 1000.
+
+    Yields:
+        Dict: _id of the file, owner_id, owner_name, owner_type, full_path, filename, length, contentType,
+        sha256, md5, codec, uncompressed_length and uploadDate (None when not set on the file)
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return
+    connection = get_connection()
+    db = connection.get_database()
+    owners = set(object_ids)
+    projection = {field: 1 for field in FILE_LISTING_FIELDS + ("name", "type")}
+    cursor = db["fs.files"].find(_owner_query(object_ids, _type=object_type), projection=projection, batch_size=batch_size)
+    for file_document in cursor:
+        references = file_document.get("references")
+        if references is None:
+            # stored under the owner's _id, see migrate_file_layout
+            references = [{"_id": file_document["_id"], "name": file_document.get("name"),
+                           "type": file_document.get("type"), "full_path": file_document.get("full_path")}]
+        for reference in references:
+            if reference["_id"] not in owners or (object_type is not None and reference.get("type") != object_type):
+                continue
+            entry = {"_id": file_document["_id"], "owner_id": reference["_id"], "owner_name": reference.get("name"),
+                     "owner_type": reference.get("type")}
+            for field in FILE_LISTING_FIELDS:
+                if field != "references":
+                    entry[field] = file_document.get(field)
+            if reference.get("full_path") is not None:
+                # the owner's own path, the file's is that of the first owner
+                entry["full_path"] = reference["full_path"]
+                entry["filename"] = os.path.basename(reference["full_path"])
+            yield entry
+
+
+def migrate_file_layout(buffer_size: int = 1024 * 1024) -> int:
+    """Moves files stored under their owner's _id to their own file id with the owner as a reference
+
+    Note:
+        The sha256 of each file is computed from the stored content, files with content that is already
+        stored become a reference to that file. files entries on the owning objects are updated to the
+        new file id. Safe to rerun after an interruption.
+
+    Args:
+        buffer_size (int, optional): bytes read at a time when hashing. Defaults to 1 MiB.
+
+    Returns:
+        int: number of migrated files
+    """
     connection = get_connection()
     db = connection.get_database()
     fs = gridfs.GridFS(db)
-    return list(fs.find({"_id": object_id}))
+    ensure_file_indexes()
+    migrated = 0
+    for legacy in list(db["fs.files"].find({"references": {"$exists": False}})):
+        owner_id = legacy["_id"]
+        reference = {"_id": owner_id, "name": legacy.get("name"), "type": legacy.get("type"), "full_path": legacy.get("full_path")}
+        resumed = db["fs.files"].find_one({"migrated_from": owner_id}, projection={"_id": 1})
+        if resumed is not None:
+            file_id = resumed["_id"]
+        else:
+            checksum = hashlib.sha256()
+            decoded = open_decoded(fs.get(owner_id))
+            chunk = decoded.read(buffer_size)
+            while chunk:
+                checksum.update(chunk)
+                chunk = decoded.read(buffer_size)
+            sha256 = checksum.hexdigest()
+            stored = db["fs.files"].find_one({"sha256": sha256, "references": {"$elemMatch": reference}}, projection={"_id": 1})
+            file_id = stored["_id"] if stored is not None else _add_file_reference(db, sha256, reference)
+            if file_id is None:
+                migrated_file = {key: value for key, value in legacy.items() if key not in ("_id", "name", "type")}
+                migrated_file.update({"sha256": sha256, "references": [reference], "refcount": 1, "migrated_from": owner_id})
+                file_id = db["fs.files"].insert_one(migrated_file).inserted_id
+                resumed = {"_id": file_id}
+        if resumed is not None:
+            db["fs.chunks"].update_many({"files_id": owner_id}, {"$set": {"files_id": file_id}})
+            db["fs.files"].delete_one({"_id": owner_id})
+            db["fs.files"].update_one({"_id": file_id}, {"$unset": {"migrated_from": ""}})
+        else:
+            fs.delete(owner_id)  # content was already stored, only the reference is kept
+        if legacy.get("type"):
+            db[pluralize(legacy["type"])].update_one(
+                {"_id": owner_id, "files._id": owner_id},
+                {"$set": {"files.$._id": file_id}}
+            )
+        migrated += 1
+    return migrated
+
 
 def index_field(object_type: str, field: str, unique:bool=False) -> str:
     """Indexes a collection on a field
@@ -317,3 +1424,113 @@ def get_index(object_type: str) -> Dict:
     db = connection.get_database()
     collection_name = pluralize(object_type)
     return db[collection_name].index_information()
+
+
+METADATA_DATE_FIELDS = ["metadata.created_at", "metadata.updated_at"]
+
+
+def index_metadata_dates(object_type: str) -> List[str]:
+    """Indexes the metadata dates of a collection so they can be range queried
+
+    Note:
+        updated_at is indexed together with _id to match the sort order used by find_changed_since
+
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+
+    Returns:
+        List[str]: index names
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    collection_name = pluralize(object_type)
+    return [
+        db[collection_name].create_index([("metadata.created_at", pymongo.ASCENDING)]),
+        db[collection_name].create_index([("metadata.updated_at", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+    ]
+
+
+def migrate_metadata_dates(object_type: str) -> int:
+    """Converts metadata dates stored as strings into native dates
+
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+
+    Returns:
+        int: Number of modified fields
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    collection_name = pluralize(object_type)
+    modified = 0
+    for field in METADATA_DATE_FIELDS:
+        result = db[collection_name].update_many(
+            {field: {"$type": "string"}},
+            [{"$set": {field: {"$dateFromString": {"dateString": "$" + field}}}}]
+        )
+        modified += result.modified_count
+    return modified
+
+
+CHANGED_SINCE_OVERLAP = 60.0
+
+
+def _naive_utc(date: datetime.datetime) -> datetime.datetime:
+    # dates read through json_util are timezone aware, those read by pymongo are not
+    return date if date.tzinfo is None else date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def find_changed_since(object_type: str, watermark: Dict = None, batch_size: int = 1000, query: Dict = None, projection: Dict = None, overlap: float = CHANGED_SINCE_OVERLAP) -> Iterator[Tuple[Dict, Dict]]:
+    """Streams objects changed since a watermark, oldest change first
+
+    Note:
+        The watermark is a json dict of the updated_at and _id of the newest object seen, objects with the same
+        updated_at are ordered on _id. Store the last yielded watermark and pass it back in to resume.
+        updated_at is set from the clock of each writer, so an object can be saved after the watermark passed
+        its updated_at (a slow write or a clock behind). Resuming therefore goes back overlap seconds before
+        the watermark, yielding the objects changed in that window again: every change is yielded at least
+        once if it is saved within overlap seconds of its updated_at, and consumers should be idempotent e.g.
+        upsert on _id. overlap=0 yields each change once but can miss late writes. Objects with string dates
+        are not found, see migrate_metadata_dates.
+
+    Args:
+        object_type (str): A bifrost object type found in the database as a collection
+        watermark (Dict, optional): watermark as yielded by a previous call, None for all objects. Defaults to None.
+        batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+        query (Dict, optional): json formatted MongoDB filter restricting the objects. Defaults to None for all.
+        projection (Dict, optional): MongoDB projection, metadata.updated_at is added to inclusions. Defaults to None for the whole object.
+        overlap (float, optional): seconds before the watermark to look for late writes. Defaults to CHANGED_SINCE_OVERLAP (60).
+
+    Yields:
+        Tuple[Dict, Dict]: json formatted object and the watermark to resume after it, which never moves backwards
+    """
+    connection = get_connection()
+    db = connection.get_database()
+    collection_name = pluralize(object_type)
+    bson_watermark = None
+    if watermark is None:
+        changed = {"metadata.updated_at": {"$type": "date"}}
+    elif overlap:
+        bson_watermark = json_to_bson(watermark)
+        changed = {"metadata.updated_at": {"$gte": bson_watermark["updated_at"] - datetime.timedelta(seconds=overlap)}}
+    else:
+        bson_watermark = json_to_bson(watermark)
+        changed = {"$or": [
+            {"metadata.updated_at": {"$gt": bson_watermark["updated_at"]}},
+            {"metadata.updated_at": bson_watermark["updated_at"], "_id": {"$gt": bson_watermark["_id"]}}
+        ]}
+    if query:
+        changed = {"$and": [json_to_bson(query), changed]}
+    if projection is not None and any(projection.values()):
+        projection = dict(projection, **{"metadata.updated_at": 1})
+    cursor = db[collection_name].find(
+        changed,
+        projection=projection,
+        sort=[("metadata.updated_at", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+        batch_size=batch_size
+    )
+    for bson_object in cursor:
+        new_watermark = {"updated_at": bson_object["metadata"]["updated_at"], "_id": bson_object["_id"]}
+        if bson_watermark is not None and (_naive_utc(new_watermark["updated_at"]), new_watermark["_id"]) < (_naive_utc(bson_watermark["updated_at"]), bson_watermark["_id"]):
+            new_watermark = bson_watermark  # a change within the overlap
+        yield bson_to_json(bson_object), bson_to_json(new_watermark)
@@ -6,11 +6,12 @@ import os
 import json
 import jsmin
 import warlock
-import pandas
 import functools
+import itertools
 import datetime
 import math
-from typing import Any, List, Dict, Union
+from bson import ObjectId
+from typing import Any, Iterator, List, Dict, Tuple, Union
 
 
 global BIFROST_SCHEMA
@@ -27,8 +28,8 @@ def date_now() -> datetime.datetime:
         Current time rounded to miliseconds, converts the time to be usable in mongoDB
     """
     current_time = datetime.datetime.now(datetime.timezone.utc)
-    #Format used to match datetime format in bifrost.jsonc
-    current_time_in_json = {"$date": current_time.strftime('%Y-%m-%dT%H:%M:%S')}
+    #Format used to match datetime format in bifrost.jsonc, milliseconds are kept so updated_at can be used as a watermark
+    current_time_in_json = {"$date": current_time.strftime('%Y-%m-%dT%H:%M:%S') + f".{current_time.microsecond // 1000:03d}Z"}
     return current_time_in_json
 
 def has_a_database_connection() -> bool:
@@ -120,6 +121,413 @@ def get_schema_reference(reference_type: str, schema_version: str) -> Dict:
     return object_schema
 
 
+def get_schema_category_path(path: str, schema_version: str = "v2_1_0") -> Dict:
+    """Get the schema of a dotted path inside a category e.g. species_detection.summary.species
+
+    Note:
+        Parts of a category without properties in the schema (e.g. a report of type object) are free form, any path below them is accepted
+
+    Args:
+        path (str): dotted path starting with the category name
+        schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+
+    Returns:
+        Dict: The schema of the path, empty if the path is in a free form part of the category
+
+    Raises:
+        KeyError: If the path is not in the category schema
+    """
+    BIFROST_SCHEMA = load_schema()
+    keys = path.split(".")
+    category_schemas = BIFROST_SCHEMA.get("definitions", {}).get("objects", {}).get("category", {})
+    if keys[0] not in category_schemas or schema_version not in category_schemas[keys[0]]:
+        raise KeyError(f"category: {keys[0]} not in schema {schema_version}")
+    node = category_schemas[keys[0]][schema_version]
+    for key in keys[1:]:
+        if "$ref" in node:
+            node = functools.reduce(dict.get, node["$ref"].strip("#/").split("/"), BIFROST_SCHEMA) or {}
+        if node.get("type") == "array" and isinstance(node.get("items"), dict):
+            node = node["items"]  # dotted paths match into arrays of objects
+        properties = node.get("properties")
+        if not isinstance(properties, dict):
+            if node.get("type", "object") in ("object", "array"):
+                return {}
+            raise KeyError(f"path: {path} goes below the {node.get('type')} value at {key}")
+        if not isinstance(properties.get(key), dict):
+            raise KeyError(f"path: {path} not in category schema, {key} is not a property")
+        node = properties[key]
+    return node
+
+def get_category_query(filters: Dict[str, Any], schema_version: str = "v2_1_0") -> Dict:
+    """Turns category paths and values into a MongoDB filter on categories
+
+    Args:
+        filters (Dict[str, Any]): category path (e.g. species_detection.summary.species) to the value it should have. A list matches any of its values, a dict is used as a query operator e.g. {"$gte": 30}
+        schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+
+    Returns:
+        Dict: json formatted MongoDB filter
+
+    Raises:
+        KeyError: If a path is not in the category schema
+    """
+    query = {}
+    for path, value in filters.items():
+        get_schema_category_path(path, schema_version)
+        if isinstance(value, list):
+            value = {"$in": value}
+        query[f"categories.{path}"] = value
+    return query
+
+def _find_by_categories(object_class: type, filters: Dict[str, Any], schema_version: str, create_indexes: bool, batch_size: int) -> Iterator["BifrostObject"]:
+    query = get_category_query(filters, schema_version)
+    if create_indexes:
+        for field in query:
+            database_interface.index_field(object_class._object_type, field)
+    json_objects = database_interface.find(object_class._object_type, query, batch_size=batch_size)
+    return (object_class(schema_version=schema_version, value=json_object) for json_object in json_objects)
+
+
+def flatten_json(value: Any, prefix: str = "", sep: str = ".") -> Dict[str, Any]:
+    """Flattens nested dicts into a single dict keyed on the joined path, lists and other values are kept as is
+
+    Args:
+        value (Any): json value to flatten
+        prefix (str, optional): path of value. Defaults to "".
+        sep (str, optional): separator between keys in the path. Defaults to ".".
+
+    Returns:
+        Dict[str, Any]: path to leaf value
+    """
+    if not isinstance(value, dict) or not value:
+        return {prefix: value}
+    flat = {}
+    for key, sub_value in value.items():
+        flat.update(flatten_json(sub_value, f"{prefix}{sep}{key}" if prefix else key, sep))
+    return flat
+
+def _category_table(object_class: type, paths: List[str], query: Dict, batch_size: int, as_arrow: bool, schema_version: str) -> Union["pandas.DataFrame", Any]:
+    for path in paths:
+        get_schema_category_path(path, schema_version)
+    if as_arrow:
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("pyarrow is required for as_arrow, install bifrostlib[arrow]")
+    projection = {"name": 1}
+    projection.update({f"categories.{path}": 1 for path in paths})
+    columns = {"_id": [], "name": []}
+    rows = 0
+    for json_object in database_interface.find(object_class._object_type, query or {}, projection=projection, batch_size=batch_size):
+        values = {"_id": json_object["_id"]["$oid"], "name": json_object.get("name")}
+        values.update(flatten_json(json_object.get("categories", {})))
+        values.pop("", None)  # no categories on the object
+        for column, value in values.items():
+            if column not in columns:
+                columns[column] = [None] * rows
+            columns[column].append(value)
+        rows += 1
+        for column in columns:
+            if len(columns[column]) < rows:
+                columns[column].append(None)
+    if as_arrow:
+        return pyarrow.table(columns)
+    import pandas
+    return pandas.DataFrame(columns)
+
+OFFLOAD_POINTER_KEY = "__gridfs__"
+
+
+def get_offload_threshold() -> int:
+    """Get the size above which entries of offloaded fields are stored in GridFS
+
+    Other Parameters:
+        BIFROST_OFFLOAD_THRESHOLD: (ENV) size in bytes of the json of an entry, defaults to 1 MiB
+
+    Returns:
+        int: threshold in bytes
+    """
+    return int(os.getenv("BIFROST_OFFLOAD_THRESHOLD", 1024 * 1024))
+
+def is_offloaded(value: Any) -> bool:
+    """Checks if a value is a pointer to an entry offloaded to GridFS, {"__gridfs__": {"_id": {"$oid": ...}, "size": ...}}
+
+    Args:
+        value (Any): json value
+
+    Returns:
+        bool: True if value is a pointer
+    """
+    return isinstance(value, dict) and len(value) == 1 and OFFLOAD_POINTER_KEY in value
+
+def load_offloaded(pointer: Dict) -> Any:
+    """Loads the entry a pointer refers to from GridFS, see is_offloaded
+
+    Args:
+        pointer (Dict): json pointer to the entry
+
+    Returns:
+        Any: json value of the entry
+    """
+    file_id = database_interface.json_to_bson(pointer[OFFLOAD_POINTER_KEY]["_id"])
+    with database_interface.open_file(file_id, "r") as file_handle:
+        return json.loads(file_handle.read())
+
+REQUIREMENTS_CACHE: Dict[Tuple[str, str], Dict[str, Tuple]] = {}
+
+
+def flatten_requirements(requirements: Dict, path: Tuple[str, ...] = ()) -> Tuple[Tuple[Tuple[str, ...], Union[None, Tuple]], ...]:
+    """Flattens nested requirements into (path, expected) checks
+
+    Note:
+        An expected value of None means the key has to exist, a value or list of values means the value has
+        to be one of them. Empty dicts add no checks.
+
+    Args:
+        requirements (Dict): nested requirements e.g. {"properties": {"paired_reads": None}}
+        path (Tuple[str, ...], optional): path of requirements. Defaults to ().
+
+    Returns:
+        Tuple[Tuple[Tuple[str, ...], Union[None, Tuple]], ...]: path as a tuple of keys to the allowed values, None for any
+    """
+    checks = []
+    for key, value in requirements.items():
+        if isinstance(value, dict):
+            checks.extend(flatten_requirements(value, path + (key,)))
+        elif value is None:
+            checks.append((path + (key,), None))
+        elif isinstance(value, list):
+            checks.append((path + (key,), tuple(value)))
+        else:
+            checks.append((path + (key,), (value,)))
+    return tuple(checks)
+
+DEFAULT_COMPONENT_REQUIREMENTS = {"status": "Success"}
+
+
+def compile_requirements(requirements: Dict) -> Dict[str, Tuple]:
+    """Compiles the requirements of a component into checks, see Component.compiled_requirements
+
+    Note:
+        A required component without requirements of its own has to have succeeded on the sample
+        (DEFAULT_COMPONENT_REQUIREMENTS), as the scheduler orders components on Success of the required component
+
+    Args:
+        requirements (Dict): requirements of a component, {"sample": {...}, "component": [{"name": ..., "requirements": {...}}]}
+
+    Returns:
+        Dict[str, Tuple]: "sample" to the checks on the sample, "component" to (component name, checks on its samplecomponent) pairs
+    """
+    Requirements(value=requirements)  # To validate the object
+    return {
+        "sample": flatten_requirements(requirements.get("sample") or {}),
+        "component": tuple(
+            (entry["name"], flatten_requirements(entry.get("requirements") or DEFAULT_COMPONENT_REQUIREMENTS))
+            for entry in requirements.get("component") or []
+        ),
+    }
+
+def get_path_value(object_json: Dict, path: Tuple[str, ...]) -> Tuple[bool, Any]:
+    """Gets the value at a path of keys
+
+    Args:
+        object_json (Dict): json to look in
+        path (Tuple[str, ...]): keys to follow
+
+    Returns:
+        Tuple[bool, Any]: whether the path exists and its value, None if it doesn't
+    """
+    value = object_json
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return False, None
+        value = value[key]
+    return True, value
+
+TRACE_NONE = 0  # no output
+TRACE_FAILURES = 1  # a stderr line per failed requirement
+TRACE_ALL = 2  # a stderr line per requirement
+
+
+class RequirementCheck:
+    """Outcome of checking a single requirement
+
+    Args:
+        path (Tuple[str, ...]): keys to the value checked
+        expected (Union[None, Tuple]): allowed values, None if the key only has to exist
+        exists (bool): whether the path exists on the object
+        actual (Any): the value found, None if the path doesn't exist
+        component (str, optional): name of the required component whose samplecomponent was checked, None for sample requirements. Defaults to None.
+    """
+    def __init__(self, path: Tuple[str, ...], expected: Union[None, Tuple], exists: bool, actual: Any, component: str = None) -> None:
+        self.path = path
+        self.expected = expected
+        self.exists = exists
+        self.actual = actual
+        self.component = component
+        self.passed = exists and (expected is None or actual in expected)
+    def __repr__(self) -> str:
+        return f"RequirementCheck({self.json})"
+    @property
+    def reason(self) -> str:
+        """Why the check failed e.g. "categories.species_detection.summary.species: 'Salmonella enterica' not in ['Escherichia coli']", None if it passed
+        """
+        if self.passed:
+            return None
+        prefix = f"{self.component}: " if self.component is not None else ""
+        if not self.exists:
+            return f"{prefix}{'.'.join(self.path)}: missing"
+        return f"{prefix}{'.'.join(self.path)}: {self.actual!r} not in {list(self.expected)!r}"
+    @property
+    def json(self) -> Dict:
+        return {
+            "component": self.component,
+            "path": ".".join(self.path),
+            "expected": None if self.expected is None else list(self.expected),
+            "actual": self.actual,
+            "exists": self.exists,
+            "passed": self.passed,
+        }
+    def trace(self) -> None:
+        """Prints the check to stderr in the [true]/[fail] Requirement(...) format
+        """
+        value = self.actual if self.exists else "<Failed to retrieve>"
+        expected = "NA" if self.expected is None else list(self.expected)
+        print(f"[{'true' if self.passed else 'fail'}] Requirement(value:{value}, expected_value:{expected}, requirement{list(self.path)}", file=sys.stderr)
+
+
+class RequirementReport:
+    """Outcome of checking all requirements of a component on a sample
+
+    Args:
+        sample (str): name of the sample
+        checks (List[RequirementCheck]): checks made
+        found (bool, optional): False if the sample (or component) wasn't in the DB, the report then fails. Defaults to True.
+    """
+    def __init__(self, sample: str, checks: List[RequirementCheck], found: bool = True) -> None:
+        self.sample = sample
+        self.checks = checks
+        self.found = found
+    def __repr__(self) -> str:
+        return f"RequirementReport(sample={self.sample!r}, passed={self.passed}, reasons={self.reasons})"
+    def __bool__(self) -> bool:
+        return self.passed
+    @property
+    def passed(self) -> bool:
+        return self.found and all(i.passed for i in self.checks)
+    @property
+    def failures(self) -> List[RequirementCheck]:
+        return [i for i in self.checks if not i.passed]
+    @property
+    def reasons(self) -> List[str]:
+        """Reasons for the failed checks
+        """
+        if not self.found:
+            return ["sample: not found"]
+        return [i.reason for i in self.failures]
+    @property
+    def json(self) -> Dict:
+        return {"sample": self.sample, "found": self.found, "passed": self.passed, "checks": [i.json for i in self.checks]}
+
+
+def evaluate_requirements(object_json: Dict, checks: Tuple, component: str = None, trace: int = TRACE_NONE) -> List[RequirementCheck]:
+    """Evaluates compiled checks on an object
+
+    Args:
+        object_json (Dict): The object being checked on
+        checks (Tuple): (path, expected) checks from flatten_requirements
+        component (str, optional): name of the required component when object_json is its samplecomponent. Defaults to None.
+        trace (int, optional): TRACE_NONE, TRACE_FAILURES or TRACE_ALL. Defaults to TRACE_NONE.
+
+    Returns:
+        List[RequirementCheck]: a check per requirement
+    """
+    results = []
+    for path, expected in checks:
+        exists, value = get_path_value(object_json, path)
+        check = RequirementCheck(path, expected, exists, value, component)
+        if trace == TRACE_ALL or (trace == TRACE_FAILURES and not check.passed):
+            check.trace()
+        results.append(check)
+    return results
+
+def count_failures(reports: List[RequirementReport]) -> Dict[str, int]:
+    """Counts the failed requirements over many reports, e.g. from Component.check_requirements
+
+    Args:
+        reports (List[RequirementReport]): reports to aggregate
+
+    Returns:
+        Dict[str, int]: path of the requirement (prefixed with the required component name) to the number of samples failing it, most common first
+    """
+    counts = {}
+    for report in reports:
+        if not report.found:
+            counts["sample"] = counts.get("sample", 0) + 1
+        for check in report.failures:
+            key = ".".join(check.path) if check.component is None else f"{check.component}: {'.'.join(check.path)}"
+            counts[key] = counts.get(key, 0) + 1
+    return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+def requirements_query(checks: Tuple) -> Dict[str, Dict]:
+    """Translates compiled checks into a MongoDB filter
+
+    Note:
+        A key that has to exist becomes $exists and allowed values become $in on the dotted path. As usual in
+        MongoDB a path through an array, or an array value containing an allowed value, also matches.
+
+    Args:
+        checks (Tuple): (path, expected) checks from flatten_requirements
+
+    Returns:
+        Dict[str, Dict]: json formatted MongoDB filter
+    """
+    return {
+        ".".join(path): {"$exists": True} if expected is None else {"$in": list(expected)}
+        for path, expected in checks
+    }
+
+def requirements_projection(checks: Tuple, offload_fields: Tuple[str, ...] = ()) -> Dict[str, int]:
+    """MongoDB projection of the paths compiled checks look at
+
+    Note:
+        A path into an entry of offload_fields projects the entry's pointer as well, as an offloaded entry
+        is only a pointer in the document, see resolve_offloaded_checks
+
+    Args:
+        checks (Tuple): (path, expected) checks from flatten_requirements
+        offload_fields (Tuple[str, ...], optional): _offload_fields of the object checked. Defaults to ().
+
+    Returns:
+        Dict[str, int]: projection on the dotted paths, without paths inside another projected path
+    """
+    paths = set(".".join(path) for path, expected in checks)
+    paths.update(f"{path[0]}.{path[1]}.{OFFLOAD_POINTER_KEY}" for path, expected in checks if len(path) > 2 and path[0] in offload_fields)
+    projection = {}
+    for path in sorted(paths):
+        if not any(path.startswith(f"{i}.") for i in projection):
+            projection[path] = 1
+    return projection
+
+def resolve_offloaded_checks(object_json: Dict, checks: Tuple, offload_fields: Tuple[str, ...]) -> Dict:
+    """Loads the offloaded entries compiled checks look into from GridFS, in place
+
+    Args:
+        object_json (Dict): json of the object, loaded with requirements_projection
+        checks (Tuple): (path, expected) checks from flatten_requirements
+        offload_fields (Tuple[str, ...]): _offload_fields of the object
+
+    Returns:
+        Dict: object_json
+    """
+    for path, expected in checks:
+        if len(path) > 2 and path[0] in offload_fields:
+            entries = object_json.get(path[0])
+            if isinstance(entries, dict) and is_offloaded(entries.get(path[1])):
+                entries[path[1]] = load_offloaded(entries[path[1]])
+    return object_json
+
+
 class BifrostObjectDataType(Dict):
     """For schema datatypes
 
@@ -271,7 +679,6 @@ class Requirements(BifrostObjectDataType):
         Args:
             value (Dict, optional): Base values for metadata. Defaults to None. Metadata is currently composed of a created_at and updated_at datetime. Sets times to when object is created.
         """
-        self._data_type: str="metadata" 
         if value is None:
             value = {}
         BifrostObjectDataType.__init__(self, value)
@@ -354,6 +761,17 @@ class BifrostObjectReference(Dict):
         """
         return self._reference_type
 
+def client_side_ids() -> bool:
+    """Checks if objects get their _id on construction instead of when first saved
+
+    Other Parameters:
+        BIFROST_CLIENT_IDS: (ENV) "1" or "true" to generate ids on construction, off by default
+
+    Returns:
+        bool: True if ids are generated on construction
+    """
+    return os.getenv("BIFROST_CLIENT_IDS", "").lower() in ("1", "true", "yes")
+
 class BifrostObject(Dict):
     """Base object for bifrost objects. Id's are not required for creation.
 
@@ -361,6 +779,10 @@ class BifrostObject(Dict):
         Dict: Extended off a base dict type to allow easier retrieval and setting of json items.
     """
     _object_type: str = None # to be set in inherited classes to match the inherited type
+    _offload_fields: Tuple[str, ...] = () # fields whose large entries are stored in GridFS on save, see save
+    offload_threshold: int = None # json size in bytes above which an entry is offloaded, None for get_offload_threshold()
+    _lazy_fields: Tuple[str, ...] = () # fields left out on load and fetched per key on access, see load
+    client_ids: bool = None # generate the _id on construction (see assign_id), None for client_side_ids()
     def __init__(self, schema_version: str, value: Dict = {}):
         """Initialization
 
@@ -376,6 +798,13 @@ class BifrostObject(Dict):
             self._json["metadata"] = Metadata().json
         if "version" not in self._json:
             self._json["version"] = Version(schema_version=self.schema_version).json
+        if (self.client_ids if self.client_ids is not None else client_side_ids()) and "_id" not in self._json:
+            self.assign_id()
+        self._offloaded = self._offload_pointers(self._json)
+        self._resolved: Dict[Tuple[str, str], Tuple[Dict, Any]] = {}  # offloaded entry to its pointer and stored value
+        self._partial: Dict[str, set] = {}  # lazy field to the keys fetched so far, for fields not fully loaded
+        self._dirty: Dict[str, set] = {}  # lazy field to the keys changed by set_category
+        self._categories: Dict[str, Category] = {}
     def __repr__(self) -> str:
         """Returns the validated json as a string
 
@@ -386,12 +815,20 @@ class BifrostObject(Dict):
     def __getitem__(self, key: str) -> Any:
         """Get item
 
+        Note:
+            Lazy fields are fetched and offloaded entries of the field are loaded from GridFS on first access
+
         Args:
             key (str): json key
 
         Returns:
             Any: associated key value
         """
+        if key in self._lazy_fields:
+            self._fetch_lazy(key)
+            self._categories.clear()  # the returned value can be changed in place
+        if key in self._offload_fields:
+            self._resolve_offloaded(key)
         return self._json[key]
     def __setitem__(self, key:str , value: Any) -> None:
         """Set item
@@ -412,9 +849,16 @@ class BifrostObject(Dict):
     def json(self) -> Dict:
         """Get the json as a dict
 
+        Note:
+            Lazy fields are fetched and offloaded entries are loaded from GridFS
+
         Returns:
             Dict: copy of the json contents
         """
+        for field in list(self._partial):
+            self._fetch_lazy(field)
+        for field in self._offload_fields:
+            self._resolve_offloaded(field)
         return self._json.copy()
     @json.setter
     def json(self, value: Dict) -> None:
@@ -424,6 +868,9 @@ class BifrostObject(Dict):
             Dict: copy of the json contents
         """
         self._json = self._model(value)
+        self._partial.clear()
+        self._dirty.clear()
+        self._categories.clear()
     def update_json(self, value: Dict) -> None:
         """Attempts to update the json to add dict entries
 
@@ -431,23 +878,280 @@ class BifrostObject(Dict):
             Dict: copy of the json contents
         """
         self._json.update(value)
+        for field in value:
+            self._partial.pop(field, None)
+            self._dirty.pop(field, None)
+        self._categories.clear()
     @classmethod
-    def load(cls, reference: BifrostObjectReference):
-        json_object: Dict = database_interface.load(cls._object_type, reference.json)
+    def load(cls, reference: BifrostObjectReference, lazy: bool = False):
+        """Load an object from the DB
+
+        Note:
+            With lazy the _lazy_fields (categories on Sample and SampleComponent) are left out of the query. A
+            category is fetched on its own the first time get_category asks for it, and the whole field when it is
+            accessed directly or through json. Saving the object then only writes the categories set with set_category.
+            Each fetch is another round trip and reads the document as it is then, so the object can mix versions
+            of a document changed in between; use it for large objects of which only a few categories are read.
+
+        Args:
+            reference (BifrostObjectReference): reference to the object, _id is preferred over name
+            lazy (bool, optional): leave the lazy fields out until they are accessed. Defaults to False.
+
+        Returns:
+            BifrostObject: The loaded object, None if not in the DB
+        """
+        lazy_fields = cls._lazy_fields if lazy else ()
+        projection = {field: 0 for field in lazy_fields} or None
+        json_object: Dict = database_interface.load(cls._object_type, reference.json, projection)
         if "_id" not in json_object:
             return None
-        return cls(schema_version=reference.schema_version, value=json_object)
+        json_object.update({field: {} for field in lazy_fields})
+        bifrost_object = cls(schema_version=reference.schema_version, value=json_object)
+        for field in lazy_fields:
+            bifrost_object._partial[field] = set()
+        return bifrost_object
+    def _fetch_lazy(self, field: str, key: str = None) -> None:
+        """Fetches a lazy field, or a single key of it, which wasn't loaded yet
+        """
+        if field not in self._partial or (key is not None and key in self._partial[field]):
+            return
+        path = field if key is None else f"{field}.{key}"
+        json_object = database_interface.load_fields(self._object_type, database_interface.json_to_bson(self._json["_id"]), [path])
+        if key is None:
+            values = json_object.get(field)
+            if values is None and not self._json[field]:
+                del self._json[field]  # not on the object
+            else:
+                values = values or {}
+                values.update(self._json[field])  # keys already fetched may have been changed
+                self._json[field] = values
+            del self._partial[field]
+        else:
+            values = json_object.get(field, {})
+            if key in values:
+                self._json[field][key] = values[key]
+            self._partial[field].add(key)
+        self._offloaded.update(self._offload_pointers({field: values or {}}))
+    @classmethod
+    def changed_since(cls, watermark: Dict = None, schema_version: str = "v2_1_0", batch_size: int = 1000, overlap: float = database_interface.CHANGED_SINCE_OVERLAP) -> Iterator[Tuple["BifrostObject", Dict]]:
+        """Streams the objects of this type changed since a watermark, for incremental exports
+
+        Note:
+            Objects changed within overlap seconds before the watermark are yielded again so late writes aren't
+            lost, see database_interface.find_changed_since. Exports should upsert on _id.
+
+        Args:
+            watermark (Dict, optional): watermark yielded by a previous export, None to export everything. Defaults to None.
+            schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+            overlap (float, optional): seconds before the watermark to look for late writes. Defaults to 60.
 
+        Yields:
+            Tuple[BifrostObject, Dict]: the object and the new watermark to resume after it
+        """
+        for json_object, new_watermark in database_interface.find_changed_since(cls._object_type, watermark, batch_size, overlap=overlap):
+            yield cls(schema_version=schema_version, value=json_object), new_watermark
+
+    def assign_id(self) -> BifrostObjectReference:
+        """Generates the _id client side if the object has none yet
+
+        Note:
+            ObjectIds are unique without asking the DB, so references to objects can be made before they are
+            saved and a graph of objects saved in one go (see Run.save_graph). Saving an object with a
+            generated _id inserts it. Set BIFROST_CLIENT_IDS to do this on construction.
+
+        Returns:
+            BifrostObjectReference: Reference to the object
+        """
+        if self._json.get("_id") is None:
+            self._json["_id"] = {"$oid": str(ObjectId())}
+        return self.to_reference()
     def save(self) -> None:
         """Save the object to the DB
 
         Note:
-            This updates the metadate update_at section
-        """
-        metadata = Metadata(value=self.json["metadata"])
+            This updates the metadate update_at section. Entries of the _offload_fields (e.g. a single result
+            under results) whose json is larger than offload_threshold are stored in GridFS and replaced by a
+            pointer in the document, see is_offloaded. They stay loaded on this object, and are fetched back on
+            access when the object is loaded from the DB. Entries unchanged since they were loaded or saved keep
+            their pointer without being serialised again. Server side queries only see the pointer, so fields that
+            are queried (categories) are never offloaded.
+            For lazy fields which weren't fetched entirely (see load) only the keys set with set_category are written.
+        """
+        saved = database_interface.save(self._object_type, self._document_to_save())
+        self._set_saved(saved)
+    def _document_to_save(self) -> Dict:
+        """Updates the metadata and returns the document for saving, see save
+        """
+        metadata = Metadata(value=self._json["metadata"])
         metadata.updated_now()
         self._json["metadata"] = metadata.json
-        self._json = self._model(database_interface.save(self._object_type, self.json))
+        document = self._offload()
+        for field in self._partial:
+            values = document.pop(field)
+            for key in self._dirty.get(field, ()):
+                document[f"{field}.{key}"] = values[key]
+        return document
+    def _set_saved(self, saved: Dict) -> None:
+        """Takes the saved document of _document_to_save as the json, keeping what's only loaded on this object
+        """
+        for field in self._partial:
+            for key in self._dirty.get(field, ()):
+                del saved[f"{field}.{key}"]
+        for field in set(self._offload_fields) | set(self._partial):
+            if field in self._json:
+                saved[field] = self._json[field]
+        self._json = self._model(saved)
+        self._dirty.clear()
+    def update_fields(self, fields: Dict[str, Any], buffered: bool = False) -> None:
+        """Sets fields by (dotted) path and saves only those, e.g. status or progress of a running component
+
+        Note:
+            The fields and metadata.updated_at are written with a partial update instead of the whole document.
+            With buffered the update is queued on database_interface.get_write_buffer(), where repeated updates to
+            the object are merged and written together later (see WriteBehindBuffer), otherwise it is written now.
+            The object has to be saved before. A path into an offloaded entry stores the whole entry in GridFS
+            again and writes its new pointer, as the DB only has the pointer, and a whole entry of the
+            _offload_fields (e.g. results.<key>) is offloaded or stored inline by its size as on save.
+
+        Args:
+            fields (Dict[str, Any]): json formatted field paths to values, e.g. {"status": "Running"}
+            buffered (bool, optional): write behind through the shared write buffer. Defaults to False.
+
+        Raises:
+            ValueError: If the object has no _id
+        """
+        if self._json.get("_id") is None:
+            raise ValueError(f"{self._object_type} has to be saved before updating fields")
+        metadata = Metadata(value=self._json["metadata"])
+        metadata.updated_now()
+        fields = dict(fields)
+        fields["metadata.updated_at"] = metadata.json["updated_at"]
+        writes = {}
+        offloaded = set()  # entries changed in part
+        entries = set()  # entries set as a whole
+        for path, value in fields.items():
+            keys = path.split(".")
+            if len(keys) > 2:
+                # changing part of an entry, which needs to be loaded
+                if keys[0] in self._lazy_fields:
+                    self._fetch_lazy(keys[0], keys[1])
+                if keys[0] in self._offload_fields:
+                    self._resolve_offloaded(keys[0], keys[1])
+            if keys[0] in self._partial:
+                if len(keys) == 1:
+                    del self._partial[keys[0]]
+                    self._dirty.pop(keys[0], None)
+                else:
+                    self._partial[keys[0]].add(keys[1])
+            parent = self._json
+            for key in keys[:-1]:
+                if not isinstance(parent.get(key), dict):
+                    parent[key] = {}
+                parent = parent[key]
+            parent[keys[-1]] = value
+            if len(keys) > 2 and (keys[0], keys[1]) in self._offloaded:
+                offloaded.add((keys[0], keys[1]))
+            elif len(keys) == 2 and keys[0] in self._offload_fields:
+                entries.add((keys[0], keys[1]))
+            else:
+                writes[path] = value
+        for field, key in offloaded:
+            value = self._json[field][key]
+            self._offloaded[(field, key)] = writes[f"{field}.{key}"] = self._store_offloaded(field, key, value, json.dumps(value))
+        threshold = self.offload_threshold if self.offload_threshold is not None else get_offload_threshold()
+        for field, key in entries:
+            value = self._json[field][key]
+            text = json.dumps(value)
+            if len(text) > threshold:
+                self._offloaded[(field, key)] = writes[f"{field}.{key}"] = self._store_offloaded(field, key, value, text)
+                continue
+            pointer = self._offloaded.pop((field, key), None)
+            if pointer is not None:
+                database_interface.release_file(database_interface.json_to_bson(pointer[OFFLOAD_POINTER_KEY]["_id"]), database_interface.json_to_bson(self._json["_id"]), f"{field}/{key}.json")
+                self._resolved.pop((field, key), None)
+            writes[f"{field}.{key}"] = value
+        self._categories.clear()
+        _id = database_interface.json_to_bson(self._json["_id"])
+        if buffered:
+            database_interface.get_write_buffer().update(self._object_type, _id, writes)
+        else:
+            database_interface.update_fields(self._object_type, _id, writes)
+    def _get_category(self, key: str) -> "Category":
+        self._fetch_lazy("categories", key)
+        if key not in self._categories:
+            try:
+                self._categories[key] = Category(value=self._json["categories"][key])
+            except KeyError:
+                return None
+        return self._categories[key]
+    def _set_category(self, category: "Category") -> None:
+        self._json.setdefault("categories", {})[category["name"]] = category.json
+        self._categories.pop(category["name"], None)
+        if "categories" in self._partial:
+            self._partial["categories"].add(category["name"])
+            self._dirty.setdefault("categories", set()).add(category["name"])
+    def _offload_pointers(self, json_object: Dict) -> Dict[Tuple[str, str], Dict]:
+        pointers = {}
+        for field in self._offload_fields:
+            entries = json_object.get(field)
+            if isinstance(entries, dict):
+                pointers.update({(field, key): value for key, value in entries.items() if is_offloaded(value)})
+        return pointers
+    def _resolve_offloaded(self, field: str, key: str = None) -> None:
+        entries = self._json.get(field)
+        if not isinstance(entries, dict):
+            return
+        for entry_key in (list(entries) if key is None else [key]):
+            value = entries.get(entry_key)
+            if is_offloaded(value):
+                file_id = database_interface.json_to_bson(value[OFFLOAD_POINTER_KEY]["_id"])
+                with database_interface.open_file(file_id, "r") as file_handle:
+                    text = file_handle.read()
+                entries[entry_key] = json.loads(text)
+                self._resolved[(field, entry_key)] = (value, json.loads(text))
+    def _store_offloaded(self, field: str, key: str, value: Any, text: str) -> Dict:
+        """Stores an entry in GridFS, replacing the file stored for it before, and returns its pointer
+        """
+        file_id = database_interface.save_json_file(
+            database_interface.json_to_bson(self._json["_id"]), self._json.get("name"), self._object_type, f"{field}/{key}.json", value)
+        pointer = {OFFLOAD_POINTER_KEY: {"_id": database_interface.bson_to_json(file_id), "size": len(text)}}
+        self._resolved[(field, key)] = (pointer, json.loads(text))
+        return pointer
+    def _offload(self) -> Dict:
+        """Returns the document to save with large entries replaced by pointers to GridFS
+        """
+        document = self._json.copy()
+        if not self._offload_fields:
+            return document
+        threshold = self.offload_threshold if self.offload_threshold is not None else get_offload_threshold()
+        for field in self._offload_fields:
+            if isinstance(document.get(field), dict):
+                document[field] = dict(document[field])
+                for key, value in document[field].items():
+                    if is_offloaded(value):
+                        continue
+                    resolved = self._resolved.get((field, key))
+                    if resolved is not None and resolved[1] == value:
+                        # unchanged since loaded or saved, skips serialising and hashing it
+                        document[field][key] = resolved[0]
+                        continue
+                    text = json.dumps(value)
+                    size = len(text)
+                    if size <= threshold:
+                        continue
+                    if "_id" not in document:
+                        self.assign_id()
+                        document["_id"] = self._json["_id"]
+                    document[field][key] = self._store_offloaded(field, key, value, text)
+        offloaded = self._offload_pointers(document)
+        for (field, key), pointer in self._offloaded.items():
+            if (field, key) not in offloaded:
+                # stored inline again or removed
+                database_interface.release_file(database_interface.json_to_bson(pointer[OFFLOAD_POINTER_KEY]["_id"]), database_interface.json_to_bson(self._json["_id"]), f"{field}/{key}.json")
+        self._offloaded = offloaded
+        self._resolved = {i: j for i, j in self._resolved.items() if i in offloaded}
+        return document
     def delete(self) -> bool:
         """Delete the object from the DB
 
@@ -479,6 +1183,7 @@ class Category(BifrostObject):
         BifrostObject: Inherited data type
     """
     _object_type: str = "category"
+    client_ids: bool = False # stored in samples and samplecomponents, not a document of its own
     
     def __init__(self, schema_version = "v2_1_0", value: Dict = None, name: str = None):
         """Initialization
@@ -535,6 +1240,158 @@ class Component(BifrostObject):  # Alternative name is pipeline
             if name is not None:
                 value['name'] = name
         BifrostObject.__init__(self, schema_version, value)
+    def compiled_requirements(self) -> Dict[str, Tuple]:
+        """The requirements of the component compiled into checks, see compile_requirements
+
+        Note:
+            The compiled form is cached per component _id and version (in REQUIREMENTS_CACHE) and shared, don't modify it
+
+        Returns:
+            Dict[str, Tuple]: "sample" to (path, expected) checks on the sample, "component" to (component name, checks on its samplecomponent) pairs
+        """
+        key = None
+        if "_id" in self._json:
+            key = (self._json["_id"]["$oid"], json.dumps(self._json.get("version"), sort_keys=True))
+            if key in REQUIREMENTS_CACHE:
+                return REQUIREMENTS_CACHE[key]
+        compiled = compile_requirements(self._json.get("requirements") or {})
+        if key is not None:
+            REQUIREMENTS_CACHE[key] = compiled
+        return compiled
+    def check_requirements(self, samples: List["SampleReference"], batch_size: int = 1000, trace: int = TRACE_NONE) -> Dict[str, RequirementReport]:
+        """Evaluates the requirements of the component on many samples at once
+
+        Note:
+            The samples, and the samplecomponents of the components required, are each fetched with one $in query
+            projected on the paths the requirements look at, and evaluated in memory without any output by default.
+            Offloaded results the requirements look into are loaded from GridFS, see resolve_offloaded_checks.
+
+        Args:
+            samples (List[SampleReference]): samples to check, by _id or name
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+            trace (int, optional): TRACE_NONE, TRACE_FAILURES or TRACE_ALL. Defaults to TRACE_NONE.
+
+        Returns:
+            Dict[str, RequirementReport]: sample name (its _id if it has none) to its report, see count_failures to aggregate them
+        """
+        requirements = self.compiled_requirements()
+        sample_ids = [i.json["_id"] for i in samples if i.json.get("_id") is not None]
+        sample_names = [i["name"] for i in samples if i.json.get("_id") is None and i["name"]]
+        projection = {"name": 1}
+        projection.update(requirements_projection(requirements["sample"]))
+        query = {"$or": [{"_id": {"$in": sample_ids}}, {"name": {"$in": sample_names}}]}
+        by_id = {}
+        by_name = {}
+        for sample_json in database_interface.find("sample", query, projection=projection, batch_size=batch_size):
+            by_id[sample_json["_id"]["$oid"]] = sample_json
+            if sample_json.get("name") is not None:
+                by_name[sample_json["name"]] = sample_json
+        found = {i["name"] for i in by_id.values() if i.get("name") is not None}
+
+        samplecomponent_jsons = {}
+        if requirements["component"] and found:
+            # named as in SampleComponentReference.name_generator
+            names = [f"{sample_name}___{component_name}" for sample_name in found for component_name, checks in requirements["component"]]
+            component_checks = tuple(check for component_name, checks in requirements["component"] for check in checks)
+            projection = {"name": 1}
+            projection.update(requirements_projection(component_checks, SampleComponent._offload_fields))
+            for samplecomponent_json in database_interface.find("sample_component", {"name": {"$in": names}}, projection=projection, batch_size=batch_size):
+                samplecomponent_jsons[samplecomponent_json["name"]] = resolve_offloaded_checks(samplecomponent_json, component_checks, SampleComponent._offload_fields)
+
+        results = {}
+        for sample in samples:
+            _id = sample.json.get("_id", {}).get("$oid")
+            sample_json = by_id.get(_id) if _id is not None else by_name.get(sample["name"])
+            if sample_json is None:
+                results[sample["name"] or _id] = RequirementReport(sample["name"] or _id, [], found=False)
+                continue
+            name = sample_json.get("name") or sample_json["_id"]["$oid"]
+            report = evaluate_requirements(sample_json, requirements["sample"], trace=trace)
+            for component_name, checks in requirements["component"]:
+                samplecomponent_json = samplecomponent_jsons.get(f"{sample_json.get('name')}___{component_name}", {})
+                report.extend(evaluate_requirements(samplecomponent_json, checks, component_name, trace))
+            results[name] = RequirementReport(name, report)
+        return results
+    def requirements_pipeline(self, query: Dict = None) -> List[Dict]:
+        """Aggregation pipeline on samples returning those meeting the requirements of the component
+
+        Note:
+            Sample requirements are a $match (see requirements_query), each component requirement is a $lookup of
+            the sample's samplecomponent of that component (by name, as in SampleComponentReference.name_generator)
+            which has to meet its requirements. Results may be offloaded to GridFS, where the DB only has a pointer
+            (see is_offloaded), so requirements on results can't be evaluated by the DB.
+
+        Args:
+            query (Dict, optional): json formatted MongoDB filter on the samples to consider e.g. the _ids of a run. Defaults to None for all.
+
+        Returns:
+            List[Dict]: json formatted pipeline for database_interface.aggregate("sample", ...)
+
+        Raises:
+            ValueError: If a component requirement is on results, see find_ready_samples
+        """
+        requirements = self.compiled_requirements()
+        if self._requires_offloaded():
+            raise ValueError(f"requirements of {self._json.get('name')} on results can't be evaluated by the DB")
+        match = dict(query or {})
+        match.update(requirements_query(requirements["sample"]))
+        pipeline = [{"$match": match}]
+        lookups = []
+        for i, (component_name, checks) in enumerate(requirements["component"]):
+            lookup = f"_requirement_{i}"
+            lookup_match = {"$expr": {"$eq": ["$name", {"$concat": ["$$sample_name", f"___{component_name}"]}]}}
+            lookup_match.update(requirements_query(checks))
+            pipeline.append({"$lookup": {
+                "from": database_interface.pluralize("sample_component"),
+                "let": {"sample_name": "$name"},
+                "pipeline": [{"$match": lookup_match}, {"$limit": 1}, {"$project": {"_id": 1}}],
+                "as": lookup
+            }})
+            pipeline.append({"$match": {lookup: {"$ne": []}}})
+            lookups.append(lookup)
+        if lookups:
+            pipeline.append({"$project": {lookup: 0 for lookup in lookups}})
+        return pipeline
+    def find_ready_samples(self, query: Dict = None, schema_version: str = "v2_1_0", create_indexes: bool = False, batch_size: int = 1000) -> Iterator["Sample"]:
+        """Streams the samples meeting the requirements of the component, evaluated by the DB
+
+        Args:
+            query (Dict, optional): json formatted MongoDB filter on the samples to consider e.g. the _ids of a run. Defaults to None for all.
+            schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+            create_indexes (bool, optional): Index the sample paths checked, and samplecomponent names, before querying. Defaults to False.
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+
+        Note:
+            When a component requirement is on results, which may be offloaded (see requirements_pipeline), the DB
+            only filters the samples on their own requirements and the rest are checked with check_requirements,
+            a batch of batch_size samples at a time.
+
+        Yields:
+            Sample: samples meeting the requirements
+        """
+        requirements = self.compiled_requirements()
+        if create_indexes:
+            for field in requirements_query(requirements["sample"]):
+                database_interface.index_field("sample", field)
+            database_interface.index_field("sample_component", "name")
+        if not self._requires_offloaded():
+            json_objects = database_interface.aggregate("sample", self.requirements_pipeline(query), batch_size=batch_size)
+            return (Sample(schema_version=schema_version, value=json_object) for json_object in json_objects)
+        match = dict(query or {})
+        match.update(requirements_query(requirements["sample"]))
+        return self._check_ready_samples(database_interface.find("sample", match, batch_size=batch_size), schema_version, batch_size)
+    def _requires_offloaded(self) -> bool:
+        return any(path[0] in SampleComponent._offload_fields
+                   for component_name, checks in self.compiled_requirements()["component"] for path, expected in checks)
+    def _check_ready_samples(self, json_objects: Iterator[Dict], schema_version: str, batch_size: int) -> Iterator["Sample"]:
+        json_objects = iter(json_objects)
+        batch = list(itertools.islice(json_objects, batch_size))
+        while batch:
+            reports = self.check_requirements([SampleReference(_id=i["_id"]["$oid"]) for i in batch], batch_size)
+            for sample_json in batch:
+                if reports[sample_json.get("name") or sample_json["_id"]["$oid"]].passed:
+                    yield Sample(schema_version=schema_version, value=sample_json)
+            batch = list(itertools.islice(json_objects, batch_size))
 
 
 class SampleReference(BifrostObjectReference):
@@ -563,6 +1420,7 @@ class Sample(BifrostObject): # Alternative name is genomicsample
         BifrostObject: Inherited data type
     """
     _object_type: str = "sample"
+    _lazy_fields: Tuple[str, ...] = ("categories",)
 
     def __init__(self, schema_version:str = "v2_1_0", value: Dict = None, name: str = None) -> None:
         """Initialization
@@ -617,28 +1475,76 @@ class Sample(BifrostObject): # Alternative name is genomicsample
     def get_category(self, key: str) -> Category:
         """get the category based on provided key
 
+        Note:
+            The category is fetched on its own when the object was loaded lazily, and validated once on first access
+
         Args:
             key (str): category you want to get the value of
 
         Returns:
             Category: A category object of the associated key, None if not found
         """
-        try:
-            return Category(value=self._json["categories"][key])
-        except KeyError:
-            return None
+        return self._get_category(key)
     def set_category(self, category: Category):
         """set the category based on a provided Category
 
         Args:
             category (Category): The category you want to set for the sample
         """
-        for name in category.json:
-            self._json["categories"][category["name"]] = category.json
+        self._set_category(category)
+    @classmethod
+    def find_by_categories(cls, filters: Dict[str, Any], schema_version: str = "v2_1_0", create_indexes: bool = False, batch_size: int = 1000) -> Iterator["Sample"]:
+        """Streams the samples whose categories match the filters, filtered in the DB
+
+        Args:
+            filters (Dict[str, Any]): category path (e.g. species_detection.summary.species) to the value it should have, see get_category_query
+            schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+            create_indexes (bool, optional): Index the filtered paths before querying. Defaults to False.
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+
+        Yields:
+            Sample: matching samples
+        """
+        return _find_by_categories(cls, filters, schema_version, create_indexes, batch_size)
+    @classmethod
+    def category_table(cls, paths: List[str], query: Dict = None, batch_size: int = 1000, as_arrow: bool = False, schema_version: str = "v2_1_0") -> Union["pandas.DataFrame", Any]:
+        """Get category values of many samples as a table, only the requested paths are fetched from the DB
+
+        Args:
+            paths (List[str]): category paths to include e.g. ["mapping_qc"] or ["species_detection.summary.species"], nested values get a column each
+            query (Dict, optional): json formatted MongoDB filter on the samples e.g. from get_category_query. Defaults to None for all.
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+            as_arrow (bool, optional): return a pyarrow.Table instead of a pandas.DataFrame. Defaults to False.
+            schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+
+        Returns:
+            Union[pandas.DataFrame, pyarrow.Table]: a row per sample with _id, name and a column per category path e.g. mapping_qc.summary.mapped.reads_mapped
+
+        Raises:
+            KeyError: If a path is not in the category schema
+        """
+        return _category_table(cls, paths, query, batch_size, as_arrow, schema_version)
     def add_tag(self, tag):
         self._json["tags"].append(tag)
     def remove_tag(self, tag: str):
         self._json["tags"].remove(tag)
+    def delete_cascade(self, dry_run: bool = False, transaction: bool = False) -> Dict[str, int]:
+        """Delete the sample with its samplecomponents and stored files, see database_interface.delete_cascade
+
+        Args:
+            dry_run (bool, optional): only count what would be deleted. Defaults to False.
+            transaction (bool, optional): do the deletes in one transaction, needs a replica set. Defaults to False.
+
+        Returns:
+            Dict[str, int]: number of documents deleted (or to delete with dry_run) per collection, and of "files"
+
+        Raises:
+            ValueError: If the sample has no _id
+        """
+        if self._json.get("_id") is None:
+            raise ValueError("sample has to have an _id to be deleted")
+        sample_id = database_interface.json_to_bson(self._json["_id"])
+        return database_interface.delete_cascade(sample_ids=[sample_id], dry_run=dry_run, in_transaction=transaction)
 class HostReference(BifrostObjectReference):
     """Host reference object
 
@@ -703,6 +1609,28 @@ class Host(BifrostObject):
                 json_items.append(i.json)
             self._json["samples"] = json_items
 
+def _merge_references(references: List[Dict], new_references: List[Dict]) -> List[Dict]:
+    """Replaces the references to the same object as a new reference and appends the rest
+
+    Note:
+        References match on _id, a reference without an _id matches the new reference of the same name
+    """
+    by_id = {database_interface.json_to_bson(i["_id"]): n for n, i in enumerate(new_references) if i.get("_id") is not None}
+    by_name = {i["name"]: n for n, i in enumerate(new_references) if i.get("name") is not None}
+    merged = []
+    used = set()
+    for reference in references:
+        if reference.get("_id") is not None:
+            n = by_id.get(database_interface.json_to_bson(reference["_id"]))
+        else:
+            n = by_name.get(reference.get("name"))
+        if n is None or n in used:
+            merged.append(reference)
+        else:
+            used.add(n)
+            merged.append(new_references[n])
+    return merged + [i for n, i in enumerate(new_references) if n not in used]
+
 class RunReference(BifrostObjectReference):
     """Run reference object
 
@@ -816,6 +1744,94 @@ class Run(BifrostObject): # Alternative name is collection
         for i in hosts:
             json_items.append(i.json)
         self._json["hosts"] = json_items
+    def save_graph(self, samples: List[Sample] = None, hosts: List[Host] = None, sample_components: List["SampleComponent"] = None, transaction: bool = False) -> None:
+        """Saves the run with its samples, hosts and initial samplecomponents in one bulk write per collection
+
+        Note:
+            Objects without an _id get one client side (see assign_id), references to the samples and hosts are
+            added to the run replacing those of the same name, and samplecomponents whose sample is referenced
+            only by name get the _id of the sample of that name. Samples, hosts and samplecomponents are written
+            before the run. Offloaded entries are uploaded to GridFS before the writes, outside of the transaction.
+
+        Args:
+            samples (List[Sample], optional): samples of the run. Defaults to None.
+            hosts (List[Host], optional): hosts of the run. Defaults to None.
+            sample_components (List[SampleComponent], optional): samplecomponents to create for the samples. Defaults to None.
+            transaction (bool, optional): do the writes in one transaction, needs a replica set. Defaults to False.
+        """
+        samples, hosts, sample_components = samples or [], hosts or [], sample_components or []
+        for bifrost_object in [self, *samples, *hosts, *sample_components]:
+            bifrost_object.assign_id()
+        sample_references = {i["name"]: i.to_reference().json for i in samples}
+        for sample_component in sample_components:
+            sample_reference = sample_component._json.get("sample") or {}
+            if sample_reference.get("_id") is None and sample_reference.get("name") in sample_references:
+                sample_component._json["sample"] = sample_references[sample_reference["name"]]
+        self._json["samples"] = _merge_references(self._json.get("samples", []), list(sample_references.values()))
+        self._json["hosts"] = _merge_references(self._json.get("hosts", []), [i.to_reference().json for i in hosts])
+        groups = [objects for objects in (samples, hosts, sample_components, [self]) if objects]
+        documents = [[i._document_to_save() for i in objects] for objects in groups]
+        with database_interface.transaction(transaction) as session:
+            saved = [database_interface.save_many(objects[0]._object_type, group_documents, session=session)
+                     for objects, group_documents in zip(groups, documents)]
+        for objects, group_saved in zip(groups, saved):
+            for bifrost_object, saved_document in zip(objects, group_saved):
+                bifrost_object._set_saved(saved_document)
+    def delete_cascade(self, samples: bool = True, dry_run: bool = False, transaction: bool = False) -> Dict[str, int]:
+        """Delete the run with its runcomponents, its samples and their samplecomponents, and their stored files
+
+        Note:
+            Deleting a failed run this way takes a few round trips however many samples it has, see
+            database_interface.delete_cascade. Samples referenced only by name are looked up in one query.
+            Samples another run still lists are kept along with their samplecomponents and counted under "shared_samples".
+
+        Args:
+            samples (bool, optional): delete the samples of the run which no other run lists as well. Defaults to True.
+            dry_run (bool, optional): only count what would be deleted. Defaults to False.
+            transaction (bool, optional): do the deletes in one transaction, needs a replica set. Defaults to False.
+
+        Returns:
+            Dict[str, int]: number of documents deleted (or to delete with dry_run) per collection, of "files" and of "shared_samples" kept
+
+        Raises:
+            ValueError: If the run has no _id
+        """
+        if self._json.get("_id") is None:
+            raise ValueError("run has to have an _id to be deleted")
+        run_id = database_interface.json_to_bson(self._json["_id"])
+        sample_ids = []
+        if samples:
+            sample_ids = [database_interface.json_to_bson(i["_id"]) for i in self._json["samples"] if i.get("_id") is not None]
+            sample_names = [i["name"] for i in self._json["samples"] if i.get("_id") is None and i.get("name")]
+            if sample_names:
+                found = database_interface.find(Sample._object_type, {"name": {"$in": sample_names}}, projection={"_id": 1})
+                sample_ids += [database_interface.json_to_bson(i["_id"]) for i in found]
+        return database_interface.delete_cascade(run_ids=[run_id], sample_ids=sample_ids, dry_run=dry_run, in_transaction=transaction, keep_shared_samples=True)
+    def status_matrix(self) -> "pandas.DataFrame":
+        """get the component status of every sample in the run, computed in the DB in one aggregation
+
+        Returns:
+            pandas.DataFrame: status with a row per sample name (or _id if it has none, in run order) and a column per component name, NaN where a component isn't on a sample
+        """
+        sample_ids = [i["_id"] for i in self._json["samples"] if "_id" in i]
+        sample_names = [i["name"] for i in self._json["samples"] if "_id" not in i and i.get("name")]
+        pipeline = [
+            {"$match": {"$or": [{"_id": {"$in": sample_ids}}, {"name": {"$in": sample_names}}]}},
+            {"$project": {"name": 1, "components.name": 1, "components.status": 1}},
+            {"$unwind": {"path": "$components", "preserveNullAndEmptyArrays": True}},
+            {"$project": {"sample": "$name", "component": "$components.name", "status": "$components.status"}}
+        ]
+        # rows are named as the run references the sample, samples without a name by their _id
+        rows = {i["_id"]["$oid"]: i.get("name") or i["_id"]["$oid"] for i in self._json["samples"] if "_id" in i}
+        matrix = {i.get("name") or i["_id"]["$oid"]: {} for i in self._json["samples"] if i.get("name") or "_id" in i}
+        for row in database_interface.aggregate(Sample._object_type, pipeline):
+            _id = row["_id"]["$oid"]
+            statuses = matrix.setdefault(rows.get(_id) or row.get("sample") or _id, {})
+            if row.get("component") is not None:
+                statuses[row["component"]] = row.get("status")
+        import pandas
+        status_matrix = pandas.DataFrame.from_dict(matrix, orient="index")
+        return status_matrix.reindex(index=list(matrix), columns=sorted(status_matrix.columns))
 
 
 class SampleComponentReference(BifrostObjectReference):
@@ -850,6 +1866,8 @@ class SampleComponent(BifrostObject):
         BifrostObject: Inherited data type
     """
     _object_type: str = "sample_component"
+    _offload_fields: Tuple[str, ...] = ("results",) # categories stay inline, they are queried on the server
+    _lazy_fields: Tuple[str, ...] = ("categories",)
 
     def __init__(self, schema_version:str = "v2_1_0", value: Dict = None, sample_reference:SampleReference = None, component_reference:ComponentReference = None) -> None:
         """Initializatiion
@@ -909,94 +1927,141 @@ class SampleComponent(BifrostObject):
     def set_name(self):
         self._json["name"] = SampleComponentReference.name_generator(self.sample(), self.component())
     @staticmethod
-    def _has_requirement(object_json: Dict, requirement: Dict, expected_value: Union[None, str,List[str]]) -> bool:
-        """[summary]
+    def _has_requirement(object_json: Dict, requirement: Tuple[str, ...], expected_value: Union[None, str, List[str], Tuple]) -> bool:
+        """Checks a single requirement and prints the outcome to stderr
 
         Args:
             object_json (Dict): The object being checked on
-            requirement (Dict): The requirement to be checked against
-            expected_value (Union[None, str,List[str]]): The expected value, if value is None then requirement is met if key exists, if value is str then it must be that specific value, if value is List[str] then it can be any of the values in the list
+            requirement (Tuple[str, ...]): The path of keys to the value being checked
+            expected_value (Union[None, str, List[str], Tuple]): The expected value, if value is None then requirement is met if key exists, if value is str then it must be that specific value, if value is a list or tuple then it can be any of the values in it
 
         Returns:
             bool: True, it has the requirement | False, it doesn't have the requirement
         """
-        try:
-            value = functools.reduce(dict.get, requirement, object_json)
-            if expected_value is None:
-                print(f"[true] Requirement(value:{value}, expected_value: NA, requirement{requirement}", file=sys.stderr)
-                return True
-            elif type(expected_value) is not list:
-                expected_value = [expected_value]
-            if value in expected_value:
-                print(f"[true] Requirement(value:{value}, expected_value:{expected_value}, requirement{requirement}", file=sys.stderr)
-                return True
+        if expected_value is not None and not isinstance(expected_value, (list, tuple)):
+            expected_value = [expected_value]
+        checks = ((tuple(requirement), None if expected_value is None else tuple(expected_value)),)
+        return evaluate_requirements(object_json, checks, trace=TRACE_ALL)[0].passed
+    def requirements_report(self, trace: int = TRACE_NONE) -> RequirementReport:
+        """Checks the requirements of the component on the sample
+
+        Note:
+            The requirements are compiled once per component version, see Component.compiled_requirements.
+            The sample and samplecomponents are loaded projected on the paths checked, so only the offloaded
+            results checked are loaded from GridFS, see resolve_offloaded_checks
+
+        Args:
+            trace (int, optional): TRACE_NONE, TRACE_FAILURES or TRACE_ALL. Defaults to TRACE_NONE.
+
+        Returns:
+            RequirementReport: a check per requirement, not found if the sample or component isn't in the DB
+        """
+        component = Component.load(self.component)
+        if component is None:
+            return RequirementReport(self.sample["name"], [], found=False)
+        requirements = component.compiled_requirements()
+        checks = []
+        if requirements["sample"]:
+            sample_json = database_interface.load(Sample._object_type, self.sample.json, requirements_projection(requirements["sample"]))
+            if "_id" not in sample_json:
+                return RequirementReport(self.sample["name"], [], found=False)
+            checks.extend(evaluate_requirements(sample_json, requirements["sample"], trace=trace))
+        for component_name, component_checks in requirements["component"]:
+            component_reference = ComponentReference(name=component_name)
+            name = SampleComponentReference.name_generator(self.sample, component_reference)
+            projection = requirements_projection(component_checks, self._offload_fields)
+            referenced_json = database_interface.load(self._object_type, SampleComponentReference(name=name).json, projection)
+            if "_id" in referenced_json:
+                resolve_offloaded_checks(referenced_json, component_checks, self._offload_fields)
             else:
-                print(f"[fail] Requirement(value:{value}, expected_value:{expected_value}, requirement{requirement}", file=sys.stderr)
-                return False
-        except Exception:
-            print(f"[fail] Requirement(value:<Failed to retrieve>, expected_value:{expected_value}, requirement{requirement}", file=sys.stderr)
-            return False
-    def has_requirements(self) -> bool:
+                referenced_json = {}
+            checks.extend(evaluate_requirements(referenced_json, component_checks, component_name, trace))
+        return RequirementReport(self.sample["name"], checks)
+    def has_requirements(self, trace: int = TRACE_ALL) -> bool:
         """if samplecomponent has requirements as defined
 
+        Args:
+            trace (int, optional): TRACE_NONE, TRACE_FAILURES or TRACE_ALL to print a line per requirement to stderr. Defaults to TRACE_ALL.
+
         Returns:
             bool: True, it has all the requirement | False, it doesn't have all the requirement
         """
-        
-        component = Component.load(self.component)
-        sample = Sample.load(self.sample)
-        no_failures = True
-        if component.json.get("requirements", {}) == None:
-            return True
-        sample_requirements = component.json.get("requirements", {}).get("sample", {})
-        requirements = pandas.json_normalize(sample_requirements, sep=".").to_dict(orient='records')[0] # Converts the line from a dict to a 2D dataframe with 1 row, then store as a dict at sheet 0
-        
-        for requirement, expected_value in requirements.items():
-            if not self._has_requirement(sample.json, requirement.split("."), expected_value):
-                no_failures = False
-        component_requirements = component.get("requirements", {}).get("component", {})
-        Requirements(value=component_requirements) # To validate the object
-        for entry in component_requirements:
-            component_reference = ComponentReference(name=entry["name"])
-            referenced_samplecomponent = SampleComponent(sample_reference = self.sample(), component_reference = component_reference)
-            referenced_samplecomponent.load()
-            requirements = pandas.json_normalize(entry["requirements"], sep=".").to_dict(orient='records')[0] # Converts the line from a dict to a 2D dataframe with 1 row, then store as a dict at sheet 0
-            for requirement, expected_value in requirements.items():
-                if not self._has_requirement(referenced_samplecomponent.json, requirement.split("."), expected_value):
-                    no_failures = False
-        if no_failures:
-            return True
-        else:
-            return False
+        return self.requirements_report(trace).passed
     def get_category(self, key: str) -> Category:
         """get the category based on provided key
 
+        Note:
+            The category is fetched on its own when the object was loaded lazily, and validated once on first access
+
         Args:
             key (str): category you want to get the value of
 
         Returns:
             Category: A category object of the associated key, None if not found
         """
-        try:
-            return Category(value=self._json["categories"][key])
-        except KeyError:
-            return None
+        return self._get_category(key)
     def set_category(self, category: Category):
         """set the category based on a provided Category
 
         Args:
             category (Category): The category you want to set for the sample
         """
-        self._json["categories"][category["name"]] = category.json
-    def save_files(self) -> None:
+        self._set_category(category)
+    @classmethod
+    def find_by_categories(cls, filters: Dict[str, Any], schema_version: str = "v2_1_0", create_indexes: bool = False, batch_size: int = 1000) -> Iterator["SampleComponent"]:
+        """Streams the samplecomponents whose categories match the filters, filtered in the DB
+
+        Args:
+            filters (Dict[str, Any]): category path (e.g. species_detection.summary.species) to the value it should have, see get_category_query
+            schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+            create_indexes (bool, optional): Index the filtered paths before querying. Defaults to False.
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+
+        Yields:
+            SampleComponent: matching samplecomponents
+        """
+        return _find_by_categories(cls, filters, schema_version, create_indexes, batch_size)
+    @classmethod
+    def category_table(cls, paths: List[str], query: Dict = None, batch_size: int = 1000, as_arrow: bool = False, schema_version: str = "v2_1_0") -> Union["pandas.DataFrame", Any]:
+        """Get category values of many samplecomponents as a table, only the requested paths are fetched from the DB
+
+        Args:
+            paths (List[str]): category paths to include e.g. ["mapping_qc"] or ["species_detection.summary.species"], nested values get a column each
+            query (Dict, optional): json formatted MongoDB filter on the samplecomponents e.g. from get_category_query. Defaults to None for all.
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+            as_arrow (bool, optional): return a pyarrow.Table instead of a pandas.DataFrame. Defaults to False.
+            schema_version (str, optional): Schema version from json schema (bifrost.jsonc). Defaults to "v2_1_0".
+
+        Returns:
+            Union[pandas.DataFrame, pyarrow.Table]: a row per samplecomponent with _id, name and a column per category path e.g. mapping_qc.summary.mapped.reads_mapped
+
+        Raises:
+            KeyError: If a path is not in the category schema
+        """
+        return _category_table(cls, paths, query, batch_size, as_arrow, schema_version)
+    def save_files(self, max_workers: int = 4, chunk_size: int = None, compression: str = None) -> Dict[str, str]:
+        """Uploads the files listed under the component's db_values_changed files concurrently and records them in files
+
+        Args:
+            max_workers (int, optional): maximum concurrent uploads. Defaults to 4.
+            chunk_size (int, optional): GridFS chunk size in bytes, None for the GridFS default. Defaults to None.
+            compression (str, optional): "none", "auto", "gzip" or "zstd", see database_interface.choose_file_codec. Defaults to None for BIFROST_FILE_COMPRESSION.
+
+        Returns:
+            Dict[str, str]: file path to error for files that failed to upload, empty if all were uploaded
+        """
         component = Component.load(self.component)
-        file_paths = component.get("db_values_changes", {}).get("files",[])
-        file_ids = []
-        for file_path in file_paths:
-            file_id = database_interface.save_file(self._json["id"], self._json["name"], self._object_type, file_path)
-            if file_id is not None:
-                file_ids.append({"_id": file_id, "path": file_path})
-        self._json["files"] = file_ids
+        db_values_changed = component.json.get("db_values_changed", component.json.get("db_values_changes", {}))
+        file_paths = db_values_changed.get("files", [])
+        if "_id" not in self._json:
+            self.save()
+        owner_id = database_interface.json_to_bson(self._json["_id"])
+        file_ids, failures = database_interface.save_files(owner_id, self._json["name"], self._object_type, file_paths, max_workers=max_workers, chunk_size=chunk_size, compression=compression)
+        self._json["files"] = [
+            {"_id": database_interface.bson_to_json(file_id), "path": file_path}
+            for file_path, file_id in zip(file_paths, file_ids) if file_id is not None
+        ]
+        return failures
 class RunComponentReference(BifrostObjectReference):
     """RunComponent reference object
 
@@ -0,0 +1,192 @@
+# Node local cache of files loaded from GridFS, shared between processes through the filesystem
+import contextlib
+import os
+import shutil
+import stat
+import uuid
+from typing import Callable, Dict, Iterator, List, Tuple
+
+DEFAULT_CACHE = None
+
+
+def get_default_cache() -> "FileCache":
+    """Get the cache configured by the environment
+
+    Other Parameters:
+        DEFAULT_CACHE (FileCache): GLOBAL storing the cache
+        BIFROST_FILE_CACHE_DIR: (ENV) directory of the cache, no caching when unset or not on POSIX (fcntl is needed for locking)
+        BIFROST_FILE_CACHE_SIZE: (ENV) maximum size of the cache in bytes, defaults to 10 GiB
+
+    Returns:
+        FileCache: The shared cache, None if BIFROST_FILE_CACHE_DIR is unset or the platform isn't POSIX
+    """
+    global DEFAULT_CACHE
+    if DEFAULT_CACHE is None and os.getenv("BIFROST_FILE_CACHE_DIR") and os.name == "posix":
+        max_bytes = int(os.getenv("BIFROST_FILE_CACHE_SIZE", 10 * 1024 ** 3))
+        DEFAULT_CACHE = FileCache(os.environ["BIFROST_FILE_CACHE_DIR"], max_bytes)
+    return DEFAULT_CACHE
+
+
+class FileCache:
+    """Size bounded LRU cache of stored files on local (or shared) disk
+
+    Note:
+        Entries are keyed by file id and checksum so a replaced file never serves stale content. Each entry
+        has a lock file taken with fcntl.flock while it is fetched, so concurrent jobs wanting the same file
+        download it once. Entries are read only, with link=True they are hardlinked to the destination which
+        is then read only as well; copy the file before modifying it. Recency is tracked by the mtime of a
+        separate access file per entry, bumped on every hit, so the mtime of linked destinations is left alone.
+        flock is only reliable across hosts on NFS where the client emulates it with byte range locks (Linux
+        2.6.12 and later) on a mount with locking enabled; otherwise keep the directory on local disk, as two
+        hosts sharing it could fetch the same entry twice or evict an entry the other is reading.
+
+    Args:
+        directory (str): directory of the cache, created if missing
+        max_bytes (int): total size of the entries above which the least recently used are evicted
+        link (bool, optional): hardlink entries to the destination, falling back to copying across filesystems. Defaults to True.
+    """
+    def __init__(self, directory: str, max_bytes: int, link: bool = True) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.join(directory, "entries"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "locks"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "access"), exist_ok=True)
+    def entry_path(self, file_id, checksum: str) -> str:
+        return os.path.join(self.directory, "entries", f"{file_id}.{checksum}")
+    def _access_path(self, name: str) -> str:
+        return os.path.join(self.directory, "access", name)
+    def _touch(self, name: str) -> None:
+        with open(self._access_path(name), "a"):
+            pass
+        os.utime(self._access_path(name))
+    def _lock_path(self, name: str) -> str:
+        return os.path.join(self.directory, "locks", f"{name}.lock")
+    @contextlib.contextmanager
+    def _lock(self, name: str, blocking: bool = True) -> Iterator[bool]:
+        import fcntl  # POSIX only, imported here so bifrostlib still imports without it
+        with open(self._lock_path(name), "a") as lock_handle:
+            try:
+                fcntl.flock(lock_handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_handle, fcntl.LOCK_UN)
+    def load(self, file_id, checksum: str, save_to_path: str, fetch: Callable[[str], None], verify: Callable[[str], None] = None) -> bool:
+        """Puts a cached file at save_to_path, fetching it into the cache first on a miss
+
+        Args:
+            file_id (ObjectId): GridFS id of the file
+            checksum (str): stored checksum of the file, or another key that changes with its content
+            save_to_path (str): destination path, must not exist
+            fetch (Callable[[str], None]): writes the file content to the given path, called on a miss
+            verify (Callable[[str], None], optional): checks the content of a hit at the given path, raising ValueError
+                when it does not match; a mismatching entry is fetched again. Defaults to None.
+
+        Returns:
+            bool: True on a hit, False on a miss
+        """
+        entry_path = self.entry_path(file_id, checksum)
+        name = os.path.basename(entry_path)
+        with self._lock(name):
+            hit = os.path.isfile(entry_path)
+            if hit and verify is not None:
+                try:
+                    verify(entry_path)
+                except ValueError:
+                    os.remove(entry_path)
+                    hit = False
+            if hit:
+                self.hits += 1
+                self._touch(name)
+            else:
+                self.misses += 1
+                fetch(entry_path)
+                os.chmod(entry_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                self._touch(name)
+            self._materialise(entry_path, save_to_path)
+        if not hit:
+            self.evict()
+        return hit
+    def _materialise(self, entry_path: str, save_to_path: str) -> None:
+        if self.link:
+            try:
+                os.link(entry_path, save_to_path)
+                return
+            except OSError:
+                pass  # e.g. another filesystem
+        temp_path = os.path.join(os.path.dirname(save_to_path), f".{os.path.basename(save_to_path)}.{uuid.uuid4().hex}.part")
+        try:
+            shutil.copyfile(entry_path, temp_path)
+            os.replace(temp_path, save_to_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        with os.scandir(os.path.join(self.directory, "entries")) as scan:
+            for entry in scan:
+                if entry.name.startswith("."):
+                    continue  # partial download
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                try:
+                    used = os.stat(self._access_path(entry.name)).st_mtime
+                except FileNotFoundError:
+                    used = entry_stat.st_mtime
+                entries.append((used, entry_stat.st_size, entry.name))
+        return entries
+    def evict(self) -> int:
+        """Removes the least recently used entries until the cache is within max_bytes
+
+        Note:
+            Entries being fetched or read by another process are skipped. Lock files are kept, removing them
+            would let two processes lock the same entry through different inodes.
+
+        Returns:
+            int: number of entries removed
+        """
+        removed = 0
+        with self._lock("evict"):
+            entries = sorted(self._entries())
+            size = sum(i[1] for i in entries)
+            for mtime, entry_size, name in entries:
+                if size <= self.max_bytes:
+                    break
+                with self._lock(name, blocking=False) as locked:
+                    if not locked:
+                        continue
+                    for path in (os.path.join(self.directory, "entries", name), self._access_path(name)):
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                size -= entry_size
+                removed += 1
+        self.evictions += removed
+        return removed
+    def stats(self) -> Dict:
+        """Hit rate of this process and current size of the cache
+
+        Returns:
+            Dict: hits, misses, hit_rate, evictions, entries and size_bytes
+        """
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size_bytes": sum(i[1] for i in entries),
+        }
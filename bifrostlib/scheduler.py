@@ -0,0 +1,208 @@
+# Dependency graph of components and the components ready to run on the samples of a run
+import datetime
+import heapq
+import time
+from typing import Dict, Iterator, List, Set, Tuple
+from bson import ObjectId
+from bifrostlib import database_interface
+from bifrostlib.datahandling import Run
+from bifrostlib.datahandling import RunReference
+
+DONE_STATUS = "Success"
+PENDING_STATUSES = (None, "Initialized")  # None when the sample has no samplecomponent of the component yet
+
+
+class ComponentGraph:
+    """Dependency DAG of components, a component depends on the components named in its requirements.component
+
+    Args:
+        dependencies (Dict[str, List[str]]): component name to the names of the components it requires
+
+    Raises:
+        ValueError: If the dependencies have a cycle
+    """
+    def __init__(self, dependencies: Dict[str, List[str]]) -> None:
+        self.dependencies: Dict[str, Tuple[str, ...]] = {}
+        for name, required in dependencies.items():
+            self.dependencies[name] = tuple(required)
+            for i in required:
+                self.dependencies.setdefault(i, ())
+        self.dependents: Dict[str, List[str]] = {name: [] for name in self.dependencies}
+        for name, required in self.dependencies.items():
+            for i in required:
+                self.dependents[i].append(name)
+        self.order: List[str] = self._topological_order()
+        self._rank = {name: i for i, name in enumerate(self.order)}
+    def __len__(self) -> int:
+        return len(self.dependencies)
+    def __contains__(self, name: str) -> bool:
+        return name in self.dependencies
+    @classmethod
+    def load(cls, query: Dict = None, batch_size: int = 1000) -> "ComponentGraph":
+        """Builds the graph from the components in the DB, fetching only their names and required component names
+
+        Args:
+            query (Dict, optional): json formatted MongoDB filter on the components. Defaults to None for all.
+            batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+
+        Returns:
+            ComponentGraph: the dependency graph
+        """
+        dependencies = {}
+        projection = {"name": 1, "requirements.component.name": 1}
+        for component_json in database_interface.find("component", query or {}, projection=projection, batch_size=batch_size):
+            requirements = component_json.get("requirements") or {}
+            dependencies[component_json["name"]] = [i["name"] for i in requirements.get("component") or []]
+        return cls(dependencies)
+    def _topological_order(self) -> List[str]:
+        # Kahn's algorithm, ties broken on name so the order is stable
+        remaining = {name: len(required) for name, required in self.dependencies.items()}
+        ready = [name for name, count in remaining.items() if count == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            name = heapq.heappop(ready)
+            order.append(name)
+            for dependent in self.dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, dependent)
+        if len(order) < len(self.dependencies):
+            cycle = sorted(name for name, count in remaining.items() if count > 0)
+            raise ValueError(f"Component requirements have a cycle between: {', '.join(cycle)}")
+        return order
+    def sort(self, names: List[str]) -> List[str]:
+        """Sorts component names in topological order, names not in the graph last
+        """
+        return sorted(names, key=lambda name: (self._rank.get(name, len(self._rank)), name))
+
+
+class RunScheduler:
+    """Tracks the samplecomponent statuses of a run and the components ready to run on each sample
+
+    Note:
+        A component is ready on a sample when it hasn't been started there (no samplecomponent, or status
+        Initialized) and every component it requires has status Success on the sample, as the requirements checks
+        require of a component listed without requirements (see compile_requirements). Statuses are loaded
+        once and then kept up to date with refresh, which only fetches the samplecomponents of the run changed
+        since the last call (see database_interface.find_changed_since), or with set_status when the caller
+        knows of a change. Workers write statuses with their own clocks, so refresh looks overlap seconds
+        back for late writes and refetches all statuses every full_refresh_interval seconds, so a write from a
+        clock further behind delays its dependents instead of stalling the run. Full refreshes fetch every
+        samplecomponent of the run, including those without a date in metadata.updated_at (see
+        database_interface.migrate_metadata_dates) which incremental refreshes don't see.
+
+    Args:
+        run (Run or RunReference): run whose samples are scheduled
+        graph (ComponentGraph, optional): component dependencies. Defaults to None for ComponentGraph.load().
+        components (List[str], optional): components to schedule. Defaults to None for the run's components, or every component in the graph if the run has none.
+        batch_size (int, optional): documents fetched per round trip. Defaults to 1000.
+        overlap (float, optional): seconds refresh looks back for late writes. Defaults to 60.
+        full_refresh_interval (float, optional): seconds between refreshes of all statuses, None for never. Defaults to 600.
+    """
+    def __init__(self, run, graph: ComponentGraph = None, components: List[str] = None, batch_size: int = 1000,
+                 overlap: float = database_interface.CHANGED_SINCE_OVERLAP, full_refresh_interval: float = 600) -> None:
+        if isinstance(run, RunReference):
+            run = Run.load(run)
+        self.graph = graph if graph is not None else ComponentGraph.load(batch_size=batch_size)
+        if components is None:
+            components = [i["name"] for i in run.json.get("components", [])] or self.graph.order
+        self.components = self.graph.sort(components)
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.full_refresh_interval = full_refresh_interval
+        self.samples = [i["name"] for i in run.json.get("samples", [])]
+        sample_ids = [i["_id"] for i in run.json.get("samples", []) if i.get("_id") is not None]
+        self._query = {"$or": [{"sample._id": {"$in": sample_ids}}, {"sample.name": {"$in": self.samples}}]}
+        self.statuses: Dict[str, Dict[str, str]] = {name: {} for name in self.samples}
+        self._frontier: Dict[str, List[str]] = {}
+        self._watermark = None
+        self._full_refreshed_at = None
+        self.refresh()
+    def _ready(self, sample: str) -> List[str]:
+        statuses = self.statuses.get(sample, {})
+        return [
+            component for component in self.components
+            if statuses.get(component) in PENDING_STATUSES
+            and all(statuses.get(i) == DONE_STATUS for i in self.graph.dependencies.get(component, ()))
+        ]
+    def frontier(self) -> Dict[str, List[str]]:
+        """Get the components ready to run per sample
+
+        Returns:
+            Dict[str, List[str]]: sample name to the ready component names in topological order, empty when none are
+        """
+        return {sample: list(ready) for sample, ready in self._frontier.items()}
+    def set_status(self, sample: str, component: str, status: str) -> bool:
+        """Records a status change and updates the sample's frontier
+
+        Args:
+            sample (str): sample name
+            component (str): component name
+            status (str): new status of the samplecomponent
+
+        Returns:
+            bool: True if the ready components of the sample changed
+        """
+        if sample not in self.statuses:
+            return False
+        self.statuses[sample][component] = status
+        ready = self._ready(sample)
+        changed = ready != self._frontier.get(sample)
+        self._frontier[sample] = ready
+        return changed
+    def refresh(self, full: bool = False) -> Dict[str, List[str]]:
+        """Fetches the samplecomponents of the run changed since the last refresh
+
+        Args:
+            full (bool, optional): fetch all samplecomponents of the run, done every full_refresh_interval anyway. Defaults to False.
+
+        Returns:
+            Dict[str, List[str]]: sample name to the new ready components, for the samples whose ready components changed
+        """
+        now = time.monotonic()
+        if full or (self.full_refresh_interval is not None and self._full_refreshed_at is not None
+                    and now - self._full_refreshed_at >= self.full_refresh_interval):
+            self._watermark = None
+        full = self._watermark is None
+        if full:
+            # statuses are rebuilt, a samplecomponent removed from the run mustn't keep its last status
+            self._full_refreshed_at = now
+            self.statuses = {name: {} for name in self.samples}
+        scanned_at = datetime.datetime.now(datetime.timezone.utc)
+        touched: Set[str] = set()
+        projection = {"sample.name": 1, "component.name": 1, "status": 1}
+        if full:
+            # not find_changed_since, which skips samplecomponents without a date in metadata.updated_at
+            sample_components = database_interface.find("sample_component", self._query, projection=projection, batch_size=self.batch_size)
+        else:
+            sample_components = self._changed_since(projection)
+        for sample_component in sample_components:
+            sample = sample_component.get("sample", {}).get("name")
+            component = sample_component.get("component", {}).get("name")
+            if sample in self.statuses:
+                self.statuses[sample][component] = sample_component.get("status")
+                touched.add(sample)
+        if full:
+            # incremental refreshes resume from the scan
+            self._watermark = database_interface.bson_to_json({
+                "updated_at": scanned_at - datetime.timedelta(seconds=self.overlap),
+                "_id": ObjectId("000000000000000000000000")})
+        changed: Set[str] = set()
+        for sample in (self.samples if full else touched):
+            ready = self._ready(sample)
+            if ready != self._frontier.get(sample):
+                changed.add(sample)
+            self._frontier[sample] = ready
+        return {sample: list(self._frontier[sample]) for sample in self.samples if sample in changed}
+    def _changed_since(self, projection: Dict) -> Iterator[Dict]:
+        for sample_component, watermark in database_interface.find_changed_since(
+                "sample_component", self._watermark, self.batch_size, query=self._query, projection=projection, overlap=self.overlap):
+            self._watermark = watermark
+            yield sample_component
+    def ready(self) -> Iterator[Tuple[str, str]]:
+        """Yields (sample name, component name) for every ready component, samples in run order
+        """
+        for sample in self.samples:
+            for component in self._frontier.get(sample, []):
+                yield sample, component
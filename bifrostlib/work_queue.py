@@ -0,0 +1,292 @@
+# Work queue over the sample_components collection, for workers on many nodes claiming samplecomponents to run
+import datetime
+import os
+import socket
+import time
+import uuid
+from typing import Dict, Iterator, List, Tuple
+import pymongo
+from bson import ObjectId
+from bifrostlib import database_interface
+from bifrostlib.datahandling import SampleComponent
+
+QUEUED_STATUS = "Queued"
+RUNNING_STATUS = "Running"
+SUCCESS_STATUS = "Success"
+FAILURE_STATUS = "Failure"
+TERMINAL_STATUSES = (SUCCESS_STATUS, FAILURE_STATUS, "Requirements not met")
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class WorkQueue:
+    """Queue of the samplecomponents with status Queued, claimed atomically by workers with a lease
+
+    Note:
+        claim moves a samplecomponent from Queued to Running with find_one_and_update and records the worker and
+        lease expiry under lease. The worker renews the lease with heartbeat and ends it with complete or fail.
+        A Running samplecomponent whose lease expired (the worker died or hung) can be claimed again by any
+        worker, after max_attempts claims it is failed by the next claim (or reclaim_expired) instead. Giving
+        a samplecomponent back with release doesn't count as an attempt. Each process needs its own connection, so start
+        workers with the spawn start method or connect after forking.
+
+    Args:
+        worker_id (str, optional): name of this worker. Defaults to None for hostname:pid:random.
+        lease_seconds (float, optional): lease length, heartbeat well within it. Defaults to 300.
+        components (List[str], optional): only claim samplecomponents of these component names. Defaults to None for all.
+        max_attempts (int, optional): claims before a samplecomponent with expired leases is failed, None for no limit. Defaults to None.
+    """
+    def __init__(self, worker_id: str = None, lease_seconds: float = 300, components: List[str] = None, max_attempts: int = None) -> None:
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.components = components
+        self.max_attempts = max_attempts
+    @property
+    def _collection(self):
+        return database_interface.get_connection().get_database()[database_interface.pluralize("sample_component")]
+    def _claimable(self, now: datetime.datetime) -> Dict:
+        query = {"$or": [
+            {"status": QUEUED_STATUS},
+            {"status": RUNNING_STATUS, "lease.expires_at": {"$lt": now}}
+        ]}
+        if self.max_attempts is not None:
+            query["attempts"] = {"$not": {"$gte": self.max_attempts}}
+        if self.components is not None:
+            query["component.name"] = {"$in": list(self.components)}
+        return query
+    def ensure_indexes(self) -> None:
+        """Indexes the fields claims filter on
+        """
+        self._collection.create_index([("status", pymongo.ASCENDING), ("lease.expires_at", pymongo.ASCENDING)])
+        self._collection.create_index([("status", pymongo.ASCENDING), ("component.name", pymongo.ASCENDING)])
+    def enqueue(self, sample_component_ids: List[ObjectId], rerun: bool = False) -> int:
+        """Queues samplecomponents which aren't queued, running or finished
+
+        Args:
+            sample_component_ids (List[ObjectId]): samplecomponents to queue
+            rerun (bool, optional): queue samplecomponents with one of the TERMINAL_STATUSES as well. Defaults to False.
+
+        Returns:
+            int: number of samplecomponents queued
+        """
+        now = _now()
+        skipped = [QUEUED_STATUS, RUNNING_STATUS]
+        if not rerun:
+            skipped.extend(TERMINAL_STATUSES)
+        result = self._collection.update_many(
+            {"_id": {"$in": list(sample_component_ids)}, "status": {"$nin": skipped}},
+            {"$set": {"status": QUEUED_STATUS, "attempts": 0, "metadata.updated_at": now}, "$unset": {"lease": ""}}
+        )
+        return result.modified_count
+    def claim(self) -> SampleComponent:
+        """Claims the oldest queued (or lease expired) samplecomponent
+
+        Returns:
+            SampleComponent: the claimed samplecomponent with status Running, None if there is nothing to claim
+        """
+        now = _now()
+        self._fail_exhausted(now)
+        claimed = self._collection.find_one_and_update(
+            self._claimable(now),
+            {
+                "$set": {
+                    "status": RUNNING_STATUS,
+                    "lease": {"worker": self.worker_id, "claimed_at": now, "heartbeat_at": now, "expires_at": now + datetime.timedelta(seconds=self.lease_seconds)},
+                    "metadata.updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("_id", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if claimed is None:
+            return None
+        return SampleComponent(value=database_interface.bson_to_json(claimed))
+    def _fail_exhausted(self, now: datetime.datetime) -> int:
+        """Fails the Running samplecomponents whose lease expired after max_attempts claims
+        """
+        if self.max_attempts is None:
+            return 0
+        return self._collection.update_many(
+            {"status": RUNNING_STATUS, "lease.expires_at": {"$lt": now}, "attempts": {"$gte": self.max_attempts}},
+            {"$set": {"status": FAILURE_STATUS, "failure_reason": "lease expired", "metadata.updated_at": now}, "$unset": {"lease": ""}}
+        ).modified_count
+    def _owned(self, sample_component_id: ObjectId) -> Dict:
+        return {"_id": sample_component_id, "status": RUNNING_STATUS, "lease.worker": self.worker_id}
+    def heartbeat(self, sample_component_id: ObjectId) -> bool:
+        """Extends the lease of a claimed samplecomponent, only the lease is written
+
+        Args:
+            sample_component_id (ObjectId): the claimed samplecomponent
+
+        Returns:
+            bool: True if the lease was extended, False if it was lost to another worker
+        """
+        now = _now()
+        result = self._collection.update_one(
+            self._owned(sample_component_id),
+            {"$set": {"lease.heartbeat_at": now, "lease.expires_at": now + datetime.timedelta(seconds=self.lease_seconds)}}
+        )
+        return result.matched_count == 1  # _owned proves the lease, an identical rewrite modifies nothing
+    def _finish(self, sample_component_id: ObjectId, status: str, update: Dict = None, attempts: int = 0) -> bool:
+        update = dict(update or {})
+        update.update({"status": status, "metadata.updated_at": _now()})
+        operations = {"$set": update, "$unset": {"lease": ""}}
+        if attempts:
+            operations["$inc"] = {"attempts": attempts}
+        result = self._collection.update_one(self._owned(sample_component_id), operations)
+        return result.matched_count == 1
+    def complete(self, sample_component_id: ObjectId, status: str = SUCCESS_STATUS) -> bool:
+        """Ends the lease and moves the samplecomponent from Running to status
+
+        Args:
+            sample_component_id (ObjectId): the claimed samplecomponent
+            status (str, optional): final status. Defaults to "Success".
+
+        Returns:
+            bool: True on success, False if the lease was lost to another worker
+        """
+        return self._finish(sample_component_id, status)
+    def fail(self, sample_component_id: ObjectId, reason: str = None) -> bool:
+        """Ends the lease and moves the samplecomponent from Running to Failure
+
+        Args:
+            sample_component_id (ObjectId): the claimed samplecomponent
+            reason (str, optional): stored under failure_reason. Defaults to None.
+
+        Returns:
+            bool: True on success, False if the lease was lost to another worker
+        """
+        return self._finish(sample_component_id, FAILURE_STATUS, {"failure_reason": reason} if reason is not None else None)
+    def release(self, sample_component_id: ObjectId) -> bool:
+        """Gives a claimed samplecomponent back to the queue e.g. on shutdown, without counting the claim as an attempt
+
+        Args:
+            sample_component_id (ObjectId): the claimed samplecomponent
+
+        Returns:
+            bool: True on success, False if the lease was lost to another worker
+        """
+        return self._finish(sample_component_id, QUEUED_STATUS, attempts=-1)
+    def reclaim_expired(self) -> Dict[str, int]:
+        """Requeues the Running samplecomponents whose lease expired, failing those out of attempts
+
+        Note:
+            claim already takes samplecomponents with expired leases, this is for sweeping them out of Running
+            e.g. so status reports are accurate while no worker is claiming.
+
+        Returns:
+            Dict[str, int]: number of samplecomponents "requeued" and "failed"
+        """
+        now = _now()
+        failed = self._fail_exhausted(now)
+        requeued = self._collection.update_many(
+            {"status": RUNNING_STATUS, "lease.expires_at": {"$lt": now}},
+            {"$set": {"status": QUEUED_STATUS, "metadata.updated_at": now}, "$unset": {"lease": ""}}
+        ).modified_count
+        return {"requeued": requeued, "failed": failed}
+
+
+def wait_for(sample_component_ids: List[ObjectId], statuses: Tuple[str, ...] = TERMINAL_STATUSES, timeout: float = None,
+             poll_interval: float = 1.0, max_poll_interval: float = 60.0, backoff: float = 2.0, use_change_stream: bool = True) -> Iterator[Tuple[ObjectId, str]]:
+    """Waits for samplecomponents to reach one of the statuses, yielding each as soon as it does
+
+    Note:
+        A change stream on the collection is used when available (it requires a replica set), a stream which
+        fails or closes is reopened after the last change seen. Without a replica set the
+        samplecomponents still waited on are polled with one projected $in query per interval. The interval
+        starts at poll_interval, grows by backoff while nothing finishes up to max_poll_interval and is reset
+        when something does. Samplecomponents which are deleted are waited on until the timeout.
+
+    Args:
+        sample_component_ids (List[ObjectId]): samplecomponents to wait for
+        statuses (Tuple[str, ...], optional): statuses to wait for. Defaults to TERMINAL_STATUSES.
+        timeout (float, optional): seconds to wait in total, None to wait forever. Defaults to None.
+        poll_interval (float, optional): first seconds between polls. Defaults to 1.
+        max_poll_interval (float, optional): most seconds between polls. Defaults to 60.
+        backoff (float, optional): factor the poll interval grows by. Defaults to 2.
+        use_change_stream (bool, optional): try a change stream before falling back to polling. Defaults to True.
+
+    Yields:
+        Tuple[ObjectId, str]: _id and status of each samplecomponent when it reaches one of the statuses
+
+    Raises:
+        TimeoutError: If some samplecomponents didn't reach the statuses within timeout
+    """
+    collection = database_interface.get_connection().get_database()[database_interface.pluralize("sample_component")]
+    pending = set(sample_component_ids)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def finished() -> List[Tuple[ObjectId, str]]:
+        if not pending:
+            return []
+        found = collection.find({"_id": {"$in": list(pending)}, "status": {"$in": list(statuses)}}, projection={"status": 1})
+        return [(i["_id"], i["status"]) for i in found]
+
+    def remaining() -> float:
+        return None if deadline is None else deadline - time.monotonic()
+
+    def watch(resume_token: Dict = None):
+        pipeline = [{"$match": {"documentKey._id": {"$in": list(pending)}, "operationType": {"$in": ["insert", "update", "replace"]}}}]
+        return collection.watch(pipeline, full_document="updateLookup", max_await_time_ms=1000, resume_after=resume_token)
+
+    stream = None
+    if use_change_stream:
+        try:
+            stream = watch()
+        except pymongo.errors.OperationFailure as error:
+            # "The $changeStream stage is only supported on replica sets", poll instead
+            if "replica set" not in str(error):
+                raise
+    if stream is not None:
+        try:
+            # the stream is open before the first query so no change in between is missed
+            for _id, status in finished():
+                pending.discard(_id)
+                yield _id, status
+            while pending:
+                if deadline is not None and remaining() <= 0:
+                    raise TimeoutError(f"{len(pending)} samplecomponents did not finish within {timeout}s")
+                try:
+                    change = stream.try_next() if stream.alive else None
+                    failed = False
+                except pymongo.errors.PyMongoError:
+                    change, failed = None, True  # e.g. a network error after the stream was open
+                if failed or not stream.alive:
+                    # reopened after the last change seen, as in ObjectCache._watch, errors reopening are raised
+                    resume_token = stream.resume_token
+                    stream.close()
+                    stream = watch(resume_token)
+                    if resume_token is None:
+                        for _id, status in finished():
+                            pending.discard(_id)
+                            yield _id, status
+                    continue
+                if change is None:
+                    continue
+                _id = change["documentKey"]["_id"]
+                updated_fields = (change.get("updateDescription") or {}).get("updatedFields") or {}
+                status = updated_fields.get("status", (change.get("fullDocument") or {}).get("status"))
+                if _id in pending and status in statuses:
+                    pending.discard(_id)
+                    yield _id, status
+        finally:
+            stream.close()
+        return
+
+    interval = poll_interval
+    while True:
+        done = finished()
+        for _id, status in done:
+            pending.discard(_id)
+            yield _id, status
+        if not pending:
+            return
+        interval = poll_interval if done else min(interval * backoff, max_poll_interval)
+        if deadline is not None:
+            if remaining() <= 0:
+                raise TimeoutError(f"{len(pending)} samplecomponents did not finish within {timeout}s")
+            interval = min(interval, remaining())
+        time.sleep(interval)
@@ -17,6 +17,10 @@ setup(
         'pandas',
         'libmagic',
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+        'zstd': ['zstandard'],
+    },
     package_data={"bifrostlib": ['./schemas/bifrost.jsonc']},
     include_package_data=True
     )
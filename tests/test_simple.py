@@ -1,6 +1,8 @@
 import pytest
 from bifrostlib import datahandling
 from bifrostlib import database_interface
+from bifrostlib import common
+from bifrostlib import work_queue
 from bifrostlib.datahandling import Category
 from bifrostlib.datahandling import ComponentReference
 from bifrostlib.datahandling import Component
@@ -16,8 +18,18 @@ from bifrostlib.datahandling import RunComponentReference
 from bifrostlib.datahandling import RunComponent
 from bifrostlib.datahandling import BioDBReference
 from bifrostlib.datahandling import BioDB
+from bifrostlib.cache import ObjectCache
+from bifrostlib.file_cache import FileCache
+from bifrostlib.scheduler import ComponentGraph
+from bifrostlib.scheduler import RunScheduler
+from bifrostlib.work_queue import WorkQueue
+from bifrostlib.work_queue import wait_for
+import bson
+import datetime
+import multiprocessing
 import pymongo
 import os
+import re
 import time
 
 
@@ -31,6 +43,84 @@ def test_load_schema():
     schema = datahandling.load_schema()
     assert schema is not None
 
+def test_date_now_keeps_milliseconds():
+    date = datahandling.date_now()["$date"]
+    assert re.match(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{3}Z$", date)
+    assert database_interface.json_to_bson({"$date": date}).microsecond % 1000 == 0
+
+def test_get_category_query():
+    query = datahandling.get_category_query({"species_detection.summary.species": ["Escherichia coli", "Salmonella enterica"], "mlst.summary.sequence_type.ecoli": "10"})
+    assert query == {
+        "categories.species_detection.summary.species": {"$in": ["Escherichia coli", "Salmonella enterica"]},
+        "categories.mlst.summary.sequence_type.ecoli": "10"
+    }
+    with pytest.raises(KeyError):
+        datahandling.get_category_query({"species_detection.summary.not_a_field": "x"})
+
+def test_flatten_json():
+    assert datahandling.flatten_json({"a": {"b": 1, "c": {"d": [1, 2]}}, "e": None}) == {"a.b": 1, "a.c.d": [1, 2], "e": None}
+
+def test_file_cache(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), max_bytes=10)
+    def fetch(path):
+        with open(path, "w") as file_handle:
+            file_handle.write("ACGTACGT")
+    assert cache.load("file1", "checksum1", str(tmp_path / "a.fasta"), fetch) == False
+    assert cache.load("file1", "checksum1", str(tmp_path / "b.fasta"), fetch) == True
+    assert os.path.samefile(tmp_path / "a.fasta", tmp_path / "b.fasta")
+    assert cache.load("file2", "checksum2", str(tmp_path / "c.fasta"), fetch) == False
+    assert not os.path.exists(cache.entry_path("file1", "checksum1"))
+    assert open(tmp_path / "b.fasta").read() == "ACGTACGT"
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3, "evictions": 1, "entries": 1, "size_bytes": 8}
+
+def test_file_cache_verifies_hits(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), max_bytes=100)
+    def fetch(path):
+        with open(path, "w") as file_handle:
+            file_handle.write("ACGTACGT")
+    def verify(path):
+        if open(path).read() != "ACGTACGT":
+            raise ValueError("corrupt")
+    assert cache.load("file1", "checksum1", str(tmp_path / "a.fasta"), fetch) == False
+    os.utime(tmp_path / "a.fasta", (0, 0))
+    assert cache.load("file1", "checksum1", str(tmp_path / "b.fasta"), fetch, verify) == True
+    # recency is kept in the cache, not in the mtime of the linked user files
+    assert os.stat(tmp_path / "a.fasta").st_mtime == 0
+    os.remove(tmp_path / "a.fasta")
+    os.remove(tmp_path / "b.fasta")
+    os.chmod(cache.entry_path("file1", "checksum1"), 0o644)
+    with open(cache.entry_path("file1", "checksum1"), "w") as file_handle:
+        file_handle.write("corrupt!")
+    assert cache.load("file1", "checksum1", str(tmp_path / "c.fasta"), fetch, verify) == False
+    assert open(tmp_path / "c.fasta").read() == "ACGTACGT"
+
+def test_merge_references():
+    a, b, c = ({"$oid": f"0000000000000000000000e{i}"} for i in range(1, 4))
+    merged = datahandling._merge_references(
+        [{"_id": a, "name": "old_name"}, {"name": "test_host1"}, {"_id": b}],
+        [{"_id": a, "name": "new_name"}, {"_id": c}, {"_id": {"$oid": "0000000000000000000000e4"}, "name": "test_host1"}, {"_id": b}])
+    assert merged == [{"_id": a, "name": "new_name"}, {"_id": {"$oid": "0000000000000000000000e4"}, "name": "test_host1"}, {"_id": b}, {"_id": c}]
+
+def test_compile_requirements():
+    component = Component(value={"_id": {"$oid": "0000000000000000000000f1"}, "name": "test_component1", "requirements": {
+        "sample": {"properties": {"paired_reads": None, "species": ["Escherichia coli", "Shigella"]}, "empty": {}},
+        "component": [{"name": "test_component0", "requirements": {"status": "Success"}}]}})
+    compiled = component.compiled_requirements()
+    assert compiled == {
+        "sample": ((("properties", "paired_reads"), None), (("properties", "species"), ("Escherichia coli", "Shigella"))),
+        "component": (("test_component0", ((("status",), ("Success",)),)),),
+    }
+    assert component.compiled_requirements() is compiled
+    assert datahandling.get_path_value({"properties": {"paired_reads": None}}, ("properties", "paired_reads")) == (True, None)
+    assert datahandling.get_path_value({"properties": {}}, ("properties", "paired_reads", "R1")) == (False, None)
+
+def test_component_graph():
+    graph = ComponentGraph({"assembly": ["qc"], "mlst": ["assembly", "species"], "species": ["qc"], "qc": []})
+    assert graph.order == ["qc", "assembly", "species", "mlst"]
+    assert graph.sort(["mlst", "unknown", "qc"]) == ["qc", "mlst", "unknown"]
+    with pytest.raises(ValueError):
+        ComponentGraph({"a": ["b"], "b": ["a"], "c": []})
+
 @pytest.fixture(scope="module")
 def client():
     client = pymongo.MongoClient(os.environ['BIFROST_DB_KEY'])
@@ -45,16 +135,34 @@ def db(client):
 def samples(db):
     samples = db["samples"]
     yield samples
-    
+
+@pytest.fixture
+def replica_set(client):
+    # change streams and transactions need MongoDB running as a replica set, e.g. mongod --replSet rs0
+    try:
+        set_name = client.admin.command("hello").get("setName")
+    except Exception:
+        set_name = None
+    if set_name is None:
+        pytest.skip("BIFROST_DB_KEY is not a replica set")
 
 class Bifrost:
+    json_entries_by_collection = None  # collection name to the json entries inserted, instead of bson_entries into collection_name
+    drop_files = False  # drop the stored files (fs.files and fs.chunks) as well
     @classmethod
     def setup_class(cls, client):
         client = pymongo.MongoClient(os.environ['BIFROST_DB_KEY'])
         db = client.get_database()
         cls.clear_all_collections(db)
-        col = db[cls.collection_name]
-        col.insert_many(cls.bson_entries)
+        if cls.drop_files:
+            db.drop_collection("fs.files")
+            db.drop_collection("fs.chunks")
+        if cls.json_entries_by_collection is None:
+            col = db[cls.collection_name]
+            col.insert_many(cls.bson_entries)
+        for collection_name, json_entries in (cls.json_entries_by_collection or {}).items():
+            if json_entries:
+                db[collection_name].insert_many([database_interface.json_to_bson(i) for i in json_entries])
     @classmethod
     def teardown_class(cls):
         client = pymongo.MongoClient(os.environ['BIFROST_DB_KEY'])
@@ -555,3 +663,830 @@ class TestBioDBs(Bifrost):
             test_biodb2.save()
         assert test_biodb.delete() == True
         assert test_biodb2.delete() == False
+
+class TestObjectCache(Bifrost):
+    json_entries = [{"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample1", "components": [], "categories": {}, "tags": []}]
+    bson_entries = [database_interface.json_to_bson(i) for i in json_entries]
+    collection_name = "samples"
+
+    def test_cache_hit(self):
+        cache = ObjectCache()
+        reference = SampleReference(_id="000000000000000000000001")
+        assert cache.get(Sample, reference) is not None
+        assert cache.get(Sample, SampleReference(name="test_sample1")) is not None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_cache_invalidated_on_save(self):
+        with ObjectCache(poll_interval=0.5) as cache:
+            reference = SampleReference(_id="000000000000000000000001")
+            sample = cache.get(Sample, reference)
+            sample.add_tag("changed")
+            sample.save()
+            for i in range(20):
+                if len(cache) == 0:
+                    break
+                time.sleep(0.5)
+            assert len(cache) == 0
+            assert "changed" in cache.get(Sample, reference)["tags"]
+
+    def test_change_stream_invalidation(self, replica_set):
+        with ObjectCache(refresh=True) as cache:
+            reference = SampleReference(_id="000000000000000000000001")
+            assert cache.mode == "change_stream"
+            sample = cache.get(Sample, reference)
+            sample.add_tag("streamed")
+            sample.save()
+            for i in range(20):
+                if "streamed" in cache._lookup("sample", reference.json)["tags"]:
+                    break
+                time.sleep(0.5)
+            assert "streamed" in cache.get(Sample, reference)["tags"]
+            assert cache.mode == "change_stream"
+
+    def test_refresh_ignores_uncached_documents(self):
+        cache = ObjectCache(refresh=True)
+        cache.get(Sample, SampleReference(_id="000000000000000000000001"))
+        for _id, name in [("000000000000000000000001", "test_sample1"), ("000000000000000000000002", "uncached")]:
+            cache._apply_change({"operationType": "update", "ns": {"coll": "samples"}, "documentKey": {"_id": bson.ObjectId(_id)},
+                                 "fullDocument": {"_id": bson.ObjectId(_id), "name": name, "tags": ["refreshed"]}})
+        assert len(cache) == 1
+        assert cache.get(Sample, SampleReference(_id="000000000000000000000001"))["tags"] == ["refreshed"]
+
+    def test_invalidation_during_load_is_not_cached(self, monkeypatch):
+        cache = ObjectCache()
+        load = database_interface.load
+        def load_then_invalidate(object_type, reference, projection=None):
+            loaded = load(object_type, reference, projection)
+            cache.invalidate("sample", "000000000000000000000001")  # change arriving before the load is stored
+            return loaded
+        monkeypatch.setattr(database_interface, "load", load_then_invalidate)
+        assert cache.get(Sample, SampleReference(_id="000000000000000000000001")) is not None
+        assert len(cache) == 0
+        monkeypatch.setattr(database_interface, "load", load)
+        cache.get(Sample, SampleReference(_id="000000000000000000000001"))
+        assert len(cache) == 1
+        for i in range(10):
+            cache.invalidate("sample", f"{i:024d}")  # no load in flight, nothing to remember
+        assert cache._invalidated == {} and cache._type_invalidated == {}
+
+    def test_polling_overlaps_writer_clocks(self, client):
+        cache = ObjectCache(use_change_stream=False, poll_overlap=60)
+        cache.start()
+        cache.stop()
+        cache.get(Sample, SampleReference(_id="000000000000000000000001"))
+        assert len(cache) == 1
+        # written by a host whose clock is 5 seconds behind
+        behind = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+        client.get_database()["samples"].update_one({"_id": bson.ObjectId("000000000000000000000001")}, {"$set": {"metadata.updated_at": behind}})
+        cache._poll_once()
+        assert len(cache) == 0
+        cache.get(Sample, SampleReference(_id="000000000000000000000001"))
+        cache._poll_once()
+        assert len(cache) == 1  # the same change isn't invalidated twice
+        cache.start()
+        assert len(cache) == 0  # changes while stopped weren't seen
+        cache.stop()
+
+
+class TestChangedSince(Bifrost):
+    json_entries = []
+    collection_name = "samples"
+    json_entries_by_collection = {}
+
+    def test_changed_since(self):
+        database_interface.index_metadata_dates("sample")
+        for name in ["test_sample1", "test_sample2", "test_sample3"]:
+            Sample(name=name).save()
+        exported = list(Sample.changed_since())
+        assert [i[0]["name"] for i in exported] == ["test_sample1", "test_sample2", "test_sample3"]
+        watermark = exported[-1][1]
+        assert list(Sample.changed_since(watermark, overlap=0)) == []
+        time.sleep(0.01)
+        sample = Sample.load(SampleReference(name="test_sample1"))
+        sample.save()
+        assert [i[0]["name"] for i in Sample.changed_since(watermark, overlap=0)] == ["test_sample1"]
+
+    def test_changed_since_finds_late_writes(self, client):
+        exported = list(Sample.changed_since())
+        watermark = exported[-1][1]
+        # saved after the export by a host whose clock is 5 seconds behind
+        behind = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+        client.get_database()["samples"].update_one({"name": "test_sample2"}, {"$set": {"metadata.updated_at": behind}})
+        assert list(Sample.changed_since(watermark, overlap=0)) == []
+        resumed = list(Sample.changed_since(watermark))
+        assert "test_sample2" in [i[0]["name"] for i in resumed]
+        assert all(i[1] == watermark for i in resumed)  # the watermark doesn't move backwards
+
+
+class TestFindByCategories(Bifrost):
+    json_entries = [
+        {"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample1", "components": [], "categories": {"species_detection": {"summary": {"species": "Escherichia coli"}}}},
+        {"_id": {"$oid": "000000000000000000000002"}, "name": "test_sample2", "components": [], "categories": {"species_detection": {"summary": {"species": "Salmonella enterica"}}}}
+    ]
+    bson_entries = [database_interface.json_to_bson(i) for i in json_entries]
+    collection_name = "samples"
+
+    def test_find_by_categories(self):
+        samples = Sample.find_by_categories({"species_detection.summary.species": "Escherichia coli"}, create_indexes=True)
+        assert [i["name"] for i in samples] == ["test_sample1"]
+        assert "categories.species_detection.summary.species_1" in database_interface.get_index("sample")
+
+    def test_category_table(self):
+        table = Sample.category_table(["species_detection.summary.species"])
+        assert list(table.columns) == ["_id", "name", "species_detection.summary.species"]
+        assert list(table["species_detection.summary.species"]) == ["Escherichia coli", "Salmonella enterica"]
+
+
+class TestRunStatusMatrix(Bifrost):
+    json_entries_samples = [
+        {"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1", "components": [{"name": "test_component1", "status": "Success"}, {"name": "test_component2", "status": "Running"}], "categories": {}},
+        {"_id": {"$oid": "0000000000000000000000a2"}, "name": "test_sample2", "components": [], "categories": {}},
+        {"_id": {"$oid": "0000000000000000000000a3"}, "components": [{"name": "test_component1", "status": "Failure"}], "categories": {}}
+    ]
+    json_entries = [{"_id": {"$oid": "000000000000000000000001"}, "name": "test_run1", "samples": [{"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, {"_id": {"$oid": "0000000000000000000000a2"}, "name": "test_sample2"}], "components": [], "hosts": []},
+                    {"_id": {"$oid": "000000000000000000000002"}, "name": "test_run2", "samples": [{"_id": {"$oid": "0000000000000000000000a3"}}], "components": [], "hosts": []}]
+    collection_name = "runs"
+    json_entries_by_collection = {"samples": json_entries_samples, "runs": json_entries}
+
+    def test_status_matrix(self):
+        run = Run.load(RunReference(_id="000000000000000000000001"))
+        matrix = run.status_matrix()
+        assert list(matrix.index) == ["test_sample1", "test_sample2"]
+        assert list(matrix.columns) == ["test_component1", "test_component2"]
+        assert matrix.loc["test_sample1", "test_component2"] == "Running"
+        assert matrix.loc["test_sample2"].isna().all()
+
+    def test_status_matrix_of_nameless_sample(self):
+        run = Run.load(RunReference(_id="000000000000000000000002"))
+        matrix = run.status_matrix()
+        assert list(matrix.index) == ["0000000000000000000000a3"]
+        assert matrix.loc["0000000000000000000000a3", "test_component1"] == "Failure"
+
+
+class TestSampleComponentFiles(Bifrost):
+    json_entries_samples = [{"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1", "components": [], "categories": {}}]
+    json_entries_components = [{"_id": {"$oid": "0000000000000000000000b1"}, "name": "test_component1", "db_values_changed": {"files": ["test_save_files/report.tsv", "test_save_files/missing.tsv", "test_save_files/summary.tsv"]}}]
+    json_entries = [{"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample_component1", "sample": {"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, "component": {"_id": {"$oid": "0000000000000000000000b1"}, "name": "test_component1"}}]
+    collection_name = "sample_components"
+    json_entries_by_collection = {"samples": json_entries_samples, "components": json_entries_components, "sample_components": json_entries}
+    drop_files = True
+
+    def test_save_files(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("test_save_files")
+        with open("test_save_files/report.tsv", "w") as file_handle:
+            file_handle.write("name\tvalue\n" * 1000)
+        with open("test_save_files/summary.tsv", "w") as file_handle:
+            file_handle.write("total\t1000\n")
+        sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        failures = sample_component.save_files(chunk_size=1024)
+        assert list(failures) == ["test_save_files/missing.tsv"]
+        assert [i["path"] for i in sample_component.json["files"]] == ["test_save_files/report.tsv", "test_save_files/summary.tsv"]
+        owner_id = database_interface.json_to_bson(sample_component.json["_id"])
+        assert len(database_interface.find_files(owner_id, "sample_component")) == 2
+
+
+class TestLoadFile(Bifrost):
+    json_entries = []
+    collection_name = "sample_components"
+    json_entries_by_collection = {}
+    drop_files = True
+
+    def test_load_file_in_chunks(self, tmp_path):
+        content = os.urandom(3 * 1024 * 1024 + 123)
+        with open(tmp_path / "reads.bin", "wb") as file_handle:
+            file_handle.write(content)
+        file_id = database_interface.save_file(bson.ObjectId(), "test_sample_component1", "sample_component", str(tmp_path / "reads.bin"), chunk_size=64 * 1024)
+        loaded_path = str(tmp_path / "loaded.bin")
+        assert database_interface.load_file(file_id, loaded_path, buffer_size=100000, verify_checksum=True) == file_id
+        with open(loaded_path, "rb") as file_handle:
+            assert file_handle.read() == content
+        assert database_interface.load_file(file_id, loaded_path) is None  # FileExistsError
+        assert sorted(os.listdir(tmp_path)) == ["loaded.bin", "reads.bin"]
+
+    def test_failed_checksum_leaves_no_file(self, tmp_path, client):
+        with open(tmp_path / "report.tsv", "w") as file_handle:
+            file_handle.write("gene\tcount\n" * 1000)
+        file_id = database_interface.save_file(bson.ObjectId(), "test_sample_component1", "sample_component", str(tmp_path / "report.tsv"))
+        client.get_database()["fs.files"].update_one({"_id": file_id}, {"$set": {"sha256": "0" * 64}})
+        os.makedirs(tmp_path / "loaded")
+        assert database_interface.load_file(file_id, str(tmp_path / "loaded" / "report.tsv"), buffer_size=1024, verify_checksum=True) is None
+        assert os.listdir(tmp_path / "loaded") == []
+
+    def test_file_without_checksum_is_cached(self, tmp_path, client):
+        fs = database_interface.gridfs.GridFS(client.get_database())
+        file_id = fs.put(b"stored by a client without checksums", full_path="plain.txt", filename="plain.txt")
+        cache = FileCache(str(tmp_path / "cache"), max_bytes=1000)
+        assert database_interface.load_file(file_id, str(tmp_path / "a.txt"), cache=cache) == file_id
+        assert database_interface.load_file(file_id, str(tmp_path / "b.txt"), cache=cache, verify_checksum=True) == file_id
+        assert cache.stats()["hits"] == 1
+        assert open(tmp_path / "b.txt", "rb").read() == b"stored by a client without checksums"
+
+
+class TestFileDeduplication(Bifrost):
+    json_entries = []
+    collection_name = "sample_components"
+    json_entries_by_collection = {}
+    drop_files = True
+
+    def test_identical_content_is_stored_once(self, tmp_path):
+        for name in ["reference1.fasta", "reference2.fasta"]:
+            with open(tmp_path / name, "w") as file_handle:
+                file_handle.write(">contig\nACGT\n" * 1000)
+        owner1, owner2 = bson.ObjectId(), bson.ObjectId()
+        file_id1 = database_interface.save_file(owner1, "test_sample_component1", "sample_component", str(tmp_path / "reference1.fasta"))
+        file_id2 = database_interface.save_file(owner2, "test_sample_component2", "sample_component", str(tmp_path / "reference2.fasta"))
+        assert file_id1 == file_id2
+        assert [i._id for i in database_interface.find_files(owner2)] == [file_id1]
+        assert database_interface.release_file(file_id1, owner1) == False
+        assert database_interface.release_files(owner2) == 1
+        assert database_interface.find_files(owner2) == []
+
+    def test_shared_file_keeps_each_owners_path(self, tmp_path, monkeypatch):
+        for name in ["assembly/contigs.fasta", "other/reference.fasta"]:
+            os.makedirs(os.path.dirname(tmp_path / name), exist_ok=True)
+            with open(tmp_path / name, "w") as file_handle:
+                file_handle.write(">shared\nACGT\n" * 1000)
+        owner1, owner2 = bson.ObjectId(), bson.ObjectId()
+        monkeypatch.chdir(tmp_path)
+        file_id = database_interface.save_file(owner1, "test_sample_component1", "sample_component", "assembly/contigs.fasta")
+        assert database_interface.save_file(owner2, "test_sample_component2", "sample_component", "other/reference.fasta") == file_id
+        listed = {i["owner_id"]: i for i in database_interface.list_files([owner1, owner2])}
+        assert (listed[owner2]["full_path"], listed[owner2]["filename"]) == ("other/reference.fasta", "reference.fasta")
+        assert listed[owner1]["filename"] == "contigs.fasta"
+        os.makedirs(tmp_path / "loaded")
+        assert database_interface.load_file(file_id, str(tmp_path / "loaded"), subpath=True, owner_id=owner2) == file_id
+        assert os.path.isfile(tmp_path / "loaded" / "other" / "reference.fasta")
+        database_interface.release_files(owner1)
+        database_interface.release_files(owner2)
+
+    def test_save_file_replaces_unreferenced_leftover(self, tmp_path):
+        with open(tmp_path / "leftover.txt", "w") as file_handle:
+            file_handle.write("content whose last reference is being released")
+        db = database_interface.get_connection().get_database()
+        stale_id = database_interface.save_file(bson.ObjectId(), "test_sample_component1", "sample_component", str(tmp_path / "leftover.txt"))
+        # released by another client that has not deleted the file yet
+        db["fs.files"].update_one({"_id": stale_id}, {"$set": {"references": [], "refcount": 0}})
+        owner_id = bson.ObjectId()
+        file_id = database_interface.save_file(owner_id, "test_sample_component2", "sample_component", str(tmp_path / "leftover.txt"))
+        assert file_id is not None and file_id != stale_id
+        assert db["fs.files"].count_documents({"_id": stale_id}) == 0
+        assert [i._id for i in database_interface.find_files(owner_id)] == [file_id]
+        database_interface.release_files(owner_id)
+
+    def test_migrate_file_layout(self, tmp_path):
+        db = database_interface.get_connection().get_database()
+        fs = database_interface.gridfs.GridFS(db)
+        owner_id = bson.ObjectId()
+        fs.put(b"stored before deduplication", _id=owner_id, name="test_sample_component1", type="sample_component", full_path="legacy.txt", filename="legacy.txt")
+        assert database_interface.migrate_file_layout() == 1
+        assert not fs.exists(owner_id)
+        migrated = database_interface.find_files(owner_id)
+        assert len(migrated) == 1
+        assert migrated[0].references[0]["_id"] == owner_id
+        assert migrated[0].read() == b"stored before deduplication"
+        assert database_interface.migrate_file_layout() == 0
+
+    def test_compressed_file_round_trip(self, tmp_path):
+        with open(tmp_path / "report.tsv", "w") as file_handle:
+            file_handle.write("".join(f"gene{i}\t{i}\n" for i in range(10000)))
+        file_id = database_interface.save_file(bson.ObjectId(), "test_sample_component1", "sample_component", str(tmp_path / "report.tsv"), compression="gzip")
+        fs = database_interface.gridfs.GridFS(database_interface.get_connection().get_database())
+        stored = fs.get(file_id)
+        assert stored.codec == "gzip"
+        assert stored.length < stored.uncompressed_length == os.path.getsize(tmp_path / "report.tsv")
+        assert database_interface.load_file(file_id, str(tmp_path / "loaded.tsv"), verify_checksum=True) == file_id
+        assert open(tmp_path / "loaded.tsv").read() == open(tmp_path / "report.tsv").read()
+
+    def test_open_file_reads_only_needed_chunks(self, tmp_path):
+        content = "".join(f"record {i}\n" for i in range(100000))
+        with open(tmp_path / "records.txt", "w") as file_handle:
+            file_handle.write(content)
+        file_id = database_interface.save_file(bson.ObjectId(), "test_sample_component1", "sample_component", str(tmp_path / "records.txt"), chunk_size=4096, compression="none")
+        with database_interface.open_file(file_id) as file_handle:
+            file_handle.seek(500000)
+            assert file_handle.read(100) == content.encode()[500000:500100]
+            assert file_handle.raw.chunks_fetched <= file_handle.raw.prefetch_chunks
+        with database_interface.open_file(file_id, "r") as file_handle:
+            assert common.get_group_from_file(r"^(record 4242)$", file_handle) == "record 4242"
+
+    def test_list_files(self, tmp_path):
+        owner1, owner2 = bson.ObjectId(), bson.ObjectId()
+        for owner, name in [(owner1, "contigs.fasta"), (owner1, "report.tsv"), (owner2, "contigs.fasta")]:
+            with open(tmp_path / name, "w") as file_handle:
+                file_handle.write(f"{name}\n")
+            database_interface.save_file(owner, "test_sample_component1", "sample_component", str(tmp_path / name))
+        listing = list(database_interface.list_files([owner1, owner2], "sample_component"))
+        assert sorted((i["owner_id"] == owner1, i["filename"]) for i in listing) == [(False, "contigs.fasta"), (True, "contigs.fasta"), (True, "report.tsv")]
+        assert all(i["length"] > 0 and i["sha256"] for i in listing)
+        assert list(database_interface.list_files([owner1], "sample")) == []
+
+
+class TestOffloadResults(Bifrost):
+    json_entries = [{"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample_component1", "sample": {"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, "component": {"_id": {"$oid": "0000000000000000000000b1"}, "name": "test_component1"}, "categories": {}, "results": {}}]
+    collection_name = "sample_components"
+    json_entries_by_collection = {"sample_components": json_entries}
+    drop_files = True
+
+    def test_large_result_is_offloaded(self, client):
+        sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        sample_component.offload_threshold = 1000
+        sample_component["results"]["cgmlst/alleles.json"] = {"alleles": {f"locus{i}": i for i in range(1000)}}
+        sample_component["results"]["mlst/summary.json"] = {"sequence_type": "10"}
+        sample_component.save()
+        stored = client.get_database()["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})
+        assert datahandling.is_offloaded(stored["results"]["cgmlst/alleles.json"])
+        assert stored["results"]["mlst/summary.json"] == {"sequence_type": "10"}
+        loaded = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        assert loaded["results"]["cgmlst/alleles.json"]["alleles"]["locus999"] == 999
+        del loaded["results"]["cgmlst/alleles.json"]
+        loaded.save()
+        assert database_interface.find_files(bson.ObjectId("000000000000000000000001")) == []
+
+    def test_update_fields_into_offloaded_entry(self, client):
+        _id = bson.ObjectId("000000000000000000000001")
+        sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        sample_component.offload_threshold = 1000
+        sample_component["results"]["cgmlst"] = {"alleles": {f"locus{i}": i for i in range(1000)}}
+        sample_component.save()
+        loaded = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        loaded.update_fields({"results.cgmlst.alleles.locus1": -1, "status": "Running"})
+        stored = client.get_database()["sample_components"].find_one({"_id": _id})
+        assert datahandling.is_offloaded(stored["results"]["cgmlst"])
+        assert stored["status"] == "Running"
+        reloaded = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        assert reloaded["results"]["cgmlst"]["alleles"]["locus1"] == -1
+        assert reloaded["results"]["cgmlst"]["alleles"]["locus999"] == 999
+        assert len(database_interface.find_files(_id)) == 1
+
+    def test_update_fields_sets_whole_entries(self, client):
+        _id = bson.ObjectId("000000000000000000000001")
+        sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        sample_component.offload_threshold = 1000
+        sample_component.update_fields({"results.cgmlst": {"alleles": {}}})
+        stored = client.get_database()["sample_components"].find_one({"_id": _id})
+        assert stored["results"]["cgmlst"] == {"alleles": {}}
+        assert database_interface.find_files(_id) == []  # the file of the offloaded entry is released
+        sample_component.update_fields({"results.cgmlst": {"alleles": {f"locus{i}": i for i in range(1000)}}})
+        stored = client.get_database()["sample_components"].find_one({"_id": _id})
+        assert datahandling.is_offloaded(stored["results"]["cgmlst"])
+        assert SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))["results"]["cgmlst"]["alleles"]["locus999"] == 999
+
+    def test_unchanged_entries_are_not_stored_again(self, client, monkeypatch):
+        sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        sample_component.offload_threshold = 1000
+        sample_component["results"]["cgmlst/alleles.json"] = {"alleles": {f"locus{i}": i for i in range(1000)}}
+        sample_component["categories"]["cgmlst"] = {"name": "cgmlst", "summary": {"alleles": list(range(1000))}}
+        sample_component.save()
+        stored = client.get_database()["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})
+        assert stored["categories"]["cgmlst"]["summary"]["alleles"][999] == 999  # queryable, never offloaded
+        loaded = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        loaded.offload_threshold = 1000
+        assert loaded["results"]["cgmlst/alleles.json"]["alleles"]["locus1"] == 1
+        stored_files = []
+        monkeypatch.setattr(database_interface, "save_json_file", lambda *args, **kwargs: stored_files.append(args))
+        loaded.save()
+        assert stored_files == []
+        assert datahandling.is_offloaded(client.get_database()["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})["results"]["cgmlst/alleles.json"])
+        monkeypatch.undo()
+        loaded["results"]["cgmlst/alleles.json"]["alleles"]["locus1"] = -1
+        loaded.save()
+        assert SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))["results"]["cgmlst/alleles.json"]["alleles"]["locus1"] == -1
+
+
+class TestLazyCategories(Bifrost):
+    json_entries = [{"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample1", "components": [], "categories": {"species_detection": {"name": "species_detection", "summary": {"species": "Escherichia coli"}}, "mlst": {"name": "mlst", "summary": {"sequence_type": {"ecoli": "10"}}}}}]
+    collection_name = "samples"
+    json_entries_by_collection = {"samples": json_entries}
+
+    def test_categories_are_fetched_per_key(self, client):
+        sample = Sample.load(SampleReference(_id="000000000000000000000001"), lazy=True)
+        assert sample._json["categories"] == {}
+        assert sample.get_category("species_detection")["summary"]["species"] == "Escherichia coli"
+        assert list(sample._json["categories"]) == ["species_detection"]
+        sample.set_category(Category(value={"name": "mlst", "summary": {"sequence_type": {"ecoli": "131"}}}))
+        sample.save()
+        stored = client.get_database()["samples"].find_one({"_id": bson.ObjectId("000000000000000000000001")})
+        assert sorted(stored["categories"]) == ["mlst", "species_detection"]
+        assert stored["categories"]["mlst"]["summary"]["sequence_type"]["ecoli"] == "131"
+        assert sample.json["categories"]["species_detection"]["summary"]["species"] == "Escherichia coli"
+
+    def test_load_is_eager_by_default(self):
+        sample = Sample.load(SampleReference(_id="000000000000000000000001"))
+        assert sorted(sample._json["categories"]) == ["mlst", "species_detection"]
+        assert sample._partial == {}
+
+
+class TestWriteBehindBuffer(Bifrost):
+    json_entries = [{"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample1___test_component1", "sample": {"name": "test_sample1"}, "component": {"name": "test_component1"}, "status": "Initialized", "categories": {"mlst": {"name": "mlst", "summary": {"sequence_type": {"ecoli": "10"}}}}}]
+    collection_name = "sample_components"
+    json_entries_by_collection = {"sample_components": json_entries}
+
+    def test_buffered_updates_are_merged(self, client):
+        database_interface.WRITE_BUFFER = database_interface.WriteBehindBuffer(flush_interval=None)
+        try:
+            sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+            sample_component.update_fields({"status": "Running", "properties.progress": {"done": 1, "total": 4}}, buffered=True)
+            sample_component.update_fields({"properties.progress.done": 2}, buffered=True)
+            sample_component.update_fields({"categories.mlst.summary.sequence_type.ecoli": "131"}, buffered=True)
+            stored = client.get_database()["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})
+            assert stored["status"] == "Initialized"
+            assert len(database_interface.WRITE_BUFFER) == 1
+            assert database_interface.flush_write_buffer() == 1
+            stored = client.get_database()["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})
+            assert stored["status"] == "Running"
+            assert stored["properties"]["progress"] == {"done": 2, "total": 4}
+            assert stored["categories"]["mlst"]["name"] == "mlst"
+            assert stored["categories"]["mlst"]["summary"]["sequence_type"]["ecoli"] == "131"
+            assert sample_component.get_category("mlst")["summary"]["sequence_type"]["ecoli"] == "131"
+        finally:
+            database_interface.WRITE_BUFFER = None
+
+    def test_failed_updates_are_kept(self, client):
+        db = client.get_database()
+        host_ids = db["hosts"].insert_many([{"name": "test_host1"}, {"name": "test_host2"}]).inserted_ids
+        db["hosts"].create_index("name", unique=True, name="test_unique_name")
+        try:
+            buffer = database_interface.WriteBehindBuffer(flush_interval=None)
+            buffer.update("sample_component", bson.ObjectId("000000000000000000000001"), {"status": "Success"})
+            buffer.update("host", host_ids[0], {"name": "test_host2"})  # duplicate name, fails
+            buffer.update("host", host_ids[1], {"info": "written"})
+            with pytest.raises(pymongo.errors.BulkWriteError):
+                buffer.flush()
+            assert list(buffer._updates) == [("host", host_ids[0])]
+            assert db["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})["status"] == "Success"
+            assert db["hosts"].find_one({"_id": host_ids[1]})["info"] == "written"
+            buffer.update("host", host_ids[0], {"name": "test_host3"})
+            assert buffer.flush() == 1
+            assert db["hosts"].find_one({"_id": host_ids[0]})["name"] == "test_host3"
+        finally:
+            db["hosts"].drop_index("test_unique_name")
+
+    def test_close_stops_background_flushing(self, client):
+        database_interface.WRITE_BUFFER = database_interface.WriteBehindBuffer(flush_interval=60)
+        try:
+            database_interface.WRITE_BUFFER.update("sample_component", bson.ObjectId("000000000000000000000001"), {"status": "Closed"})
+            thread = database_interface.WRITE_BUFFER._thread
+            assert thread.is_alive()
+            assert database_interface.close_write_buffer() == 1
+            assert not thread.is_alive()
+            assert client.get_database()["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})["status"] == "Closed"
+        finally:
+            database_interface.WRITE_BUFFER = None
+
+
+class TestSaveGraph(Bifrost):
+    json_entries_by_collection = {}
+
+    def test_client_side_ids(self, monkeypatch):
+        assert "_id" not in Sample(name="test_sample0").json
+        monkeypatch.setenv("BIFROST_CLIENT_IDS", "1")
+        sample = Sample(name="test_sample0")
+        assert "_id" in sample.json
+        assert sample.to_reference()["_id"] == sample["_id"]
+        assert "_id" not in Category(name="test_category").json
+
+    def test_save_graph(self, client):
+        run = Run(name="test_run1")
+        samples = [Sample(name=f"test_sample{i}") for i in range(1, 4)]
+        host = Host(name="test_host1")
+        component_reference = ComponentReference(name="test_component1")
+        sample_components = [SampleComponent(sample_reference=SampleReference(name=i["name"]), component_reference=component_reference) for i in samples]
+        run.save_graph(samples, hosts=[host], sample_components=sample_components)
+        db = client.get_database()
+        assert db["samples"].count_documents({}) == 3
+        assert db["hosts"].count_documents({}) == 1
+        assert db["sample_components"].count_documents({}) == 3
+        stored_run = db["runs"].find_one({"name": "test_run1"})
+        assert [database_interface.bson_to_json(i["_id"]) for i in stored_run["samples"]] == [i["_id"] for i in samples]
+        assert database_interface.bson_to_json(stored_run["hosts"][0]["_id"]) == host["_id"]
+        stored_sample_component = db["sample_components"].find_one({"name": "test_sample2___test_component1"})
+        assert database_interface.bson_to_json(stored_sample_component["sample"]["_id"]) == samples[1]["_id"]
+        assert Run.load(run.to_reference())["samples"] == run["samples"]
+
+
+class TestDeleteCascade(Bifrost):
+    json_entries_runs = [
+        {"_id": {"$oid": "0000000000000000000000c1"}, "name": "test_run1", "samples": [{"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, {"name": "test_sample2"}], "components": [], "hosts": []},
+        {"_id": {"$oid": "0000000000000000000000c2"}, "name": "test_run2", "samples": [{"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, {"_id": {"$oid": "0000000000000000000000a3"}, "name": "test_sample3"}], "components": [], "hosts": []}
+    ]
+    json_entries_samples = [
+        {"_id": {"$oid": f"0000000000000000000000a{i}"}, "name": f"test_sample{i}", "components": [], "categories": {}} for i in range(1, 4)
+    ]
+    json_entries = [
+        {"_id": {"$oid": f"00000000000000000000000{i}"}, "name": f"test_sample{i}___test_component1", "sample": {"_id": {"$oid": f"0000000000000000000000a{i}"}, "name": f"test_sample{i}"}, "component": {"name": "test_component1"}, "status": "Failure"} for i in range(1, 4)
+    ]
+    json_entries_run_components = [
+        {"_id": {"$oid": "0000000000000000000000d1"}, "name": "test_run1___test_component2", "run": {"_id": {"$oid": "0000000000000000000000c1"}, "name": "test_run1"}, "component": {"name": "test_component2"}, "status": "Failure"}
+    ]
+    collection_name = "sample_components"
+    json_entries_by_collection = {"runs": json_entries_runs, "samples": json_entries_samples, "sample_components": json_entries, "run_components": json_entries_run_components}
+    drop_files = True
+
+    def test_delete_run(self, client, tmp_path):
+        for name in ["contigs.fasta", "report.tsv"]:
+            with open(tmp_path / name, "w") as file_handle:
+                file_handle.write(f"{name}\n" * 1000)
+        owned_file = database_interface.save_file(bson.ObjectId("000000000000000000000002"), "test_sample2___test_component1", "sample_component", str(tmp_path / "report.tsv"))
+        shared_file = database_interface.save_file(bson.ObjectId("000000000000000000000002"), "test_sample2___test_component1", "sample_component", str(tmp_path / "contigs.fasta"))
+        database_interface.save_file(bson.ObjectId("000000000000000000000003"), "test_sample3___test_component1", "sample_component", str(tmp_path / "contigs.fasta"))
+        run = Run.load(RunReference(_id="0000000000000000000000c1"))
+        # test_sample1 is listed by test_run2 as well so it's kept
+        expected = {"runs": 1, "samples": 1, "run_components": 1, "sample_components": 1, "files": 1, "shared_samples": 1}
+        assert run.delete_cascade(dry_run=True) == expected
+        db = client.get_database()
+        assert db["samples"].count_documents({}) == 3
+        assert run.delete_cascade() == expected
+        assert [i["name"] for i in db["samples"].find()] == ["test_sample1", "test_sample3"]
+        assert [i["name"] for i in db["sample_components"].find()] == ["test_sample1___test_component1", "test_sample3___test_component1"]
+        assert db["run_components"].count_documents({}) == 0
+        assert [i["name"] for i in db["runs"].find_one({"name": "test_run2"})["samples"]] == ["test_sample1", "test_sample3"]
+        assert db["fs.files"].count_documents({"_id": owned_file}) == 0
+        assert db["fs.chunks"].count_documents({"files_id": owned_file}) == 0
+        assert db["fs.files"].find_one({"_id": shared_file})["refcount"] == 1
+
+
+class TestRequirements(Bifrost):
+    json_entries_samples = [
+        {"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1", "components": [], "categories": {"paired_reads": {"name": "paired_reads", "summary": {"data": ["R1.fastq.gz", "R2.fastq.gz"]}}, "species_detection": {"name": "species_detection", "summary": {"species": "Escherichia coli"}}}},
+        {"_id": {"$oid": "0000000000000000000000a2"}, "name": "test_sample2", "components": [], "categories": {"species_detection": {"name": "species_detection", "summary": {"species": "Salmonella enterica"}}}},
+        {"_id": {"$oid": "0000000000000000000000a3"}, "components": [], "categories": {}}
+    ]
+    json_entries_components = [
+        {"_id": {"$oid": "0000000000000000000000b1"}, "name": "test_component1", "requirements": {
+            "sample": {"categories": {"paired_reads": {"summary": {"data": None}}, "species_detection": {"summary": {"species": ["Escherichia coli", "Shigella"]}}}},
+            "component": [{"name": "test_component0", "requirements": {"status": "Success"}}]}},
+        {"_id": {"$oid": "0000000000000000000000b0"}, "name": "test_component0"},
+        {"_id": {"$oid": "0000000000000000000000b2"}, "name": "test_component2", "requirements": {"component": [{"name": "test_component3"}]}}
+    ]
+    json_entries = [
+        {"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample1___test_component0", "sample": {"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, "component": {"_id": {"$oid": "0000000000000000000000b0"}, "name": "test_component0"}, "status": "Success"},
+        {"_id": {"$oid": "000000000000000000000002"}, "name": "test_sample2___test_component0", "sample": {"_id": {"$oid": "0000000000000000000000a2"}, "name": "test_sample2"}, "component": {"_id": {"$oid": "0000000000000000000000b0"}, "name": "test_component0"}, "status": "Success"},
+        {"_id": {"$oid": "000000000000000000000003"}, "name": "test_sample1___test_component3", "sample": {"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, "component": {"name": "test_component3"}, "status": "Success"},
+        {"_id": {"$oid": "000000000000000000000004"}, "name": "test_sample2___test_component3", "sample": {"_id": {"$oid": "0000000000000000000000a2"}, "name": "test_sample2"}, "component": {"name": "test_component3"}, "status": "Running"}
+    ]
+    collection_name = "sample_components"
+    json_entries_by_collection = {"samples": json_entries_samples, "components": json_entries_components, "sample_components": json_entries}
+
+    def test_has_requirements(self):
+        component_reference = ComponentReference(_id="0000000000000000000000b1", name="test_component1")
+        sample_component1 = SampleComponent(sample_reference=SampleReference(_id="0000000000000000000000a1", name="test_sample1"), component_reference=component_reference)
+        sample_component2 = SampleComponent(sample_reference=SampleReference(_id="0000000000000000000000a2", name="test_sample2"), component_reference=component_reference)
+        assert sample_component1.has_requirements() == True
+        assert sample_component2.has_requirements() == False
+
+    def test_check_requirements(self):
+        component = Component.load(ComponentReference(_id="0000000000000000000000b1"))
+        results = component.check_requirements([SampleReference(_id="0000000000000000000000a1"), SampleReference(name="test_sample2"), SampleReference(name="test_sample3")])
+        assert results["test_sample1"].passed and results["test_sample1"].reasons == []
+        assert not results["test_sample2"]
+        assert results["test_sample2"].reasons == ["categories.paired_reads.summary.data: missing", "categories.species_detection.summary.species: 'Salmonella enterica' not in ['Escherichia coli', 'Shigella']"]
+        assert results["test_sample3"].reasons == ["sample: not found"]
+        assert datahandling.count_failures(results.values()) == {"categories.paired_reads.summary.data": 1, "categories.species_detection.summary.species": 1, "sample": 1}
+
+    def test_check_requirements_of_nameless_sample(self):
+        component = Component.load(ComponentReference(_id="0000000000000000000000b1"))
+        results = component.check_requirements([SampleReference(_id="0000000000000000000000a3"), SampleReference(name="test_sample1")])
+        assert sorted(results) == ["0000000000000000000000a3", "test_sample1"]
+        assert results["test_sample1"].passed
+        assert not results["0000000000000000000000a3"]
+
+    def test_component_without_requirements_has_to_succeed(self):
+        component = Component.load(ComponentReference(_id="0000000000000000000000b2"))
+        assert component.compiled_requirements()["component"] == (("test_component3", ((("status",), ("Success",)),)),)
+        results = component.check_requirements([SampleReference(name="test_sample1"), SampleReference(name="test_sample2")])
+        assert results["test_sample1"].passed
+        assert results["test_sample2"].reasons == ["test_component3: status: 'Running' not in ['Success']"]
+        lookup = component.requirements_pipeline()[1]["$lookup"]["pipeline"][0]["$match"]
+        assert lookup["status"] == {"$in": ["Success"]}
+        graph = ComponentGraph.load()
+        assert list(graph.dependencies["test_component2"]) == ["test_component3"]
+
+    def test_requirements_report_is_silent(self, capsys):
+        component_reference = ComponentReference(_id="0000000000000000000000b1", name="test_component1")
+        sample_component = SampleComponent(sample_reference=SampleReference(_id="0000000000000000000000a2", name="test_sample2"), component_reference=component_reference)
+        report = sample_component.requirements_report()
+        assert capsys.readouterr().err == ""
+        assert [(i.json["path"], i.passed) for i in report.checks] == [("categories.paired_reads.summary.data", False), ("categories.species_detection.summary.species", False), ("status", True)]
+        assert report.checks[2].component == "test_component0"
+
+    def test_requirements_report_of_missing_sample_or_component(self):
+        component_reference = ComponentReference(_id="0000000000000000000000b1", name="test_component1")
+        missing_sample = SampleComponent(sample_reference=SampleReference(_id="0000000000000000000000a9", name="test_sample9"), component_reference=component_reference)
+        assert not missing_sample.requirements_report().found
+        missing_component = SampleComponent(sample_reference=SampleReference(_id="0000000000000000000000a1", name="test_sample1"), component_reference=ComponentReference(_id="0000000000000000000000b9", name="test_component9"))
+        assert not missing_component.requirements_report().found
+
+    def test_find_ready_samples(self):
+        component = Component.load(ComponentReference(_id="0000000000000000000000b1"))
+        assert datahandling.requirements_query(component.compiled_requirements()["sample"]) == {
+            "categories.paired_reads.summary.data": {"$exists": True},
+            "categories.species_detection.summary.species": {"$in": ["Escherichia coli", "Shigella"]}
+        }
+        assert [i["name"] for i in component.find_ready_samples(create_indexes=True)] == ["test_sample1"]
+
+    def test_requirements_on_offloaded_results(self, client):
+        client.get_database()["components"].insert_one(database_interface.json_to_bson(
+            {"_id": {"$oid": "0000000000000000000000b4"}, "name": "test_component4", "requirements": {"component": [{"name": "test_component0", "requirements": {"results": {"alleles": {"passed": True}}}}]}}))
+        sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000001"))
+        sample_component.offload_threshold = 1000
+        sample_component["results"] = {"alleles": {"passed": True, "loci": list(range(1000))}}
+        sample_component.save()
+        assert datahandling.is_offloaded(client.get_database()["sample_components"].find_one({"_id": bson.ObjectId("000000000000000000000001")})["results"]["alleles"])
+        component = Component.load(ComponentReference(_id="0000000000000000000000b4"))
+        results = component.check_requirements([SampleReference(name="test_sample1"), SampleReference(name="test_sample2")])
+        assert results["test_sample1"].passed
+        assert results["test_sample2"].reasons == ["test_component0: results.alleles.passed: missing"]
+        reference = ComponentReference(_id="0000000000000000000000b4", name="test_component4")
+        assert SampleComponent(sample_reference=SampleReference(name="test_sample1"), component_reference=reference).requirements_report()
+        with pytest.raises(ValueError):
+            component.requirements_pipeline()
+        assert [i["name"] for i in component.find_ready_samples(batch_size=1)] == ["test_sample1"]
+
+
+class TestRunScheduler(Bifrost):
+    json_entries_runs = [{"_id": {"$oid": "0000000000000000000000c1"}, "name": "test_run1", "samples": [{"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, {"_id": {"$oid": "0000000000000000000000a2"}, "name": "test_sample2"}], "components": [], "hosts": []}]
+    json_entries_components = [
+        {"_id": {"$oid": "0000000000000000000000b1"}, "name": "test_qc"},
+        {"_id": {"$oid": "0000000000000000000000b2"}, "name": "test_assembly", "requirements": {"component": [{"name": "test_qc", "requirements": {"status": "Success"}}]}},
+        {"_id": {"$oid": "0000000000000000000000b3"}, "name": "test_mlst", "requirements": {"component": [{"name": "test_assembly", "requirements": {"status": "Success"}}]}}
+    ]
+    json_entries = [
+        {"_id": {"$oid": "000000000000000000000001"}, "name": "test_sample1___test_qc", "sample": {"_id": {"$oid": "0000000000000000000000a1"}, "name": "test_sample1"}, "component": {"_id": {"$oid": "0000000000000000000000b1"}, "name": "test_qc"}, "status": "Success", "metadata": {"created_at": {"$date": "2021-01-01T00:00:00.000Z"}, "updated_at": {"$date": "2021-01-01T00:00:00.000Z"}}},
+        {"_id": {"$oid": "000000000000000000000002"}, "name": "test_sample2___test_qc", "sample": {"_id": {"$oid": "0000000000000000000000a2"}, "name": "test_sample2"}, "component": {"_id": {"$oid": "0000000000000000000000b1"}, "name": "test_qc"}, "status": "Running", "metadata": {"created_at": {"$date": "2021-01-01T00:00:00.000Z"}, "updated_at": {"$date": "2021-01-01T00:00:00.000Z"}}}
+    ]
+    collection_name = "sample_components"
+    json_entries_by_collection = {"runs": json_entries_runs, "components": json_entries_components, "sample_components": json_entries}
+
+    def test_frontier_follows_statuses(self):
+        scheduler = RunScheduler(RunReference(_id="0000000000000000000000c1"))
+        assert scheduler.components == ["test_qc", "test_assembly", "test_mlst"]
+        assert scheduler.frontier() == {"test_sample1": ["test_assembly"], "test_sample2": []}
+        assert scheduler.refresh() == {}
+        sample_component = SampleComponent.load(SampleComponentReference(_id="000000000000000000000002"))
+        sample_component["status"] = "Success"
+        sample_component.save()
+        assert scheduler.refresh() == {"test_sample2": ["test_assembly"]}
+        assert list(scheduler.ready()) == [("test_sample1", "test_assembly"), ("test_sample2", "test_assembly")]
+
+    def test_refresh_finds_late_writes(self, client):
+        scheduler = RunScheduler(RunReference(_id="0000000000000000000000c1"))
+        sample_components = client.get_database()["sample_components"]
+        # a worker whose clock is 5 seconds behind finishes test_assembly on test_sample1
+        behind = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+        sample_components.insert_one({"name": "test_sample1___test_assembly", "sample": {"_id": bson.ObjectId("0000000000000000000000a1"), "name": "test_sample1"}, "component": {"name": "test_assembly"}, "status": "Success", "metadata": {"updated_at": behind}})
+        assert scheduler.refresh() == {"test_sample1": ["test_mlst"]}
+        # a clock further behind than the overlap is caught by the full refresh
+        sample_components.insert_one({"name": "test_sample2___test_assembly", "sample": {"_id": bson.ObjectId("0000000000000000000000a2"), "name": "test_sample2"}, "component": {"name": "test_assembly"}, "status": "Success", "metadata": {"updated_at": datetime.datetime(2021, 1, 1)}})
+        assert scheduler.refresh() == {}
+        assert scheduler.refresh(full=True) == {"test_sample2": ["test_mlst"]}
+
+    def test_full_refresh_forgets_removed_samplecomponents(self, client):
+        scheduler = RunScheduler(RunReference(_id="0000000000000000000000c1"))
+        assert scheduler.frontier()["test_sample1"] == ["test_mlst"]
+        client.get_database()["sample_components"].delete_one({"name": "test_sample1___test_assembly"})
+        assert scheduler.refresh(full=True) == {"test_sample1": ["test_assembly"]}
+        assert "test_assembly" not in scheduler.statuses["test_sample1"]
+
+    def test_refresh_of_run_without_samplecomponents(self, client):
+        client.get_database()["runs"].insert_one({"_id": bson.ObjectId("0000000000000000000000c2"), "name": "test_run2", "samples": [{"name": "test_sample9"}], "components": [], "hosts": []})
+        scheduler = RunScheduler(RunReference(_id="0000000000000000000000c2"))
+        assert scheduler._watermark is not None  # the next refresh isn't a full rescan
+        full_refreshed_at = scheduler._full_refreshed_at
+        assert scheduler.refresh() == {}
+        assert scheduler._full_refreshed_at == full_refreshed_at
+
+    def test_full_refresh_sees_undated_samplecomponents(self, client):
+        sample_components = client.get_database()["sample_components"]
+        sample_components.insert_one({"name": "test_sample2___test_mlst", "sample": {"_id": bson.ObjectId("0000000000000000000000a2"), "name": "test_sample2"}, "component": {"name": "test_mlst"}, "status": "Running", "metadata": {"updated_at": "2021-01-01T00:00:00"}})
+        scheduler = RunScheduler(RunReference(_id="0000000000000000000000c1"))
+        assert scheduler.statuses["test_sample2"]["test_mlst"] == "Running"
+        assert scheduler.frontier()["test_sample2"] == []  # already started, not run twice
+
+
+def claim_until_empty(worker_id):
+    queue = WorkQueue(worker_id)
+    claimed = []
+    sample_component = queue.claim()
+    while sample_component is not None:
+        assert queue.complete(database_interface.json_to_bson(sample_component["_id"]))
+        claimed.append(sample_component["name"])
+        sample_component = queue.claim()
+    return claimed
+
+
+class TestWorkQueue(Bifrost):
+    json_entries = [
+        {"_id": {"$oid": f"0000000000000000000000{i:02d}"}, "name": f"test_sample{i}___test_component1", "sample": {"name": f"test_sample{i}"}, "component": {"name": "test_component1"}, "status": "Queued"}
+        for i in range(1, 21)
+    ]
+    collection_name = "sample_components"
+    json_entries_by_collection = {"sample_components": json_entries}
+
+    def test_claim_heartbeat_and_expiry(self):
+        queue = WorkQueue("worker1", lease_seconds=60)
+        other = WorkQueue("worker2", lease_seconds=60)
+        sample_component = queue.claim()
+        _id = database_interface.json_to_bson(sample_component["_id"])
+        assert sample_component["status"] == "Running"
+        assert queue.heartbeat(_id) == True
+        assert other.heartbeat(_id) == False
+        assert other.complete(_id) == False
+        queue.lease_seconds = -1
+        assert queue.heartbeat(_id) == True  # lease now expired
+        assert other.claim()["_id"] == sample_component["_id"]
+        assert queue.complete(_id) == False
+        assert other.fail(_id, "test") == True
+        assert queue.enqueue([_id]) == 0  # finished samplecomponents are left alone
+        assert queue.enqueue([_id], rerun=True) == 1
+
+    def test_heartbeat_within_the_same_millisecond(self, monkeypatch):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        monkeypatch.setattr(work_queue, "_now", lambda: now)
+        queue = WorkQueue("worker1", lease_seconds=60)
+        _id = database_interface.json_to_bson(queue.claim()["_id"])
+        assert queue.heartbeat(_id) == True
+        assert queue.heartbeat(_id) == True  # writes the same lease again, still held
+        assert queue.complete(_id) == True
+
+    def test_release_and_max_attempts(self, client):
+        collection = client.get_database()["sample_components"]
+        queue = WorkQueue("worker1", lease_seconds=60, max_attempts=2)
+        ids = [database_interface.json_to_bson(i["_id"]) for i in self.json_entries[:2]]
+        collection.update_many({"_id": {"$in": ids}}, {"$set": {"status": "Initialized", "attempts": 0}})
+        assert queue.enqueue(ids) == 2
+        for i in range(3):
+            _id = database_interface.json_to_bson(queue.claim()["_id"])
+            assert _id == ids[0]
+            assert queue.release(_id) == True
+        assert collection.find_one({"_id": ids[0]})["attempts"] == 0
+        queue.lease_seconds = -1
+        assert database_interface.json_to_bson(queue.claim()["_id"]) == ids[0]
+        assert database_interface.json_to_bson(queue.claim()["_id"]) == ids[0]  # second attempt, lease expired
+        # out of attempts, failed by the next claim instead of staying Running
+        assert database_interface.json_to_bson(queue.claim()["_id"]) == ids[1]
+        assert collection.find_one({"_id": ids[0]})["status"] == "Failure"
+        assert collection.find_one({"_id": ids[0]})["failure_reason"] == "lease expired"
+        collection.update_many({"_id": {"$in": ids}}, {"$set": {"status": "Queued", "attempts": 0}, "$unset": {"lease": ""}})
+
+    def test_workers_claim_each_item_once(self):
+        with multiprocessing.get_context("spawn").Pool(3) as pool:
+            claimed = pool.map(claim_until_empty, ["worker1", "worker2", "worker3"])
+        names = [name for worker_claimed in claimed for name in worker_claimed]
+        assert sorted(names) == sorted(i["name"] for i in self.json_entries)
+
+    def test_wait_for(self):
+        queue = WorkQueue("worker1")
+        ids = [database_interface.json_to_bson(i["_id"]) for i in self.json_entries[:3]]
+        queue.enqueue(ids, rerun=True)
+        queue.claim()
+        queue.complete(ids[0])
+        done = []
+        with pytest.raises(TimeoutError):
+            for _id, status in wait_for(ids, timeout=0.2, poll_interval=0.05, use_change_stream=False):
+                done.append((_id, status))
+        assert done == [(ids[0], "Success")]
+        queue.claim()
+        queue.claim()
+        queue.fail(ids[1])
+        queue.complete(ids[2])
+        assert sorted(wait_for(ids[1:], timeout=5, poll_interval=0.05, use_change_stream=False)) == [(ids[1], "Failure"), (ids[2], "Success")]
+
+    def test_wait_for_change_stream(self, replica_set, client, monkeypatch):
+        collection = client.get_database()["sample_components"]
+        ids = [database_interface.json_to_bson(i["_id"]) for i in self.json_entries[3:5]]
+        collection.update_many({"_id": {"$in": ids}}, {"$set": {"status": "Running"}})
+        collection.update_one({"_id": ids[0]}, {"$set": {"status": "Success"}})
+        # polling every 60s would time out, so both have to come from the change stream
+        waiting = wait_for(ids, timeout=5, poll_interval=60)
+        assert next(waiting) == (ids[0], "Success")  # finished before the stream was opened
+        collection.update_one({"_id": ids[1]}, {"$set": {"status": "Failure"}})
+        assert list(waiting) == [(ids[1], "Failure")]
+        collection.update_one({"_id": ids[1]}, {"$set": {"status": "Running"}})
+        def no_polling(seconds):
+            raise AssertionError("fell back to polling")
+        monkeypatch.setattr(work_queue.time, "sleep", no_polling)
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            list(wait_for(ids[1:], timeout=0.5, poll_interval=60))
+        assert time.monotonic() - started < 3
+        collection.update_many({"_id": {"$in": ids}}, {"$set": {"status": "Queued"}})
+
+    def test_wait_for_resumes_change_stream(self, replica_set, client, monkeypatch):
+        collection = client.get_database()["sample_components"]
+        ids = [database_interface.json_to_bson(self.json_entries[5]["_id"])]
+        collection.update_many({"_id": {"$in": ids}}, {"$set": {"status": "Running"}})
+        try_next = pymongo.change_stream.ChangeStream.try_next
+        failed = []
+        def fail_once(stream):
+            if not failed:
+                failed.append(stream)
+                collection.update_one({"_id": ids[0]}, {"$set": {"status": "Success"}})  # written while the stream is down
+                raise pymongo.errors.AutoReconnect("connection lost")
+            return try_next(stream)
+        def no_polling(seconds):
+            raise AssertionError("fell back to polling")
+        monkeypatch.setattr(pymongo.change_stream.ChangeStream, "try_next", fail_once)
+        monkeypatch.setattr(work_queue.time, "sleep", no_polling)
+        assert list(wait_for(ids, timeout=5, poll_interval=60)) == [(ids[0], "Success")]
+        collection.update_many({"_id": {"$in": ids}}, {"$set": {"status": "Queued"}})